@@ -3,6 +3,9 @@ import { Frame } from './components/Frame';
 import { Terminal } from './components/Terminal';
 import { Dialog } from './components/Dialog';
 
+const RESUME_ATTEMPTS = 5;
+const RESUME_DELAY_MS = 1000;
+
 function App() {
   //state: "initial" or "terminal"
   const [state, setState] = useState<'initial' | 'terminal'>('initial');
@@ -13,6 +16,8 @@ function App() {
 
   // WebSocket reference
   const websocketRef = useRef<WebSocket | null>(null);
+  // Bytes of output received, so a dropped connection can resume where it left off.
+  const offsetRef = useRef(0);
 
   //create a clientId (uuid) on app startup.
   const clientIdRef = useRef<string>('');
@@ -24,12 +29,37 @@ function App() {
   const host = import.meta.env.VITE_SERVER_HOST || 'localhost';
   const port = import.meta.env.VITE_SERVER_PORT || '3000';
 
+  // Change version the device list is at, so a refresh only pulls what changed.
+  const devicesVersionRef = useRef<number | null>(null);
+
   const refreshRemotes = async () => {    
     console.log(`Fetching devices from http://${host}:${port}/devices`);
 
     try {
+      if (devicesVersionRef.current !== null) {
+        const response = await fetch(`http://${host}:${port}/devices/changes?since=${devicesVersionRef.current}`);
+        if (response.ok) {
+          const data = await response.json();
+          devicesVersionRef.current = data.version;
+          setRemotes((remotes) => {
+            const byId = new Map(remotes.map((remote) => [remote.id, remote]));
+            for (const change of data.changes) {
+              if (change.event === 'leave') {
+                byId.delete(change.id);
+              } else {
+                byId.set(change.id, change);
+              }
+            }
+            return [...byId.values()];
+          });
+          return;
+        }
+        // 410: too far behind for deltas, list everything again.
+      }
+
       const response = await fetch(`http://${host}:${port}/devices`);
       const data = await response.json();
+      devicesVersionRef.current = data.version;
       setRemotes(data.devices);
     } catch (error) {
     }
@@ -61,19 +91,41 @@ function App() {
     }
 
     const { websocket_url } = await response.json();
-    const websocket = new WebSocket(websocket_url);
+    offsetRef.current = 0;
+    openWebsocket(websocket_url, websocket_url, RESUME_ATTEMPTS);
+    setState('terminal');
+  };
+
+  const openWebsocket = (sessionUrl: string, url: string, attemptsLeft: number) => {
+    const websocket = new WebSocket(url);
     websocketRef.current = websocket;
+    const encoder = new TextEncoder();
+
+    websocket.onopen = () => {
+      attemptsLeft = RESUME_ATTEMPTS;
+    };
 
     websocket.onmessage = (event) => {
+      offsetRef.current += encoder.encode(event.data).length;
       setTerminalLines((prevLines) => [...prevLines, event.data]);
     };
 
-    websocket.onclose = () => {
+    websocket.onclose = (event) => {
+      if (websocketRef.current !== websocket) {
+        return;
+      }
+      // The server keeps the session for a while when the connection drops.
+      if (event.code !== 1000 && attemptsLeft > 0) {
+        console.log('WebSocket connection dropped. Resuming session.');
+        setTimeout(
+          () => openWebsocket(sessionUrl, `${sessionUrl}?offset=${offsetRef.current}`, attemptsLeft - 1),
+          RESUME_DELAY_MS,
+        );
+        return;
+      }
       console.log('WebSocket connection closed.');
       onDisconnect();
     };
-
-    setState('terminal');
   };
 
   let onDisconnect = () => {
@@ -83,8 +135,9 @@ function App() {
     setTerminalLines([]);
 
     if (websocketRef.current) {
-      websocketRef.current.close();
+      const websocket = websocketRef.current;
       websocketRef.current = null;
+      websocket.close(1000);
     }
   };
 
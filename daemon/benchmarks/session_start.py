@@ -0,0 +1,113 @@
+"""
+Session start benchmark: time from a shell request until the first byte of
+the prompt reaches the server.
+
+Run from the daemon directory:
+
+    python -m benchmarks.session_start [--shell /bin/bash] [--sessions 50]
+
+A local websocket server stands in for the relay. Each session is started
+the way Main handles a shell request, by entering a RemoteShell, and timed
+until the server receives its first frame. Compared:
+
+- printenv: the environment built by running and parsing printenv per
+  session, as sessions used to.
+- cached env: the environment snapshot shared by every session.
+- warm pool: a shell taken from a ShellPool, started before the request.
+- multiplexed: a warm shell, its session opened as a channel of one
+  connection kept open (SESSION_TRANSPORT=mux) rather than a websocket of
+  its own. Over a real network, and TLS, the handshake saved is larger.
+"""
+import time
+import asyncio
+import argparse
+import subprocess
+
+from websockets.asyncio.server import serve
+
+from daemon.shell import Shell, ENGINE_PTY
+from daemon.shell_pool import ShellPool
+from daemon.mux import MuxConnector, MUX_HEADER, MUX_OPEN, MUX_CLOSE
+from daemon.remote_shell import RemoteShell
+from benchmarks.common import percentile, print_table
+
+
+class PrintenvShell(Shell):
+    def get_environment_variables(self):
+        output = subprocess.check_output(["printenv"], text=True)
+        env_vars = dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+        env_vars["SHELL"] = self.shell
+        env_vars["PS1"] = self.shell_profile.ps1
+        return env_vars
+
+
+class PromptServer:
+    """Records when the first frame of each session arrives, then hangs up."""
+
+    def __init__(self):
+        self.first_frame = None
+
+    async def handler(self, websocket):
+        await websocket.recv()
+        self.first_frame.set_result(time.perf_counter())
+        await websocket.close()
+
+    async def mux_handler(self, websocket):
+        """The same over a multiplexed connection: hang up each channel on its first frame."""
+        async for message in websocket:
+            kind, channel_id = MUX_HEADER.unpack_from(message)
+            if kind != MUX_OPEN and not self.first_frame.done():
+                self.first_frame.set_result(time.perf_counter())
+                await websocket.send(MUX_HEADER.pack(MUX_CLOSE, channel_id))
+
+
+async def run(
+    name: str, shell_path: str, sessions: int, pool_size: int, shell_class=Shell, mux: bool = False
+) -> list:
+    server = PromptServer()
+    pool = ShellPool(pool_size, lambda: shell_class(shell_path, engine=ENGINE_PTY))
+    connector = MuxConnector() if mux else None
+    latencies = []
+    async with serve(server.mux_handler if mux else server.handler, "127.0.0.1", 0) as ws_server:
+        port = ws_server.sockets[0].getsockname()[1]
+        pool.fill()
+        for i in range(sessions):
+            # Requests are usually seconds apart; let the pool refill between them.
+            while len(pool.idle) < pool.size:
+                await asyncio.sleep(0.001)
+            server.first_frame = asyncio.get_running_loop().create_future()
+
+            requested = time.perf_counter()
+            remote_shell = RemoteShell(pool.take(), connector=connector and connector.connect)
+            session = asyncio.create_task(remote_shell.enter(f"ws://127.0.0.1:{port}/ws/daemon/session-{i}"))
+            latencies.append(await asyncio.wait_for(server.first_frame, 10) - requested)
+            await session
+        await pool.close()
+        if connector:
+            await connector.close()
+
+    return [
+        name,
+        sessions,
+        f"{percentile(latencies, 50) * 1e3:.2f}",
+        f"{percentile(latencies, 99) * 1e3:.2f}",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shell", default="/bin/bash")
+    parser.add_argument("--sessions", type=int, default=50)
+    args = parser.parse_args()
+
+    rows = [
+        asyncio.run(run("printenv", args.shell, args.sessions, 0, PrintenvShell)),
+        asyncio.run(run("cached env", args.shell, args.sessions, 0)),
+        asyncio.run(run("warm pool", args.shell, args.sessions, 2)),
+        asyncio.run(run("multiplexed", args.shell, args.sessions, 2, mux=True)),
+    ]
+    print_table(["start", "sessions", "first byte p50 ms", "p99 ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Shell I/O benchmark, PTY engine against the pipe engine, and the PTY engine
+behind an OutputBatcher as RemoteShell runs it.
+
+Run from the daemon directory:
+
+    python -m benchmarks.shell_io [--shell /bin/bash] [--mbytes 32] [--echoes 200]
+
+Throughput streams `mbytes` of base64 text out of the shell. Echo latency is
+the time from handing a command line to the shell until its output arrives.
+Frames counts the sink calls, i.e. the websocket messages a session would send.
+"""
+import time
+import asyncio
+import argparse
+
+from daemon.shell import Shell, ENGINE_PTY, ENGINE_PIPE
+from daemon.output import OutputBatcher
+from benchmarks.common import percentile, print_table
+
+
+class ShellHarness:
+    def __init__(self, shell_path: str, engine: str, batched: bool):
+        self.shell = Shell(shell_path, engine=engine)
+        self.batcher = OutputBatcher(self.on_output) if batched else None
+        self.inputs = asyncio.Queue()
+        self.output = []
+        self.output_size = 0
+        self.frames = 0
+        self.waiting_for = None
+        self.found = asyncio.Event()
+
+        self.shell.set_input_source(self.inputs.get)
+        self.shell.set_output_sink(self.batcher.write if batched else self.on_output)
+
+    async def on_output(self, data: bytes):
+        self.output_size += len(data)
+        self.frames += 1
+        if self.waiting_for is None:
+            return
+        self.output.append(data)
+        # Markers are short, so only the tail of the output needs checking.
+        if self.waiting_for in b"".join(self.output[-4:]):
+            self.found.set()
+
+    async def run_until(self, command: str, marker: str, timeout: float = 120):
+        self.output.clear()
+        self.found.clear()
+        self.waiting_for = marker.encode()
+        await self.inputs.put(command)
+        await asyncio.wait_for(self.found.wait(), timeout)
+        self.waiting_for = None
+
+
+async def run(shell_path: str, engine: str, batched: bool, mbytes: int, echoes: int):
+    harness = ShellHarness(shell_path, engine, batched)
+    session = asyncio.create_task(harness.shell.enter())
+    await harness.run_until("echo __ready__", "__ready__")
+
+    n_bytes = mbytes * 1024 * 1024
+    harness.output_size = 0
+    harness.frames = 0
+    start = time.perf_counter()
+    await harness.run_until(f"head -c {n_bytes * 3 // 4} /dev/zero | base64; echo __done__", "__done__")
+    elapsed = time.perf_counter() - start
+    throughput = harness.output_size / elapsed
+    frames = harness.frames
+
+    latencies = []
+    for i in range(echoes):
+        start = time.perf_counter()
+        await harness.run_until(f"echo ping{i}x", f"ping{i}x")
+        latencies.append(time.perf_counter() - start)
+
+    await harness.inputs.put("exit")
+    await asyncio.wait_for(session, 10)
+
+    return [
+        engine + (" + batch" if batched else ""),
+        f"{throughput / 1e6:,.1f}",
+        frames,
+        f"{percentile(latencies, 50) * 1e3:.3f}",
+        f"{percentile(latencies, 99) * 1e3:.3f}",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shell", default="/bin/bash")
+    parser.add_argument("--mbytes", type=int, default=32)
+    parser.add_argument("--echoes", type=int, default=200)
+    args = parser.parse_args()
+
+    rows = [
+        asyncio.run(run(args.shell, engine, batched, args.mbytes, args.echoes))
+        for engine, batched in ((ENGINE_PIPE, False), (ENGINE_PTY, False), (ENGINE_PTY, True))
+    ]
+    print_table(["engine", "MB/s", "frames", "echo p50 ms", "echo p99 ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Daemon start-up benchmark: how long a daemon takes from exec to its first
+heartbeat, and how much memory it holds while idle.
+
+Run from the daemon directory (Linux, for /proc):
+
+    python -m benchmarks.startup [--runs 5] [--ticks 3]
+
+A local HTTP server stands in for the easyshell server and answers every
+heartbeat with nop. Each run starts `python main.py` as a device would,
+times it until its first heartbeat arrives, and reads its VmRSS after
+`ticks` more. Compared:
+
+- idle: the plain heartbeat loop, as most daemons run.
+- after a session: the same daemon once a shell request has loaded the
+  session machinery. The request points at a closed port, so no shell is
+  started; only the imports and setup are counted.
+- warm pool: SHELL_POOL_SIZE=1, which loads the machinery at start. The
+  pooled shell's own process is not counted.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.common import percentile, print_table
+
+DAEMON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class HeartbeatServer(ThreadingHTTPServer):
+    """Counts heartbeats per instance; answers one shell request to instances listed in shell_requests."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), HeartbeatHandler)
+        self.heartbeats: dict[str, list[float]] = {}
+        self.shell_requests: set[str] = set()
+        self.changed = threading.Condition()
+
+    def wait_for(self, instance_id: str, count: int, timeout: float = 30) -> list[float]:
+        with self.changed:
+            if not self.changed.wait_for(lambda: len(self.heartbeats.get(instance_id, ())) >= count, timeout):
+                raise TimeoutError(f"{instance_id} sent no heartbeat #{count}")
+            return self.heartbeats[instance_id]
+
+    def handle_error(self, request, client_address):
+        # Daemons are terminated with a heartbeat in flight.
+        pass
+
+
+class HeartbeatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        instance_id = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["id"]
+        answer = {"status": "nop"}
+        with self.server.changed:
+            self.server.heartbeats.setdefault(instance_id, []).append(time.perf_counter())
+            if instance_id in self.server.shell_requests:
+                self.server.shell_requests.discard(instance_id)
+                # Nothing listens there; the daemon loads everything, then fails to connect.
+                answer = {"status": "shell_request", "ws_url": "ws://127.0.0.1:9/ws/daemon/benchmark"}
+            self.server.changed.notify_all()
+        body = json.dumps(answer).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run(server: HeartbeatServer, instance_id: str, ticks: int, session: bool, pool_size: int) -> tuple[float, float]:
+    env = dict(
+        os.environ,
+        HEARTBEAT_ENDPOINT="127.0.0.1",
+        HEARTBEAT_PORT=str(server.server_address[1]),
+        HEARTBEAT_INTERVAL="1",
+        HEARTBEAT_FAST_INTERVAL="1",
+        INSTANCE_ID=instance_id,
+        SHELL_POOL_SIZE=str(pool_size),
+    )
+    started = time.perf_counter()
+    daemon = subprocess.Popen(
+        [sys.executable, "main.py"], cwd=DAEMON_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        cold_start = server.wait_for(instance_id, 1)[0] - started
+        if session:
+            server.shell_requests.add(instance_id)
+        server.wait_for(instance_id, 1 + ticks)
+        return cold_start, rss_mb(daemon.pid)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--ticks", type=int, default=3)
+    args = parser.parse_args()
+
+    server = HeartbeatServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    rows = []
+    for name, session, pool_size in [("idle", False, 0), ("after a session", True, 0), ("warm pool", False, 1)]:
+        results = [
+            run(server, f"{name}-{i}", args.ticks, session, pool_size) for i in range(args.runs)
+        ]
+        cold_starts = [cold_start for cold_start, _ in results]
+        rss = [rss for _, rss in results]
+        rows.append([
+            name,
+            args.runs,
+            f"{percentile(cold_starts, 50) * 1e3:.0f}",
+            f"{max(cold_starts) * 1e3:.0f}",
+            f"{percentile(rss, 50):.1f}",
+        ])
+    server.shutdown()
+    print_table(["daemon", "runs", "first heartbeat p50 ms", "max ms", "RSS MB"], rows)
+
+
+if __name__ == "__main__":
+    main()
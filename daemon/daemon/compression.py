@@ -0,0 +1,53 @@
+from websockets.frames import Frame, Opcode
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ClientPerMessageDeflateFactory
+
+
+class SelectivePerMessageDeflate(PerMessageDeflate):
+    """
+    permessage-deflate that sends messages under min_bytes uncompressed,
+    so short interactive output does not wait on the compressor. Such
+    messages leave the compression context alone; larger output still
+    compresses against everything sent before.
+    """
+
+    def __init__(self, *args, min_bytes: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_bytes = min_bytes
+
+    def encode(self, frame: Frame) -> Frame:
+        if frame.fin and frame.opcode in (Opcode.TEXT, Opcode.BINARY) and len(frame.data) < self.min_bytes:
+            return frame
+        return super().encode(frame)
+
+
+class SelectiveDeflateFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, min_bytes: int, **kwargs):
+        super().__init__(**kwargs)
+        self.min_bytes = min_bytes
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return SelectivePerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_bytes=self.min_bytes,
+        )
+
+
+def connect_options(compression: str, min_bytes: int) -> dict:
+    """
+    Keyword arguments for websockets' connect. "deflate" offers
+    permessage-deflate, which the server accepts if it has compression on;
+    anything else sends everything uncompressed.
+    """
+    if compression != "deflate":
+        return {"compression": None}
+    factory = SelectiveDeflateFactory(
+        min_bytes=min_bytes,
+        client_max_window_bits=True,
+        compress_settings={"memLevel": 5},
+    )
+    return {"compression": None, "extensions": [factory]}
@@ -4,17 +4,74 @@ from dataclasses import dataclass
 
 class Config:
     HEARTBEAT_INTERVAL = 5
+    HEARTBEAT_MAX_INTERVAL = 60
+    HEARTBEAT_FAST_INTERVAL = 1
     HEARTBEAT_ENDPOINT = ""
     HEARTBEAT_PORT = 7843
+    HEARTBEAT_TIMEOUT = 10  # seconds a heartbeat request may take
     FORCED_SHELL = None
     INSTANCE_ID = ""
+    # Aggregator mode: instance IDs heartbeated together in one batched tick.
+    AGGREGATE_INSTANCE_IDS: list[str] = []
+    SHELL_ENGINE = "pty"
+    OUTPUT_BATCH_BYTES = 32 * 1024
+    OUTPUT_BATCH_DELAY_MS = 5
+    CONTROL_MODE = "poll"
+    CONTROL_RETRY_INTERVAL = 60
+    MAX_SESSIONS = 4
+    # "mux" carries every session over one websocket per server.
+    SESSION_TRANSPORT = "websocket"
+    # permessage-deflate, if the server accepts it; "none" disables it.
+    COMPRESSION = "deflate"
+    COMPRESSION_MIN_BYTES = 256  # smaller messages are sent as they are
+    # Shells kept started ahead of sessions; 0 starts each on demand.
+    SHELL_POOL_SIZE = 0
+    # Per session; 0 disables a limit.
+    SESSION_OUTPUT_RATE = 0  # bytes per second
+    SESSION_OUTPUT_BURST = 256 * 1024
+    SESSION_IDLE_TIMEOUT = 0  # seconds without input or output
+    SESSION_CPU_SECONDS = 0  # per process of the session
+    SESSION_MEMORY_MB = 0  # address space, per process of the session
+    SESSION_NICE = 0
 
     @classmethod
     def init(cls):
         cls.HEARTBEAT_INTERVAL = int(
             os.getenv("HEARTBEAT_INTERVAL", cls.HEARTBEAT_INTERVAL)
         )
+        cls.HEARTBEAT_MAX_INTERVAL = int(
+            os.getenv("HEARTBEAT_MAX_INTERVAL", cls.HEARTBEAT_MAX_INTERVAL)
+        )
+        cls.HEARTBEAT_FAST_INTERVAL = int(
+            os.getenv("HEARTBEAT_FAST_INTERVAL", cls.HEARTBEAT_FAST_INTERVAL)
+        )
         cls.HEARTBEAT_ENDPOINT = os.getenv("HEARTBEAT_ENDPOINT", cls.HEARTBEAT_ENDPOINT)
         cls.HEARTBEAT_PORT = int(os.getenv("HEARTBEAT_PORT", cls.HEARTBEAT_PORT))
+        cls.HEARTBEAT_TIMEOUT = int(os.getenv("HEARTBEAT_TIMEOUT", cls.HEARTBEAT_TIMEOUT))
         cls.FORCED_SHELL = os.getenv("FORCED_SHELL", cls.FORCED_SHELL)
-        cls.INSTANCE_ID = UUID = os.getenv("INSTANCE_ID") 
\ No newline at end of file
+        cls.INSTANCE_ID = UUID = os.getenv("INSTANCE_ID") 
+        cls.AGGREGATE_INSTANCE_IDS = [
+            instance_id.strip()
+            for instance_id in os.getenv("AGGREGATE_INSTANCE_IDS", "").split(",")
+            if instance_id.strip()
+        ]
+        cls.SHELL_ENGINE = os.getenv("SHELL_ENGINE", cls.SHELL_ENGINE)
+        cls.OUTPUT_BATCH_BYTES = int(os.getenv("OUTPUT_BATCH_BYTES", cls.OUTPUT_BATCH_BYTES))
+        cls.OUTPUT_BATCH_DELAY_MS = int(
+            os.getenv("OUTPUT_BATCH_DELAY_MS", cls.OUTPUT_BATCH_DELAY_MS)
+        )
+        cls.CONTROL_MODE = os.getenv("CONTROL_MODE", cls.CONTROL_MODE)
+        cls.CONTROL_RETRY_INTERVAL = int(
+            os.getenv("CONTROL_RETRY_INTERVAL", cls.CONTROL_RETRY_INTERVAL)
+        )
+        cls.MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", cls.MAX_SESSIONS))
+        cls.SESSION_TRANSPORT = os.getenv("SESSION_TRANSPORT", cls.SESSION_TRANSPORT)
+        cls.COMPRESSION = os.getenv("COMPRESSION", cls.COMPRESSION)
+        cls.COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", cls.COMPRESSION_MIN_BYTES))
+        cls.SHELL_POOL_SIZE = int(os.getenv("SHELL_POOL_SIZE", cls.SHELL_POOL_SIZE))
+        cls.SESSION_OUTPUT_RATE = int(os.getenv("SESSION_OUTPUT_RATE", cls.SESSION_OUTPUT_RATE))
+        cls.SESSION_OUTPUT_BURST = int(os.getenv("SESSION_OUTPUT_BURST", cls.SESSION_OUTPUT_BURST))
+        cls.SESSION_IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT", cls.SESSION_IDLE_TIMEOUT))
+        cls.SESSION_CPU_SECONDS = int(os.getenv("SESSION_CPU_SECONDS", cls.SESSION_CPU_SECONDS))
+        cls.SESSION_MEMORY_MB = int(os.getenv("SESSION_MEMORY_MB", cls.SESSION_MEMORY_MB))
+        cls.SESSION_NICE = int(os.getenv("SESSION_NICE", cls.SESSION_NICE))
\ No newline at end of file
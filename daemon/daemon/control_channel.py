@@ -0,0 +1,61 @@
+import json
+import asyncio
+import logging as log
+from websockets.asyncio.client import connect
+from websockets.exceptions import WebSocketException
+
+from daemon.heartbeat import Heartbeat
+
+
+class ControlChannel:
+    """
+    Persistent websocket to the server for push mode. The server sends
+    instructions (shell_request, stop) down it as soon as they exist; the
+    daemon sends a small frame every `interval` seconds so the server keeps
+    the device listed, instead of a full HTTP heartbeat.
+    """
+
+    PING = json.dumps({"type": "ping"})
+
+    def __init__(self, instance_id, endpoint, port=7843, interval=5):
+        self.instance_id = instance_id
+        self.endpoint = endpoint
+        self.port = port
+        self.interval = interval
+
+    async def run(self, on_response) -> bool:
+        """
+        Serve the channel, calling on_response(response_code, body) for every
+        instruction. Returns False when the channel cannot be opened or is
+        lost, so the caller can fall back to polling, and True once
+        on_response returns False (e.g. on stop).
+        """
+        url = f"ws://{self.endpoint}:{self.port}/ws/control"
+        log.info("Opening control channel to %s.", url)
+
+        try:
+            async with connect(url, open_timeout=10) as websocket:
+                await websocket.send(json.dumps({"id": self.instance_id, "auth_type": "otp"}))
+                log.info("Control channel open.")
+
+                pinger = asyncio.create_task(self._ping(websocket))
+                try:
+                    async for message in websocket:
+                        body = json.loads(message)
+                        response_code = Heartbeat.response_code(body.get("status", "nop"))
+                        if not on_response(response_code, body):
+                            return True
+                finally:
+                    pinger.cancel()
+
+            log.error("Control channel closed by server.")
+            return False
+
+        except (OSError, asyncio.TimeoutError, WebSocketException, json.JSONDecodeError) as e:
+            log.error("Control channel failed: %s", e)
+            return False
+
+    async def _ping(self, websocket):
+        while True:
+            await asyncio.sleep(self.interval)
+            await websocket.send(self.PING)
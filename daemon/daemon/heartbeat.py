@@ -1,51 +1,215 @@
+import json
+import time
+import socket
+import http.client
 import logging as log
-import requests
+from collections import deque
+
+# Errors that fail a tick: the server unreachable or hanging up, an HTTP
+# error status, or a body that is not JSON.
+TICK_ERRORS = (OSError, http.client.HTTPException, ValueError)
 
 class Heartbeat:
     RESPONSE_EMPTY = 0
     RESPONSE_STOP = 1
     RESPONSE_SHELL_REQUEST = 2
 
-    def __init__(self, instance_id, auth, endpoint, port=7843):
+    # Ticks run at fast_interval after a shell request, when another one
+    # (or a reconnect) is most likely.
+    FAST_TICKS = 6
+    STATS_WINDOW = 120
+    STATS_LOG_EVERY = 60
+
+    def __init__(
+        self, instance_id, auth, endpoint, port=7843, interval=5, max_interval=60, fast_interval=1, timeout=10
+    ):
         self.instance_id = instance_id
         self.auth = auth
         self.endpoint = endpoint
         self.port = port
+        self.interval = interval
+        self.max_interval = max_interval
+        self.fast_interval = fast_interval
+        # Socket timeout of the connection, which bounds a tick: every
+        # connect, send and read fails after this many seconds.
+        self.timeout = timeout
+
+        # One keep-alive connection for every tick. http.client rather than
+        # requests, which would cost an idle daemon about 14 MB and 100 ms
+        # of start-up for a single POST every few seconds. It blocks, so
+        # the daemon runs ticks in a thread and interrupt()s it on shutdown.
+        self.connection: http.client.HTTPConnection | None = None
+        self.closing = False
+        self.path = "/heartbeat"
+        self.body = {
+            "id": self.instance_id,
+            "auth_type": "otp",
+        }
+
+        self.failures = 0
+        self.fast_ticks_left = 0
+        self.latencies = deque(maxlen=self.STATS_WINDOW)
+        self.ticks = 0
+        self.failed_ticks = 0
+
+    @staticmethod
+    def response_code(status: str) -> int:
+        """Map a status sent by the server to one of the RESPONSE_* codes."""
+        match status:
+            case "stop":
+                log.info("Received stop command from server.")
+                return Heartbeat.RESPONSE_STOP
+            case "shell_request":
+                log.info("Received shell request from server.")
+                return Heartbeat.RESPONSE_SHELL_REQUEST
+            case "nop":
+                log.debug("No operation requested by server.")
+                return Heartbeat.RESPONSE_EMPTY
+            case _:
+                log.warning("Unknown status received: %s", status)
+                return Heartbeat.RESPONSE_EMPTY
+
+    def read_response(self, response_json: dict) -> tuple[int, dict]:
+        return Heartbeat.response_code(response_json.get("status", "nop")), response_json
+
+    def next_interval(self) -> float:
+        """
+        Seconds to wait before the next tick: doubled per consecutive failure
+        up to max_interval while the server is unreachable, fast_interval for
+        a few ticks after a shell request, the regular interval otherwise.
+        """
+        if self.failures:
+            return min(self.interval * 2 ** (self.failures - 1), self.max_interval)
+        if self.fast_ticks_left:
+            self.fast_ticks_left -= 1
+            return self.fast_interval
+        return self.interval
+
+    def stats(self) -> dict:
+        """Round-trip latency of the recent successful ticks, in seconds."""
+        ordered = sorted(self.latencies)
+        if not ordered:
+            return {"ticks": self.ticks, "failed": self.failed_ticks}
+        return {
+            "ticks": self.ticks,
+            "failed": self.failed_ticks,
+            "p50": ordered[len(ordered) // 2],
+            "p95": ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)],
+            "max": ordered[-1],
+        }
+
+    def post(self) -> dict:
+        """POST the body to path and return the decoded answer."""
+        # The server may have closed a kept-alive connection since the last
+        # tick, which only shows on the next request; that one is retried
+        # on a new connection instead of failing the tick.
+        reused = self.connection is not None
+        try:
+            return self._post()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            self.close()
+            if not reused or self.closing:
+                raise
+        return self._post()
+
+    def _post(self) -> dict:
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.endpoint, self.port, timeout=self.timeout)
+        self.connection.request(
+            "POST", self.path, json.dumps(self.body), {"Content-Type": "application/json"}
+        )
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.status >= 400:
+            raise http.client.HTTPException(f"{response.status} {response.reason} for {self.path}")
+        return json.loads(body)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def interrupt(self):
+        """
+        Make a tick blocked on the connection in another thread fail now
+        rather than at its timeout, without reconnecting. A connect still
+        in progress runs out its timeout.
+        """
+        self.closing = True
+        connection = self.connection
+        sock = connection.sock if connection is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def tick(self) -> tuple[int, dict]:
-        log.info("Sending heartbeat to %s:%s.", self.endpoint, self.port)
+        log.debug("Sending heartbeat to %s:%s.", self.endpoint, self.port)
+        self.ticks += 1
 
         try:
             response_code = Heartbeat.RESPONSE_EMPTY
 
-            response = requests.post(
-                f"http://{self.endpoint}:{self.port}/heartbeat",
-                json={
-                    "id": self.instance_id,
-                    "auth_type": "otp",
-                },
-                timeout=10,
-            )
-            response.raise_for_status()
-
-            response_json = response.json()
-            status = response_json.get("status", "nop")
-
-            match status:
-                case "stop":
-                    log.info("Received stop command from server.")
-                    response_code = Heartbeat.RESPONSE_STOP
-                case "shell_request":
-                    log.info("Received shell request from server.")
-                    response_code = Heartbeat.RESPONSE_SHELL_REQUEST
-                case "nop":
-                    log.info("No operation requested by server.")
-                    response_code = Heartbeat.RESPONSE_EMPTY
-                case _:
-                    log.warning("Unknown status received: %s", status)
+            start = time.perf_counter()
+            response_json = self.post()
+            self.latencies.append(time.perf_counter() - start)
+            self.failures = 0
+
+            response_code, response_json = self.read_response(response_json)
+            if response_code == Heartbeat.RESPONSE_SHELL_REQUEST:
+                self.fast_ticks_left = self.FAST_TICKS
 
             return response_code, response_json
 
-        except requests.RequestException as e:
+        except TICK_ERRORS as e:
+            self.close()
+            self.failures += 1
+            self.failed_ticks += 1
             log.error("Heartbeat request failed: %s", e)
-            return response_code, {}
\ No newline at end of file
+            return response_code, {}
+
+        finally:
+            if self.ticks % self.STATS_LOG_EVERY == 0:
+                self.log_stats()
+
+    def log_stats(self):
+        stats = self.stats()
+        if "p50" not in stats:
+            log.info("Heartbeat stats: %s ticks, %s failed.", stats["ticks"], stats["failed"])
+            return
+        log.info(
+            "Heartbeat stats: %s ticks, %s failed, latency p50 %.1f ms, p95 %.1f ms, max %.1f ms.",
+            stats["ticks"],
+            stats["failed"],
+            stats["p50"] * 1000,
+            stats["p95"] * 1000,
+            stats["max"] * 1000,
+        )
+
+
+class BatchHeartbeat(Heartbeat):
+    """
+    Heartbeats several local instances in one request to /heartbeats, for a
+    gateway daemon that stands in for the devices behind it. A tick answers
+    RESPONSE_SHELL_REQUEST with {"instructions": [...]}, one shell request
+    per instance the server has a session for.
+    """
+
+    def __init__(self, instance_ids, auth, endpoint, **kwargs):
+        super().__init__(instance_ids[0], auth, endpoint, **kwargs)
+        self.instance_ids = instance_ids
+        self.path = "/heartbeats"
+        self.body = {
+            "devices": [{"id": instance_id, "auth_type": "otp"} for instance_id in instance_ids],
+        }
+
+    def read_response(self, response_json: dict) -> tuple[int, dict]:
+        instructions = [
+            instruction
+            for instruction in response_json.get("instructions", [])
+            if Heartbeat.response_code(instruction.get("status", "nop")) == Heartbeat.RESPONSE_SHELL_REQUEST
+        ]
+        if not instructions:
+            return Heartbeat.RESPONSE_EMPTY, response_json
+        return Heartbeat.RESPONSE_SHELL_REQUEST, {"instructions": instructions}
@@ -0,0 +1,217 @@
+import struct
+import asyncio
+import logging as log
+from collections import deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit
+
+from websockets.asyncio.client import connect, ClientConnection
+from websockets.exceptions import ConnectionClosed, ConnectionClosedOK, InvalidStatus, WebSocketException
+
+# Framing of a multiplexed connection; must match the server's
+# easyshell_server.mux. Every message is one binary websocket frame.
+MUX_HEADER = struct.Struct("!BI")  # message type, channel id
+MUX_CREDIT = struct.Struct("!I")  # payload of MUX_WINDOW
+
+MUX_OPEN = 0  # Payload: the session secret.
+MUX_TEXT = 1
+MUX_BINARY = 2
+MUX_WINDOW = 3  # Bytes the receiver consumed, which the sender may send again.
+MUX_CLOSE = 4
+
+INITIAL_WINDOW = 256 * 1024
+
+
+def mux_url(websocket_url: str) -> tuple[str, str]:
+    """The multiplexed endpoint serving a ws://host/ws/daemon/<secret> URL, and the secret."""
+    parts = urlsplit(websocket_url)
+    base, _, session_secret = parts.path.rpartition("/")
+    path = base.rpartition("/")[0] + "/mux"
+    return urlunsplit((parts.scheme, parts.netloc, path, "", "")), session_secret
+
+
+class Channel:
+    """
+    One session on a Multiplexer, with the recv/send/close surface that
+    RemoteShell uses of a websocket. A channel sends at most INITIAL_WINDOW
+    bytes, plus the frame that crosses it, that the server has not
+    consumed yet, so a session whose client is slow only stalls itself.
+    """
+
+    def __init__(self, multiplexer: "Multiplexer", channel_id: int):
+        self.multiplexer = multiplexer
+        self.id = channel_id
+        self.frames: deque[tuple[str | bytes, int]] = deque()
+        self.send_window = INITIAL_WINDOW
+        # Consumed bytes not yet granted back to the server.
+        self.consumed = 0
+        self.closed = False
+        self._readable = asyncio.Event()
+        self._window_open = asyncio.Event()
+        self._window_open.set()
+
+    def feed(self, frame: str | bytes, size: int):
+        self.frames.append((frame, size))
+        self._readable.set()
+
+    def grant(self, size: int):
+        self.send_window += size
+        if self.send_window > 0:
+            self._window_open.set()
+
+    def hang_up(self):
+        self.closed = True
+        self._readable.set()
+        self._window_open.set()
+
+    async def recv(self):
+        while not self.frames:
+            if self.closed:
+                raise ConnectionClosedOK(None, None)
+            self._readable.clear()
+            await self._readable.wait()
+
+        frame, size = self.frames.popleft()
+        self.consumed += size
+        if self.consumed >= INITIAL_WINDOW // 2 and not self.closed:
+            credit, self.consumed = self.consumed, 0
+            await self.multiplexer.send(MUX_WINDOW, self.id, MUX_CREDIT.pack(credit))
+        return frame
+
+    async def send(self, data):
+        if isinstance(data, str):
+            payload, kind = data.encode(), MUX_TEXT
+        else:
+            payload, kind = data, MUX_BINARY
+        while self.send_window <= 0 and not self.closed:
+            self._window_open.clear()
+            await self._window_open.wait()
+        if self.closed:
+            raise ConnectionClosedOK(None, None)
+        self.send_window -= len(payload)
+        await self.multiplexer.send(kind, self.id, payload)
+
+    async def close(self):
+        if self.closed:
+            return
+        self.hang_up()
+        self.multiplexer.channels.pop(self.id, None)
+        try:
+            await self.multiplexer.send(MUX_CLOSE, self.id)
+        except ConnectionClosed:
+            pass
+
+
+class Multiplexer:
+    """
+    One websocket to the server's /ws/mux, carrying the daemon side of many
+    sessions as channels. Opening a session costs a single small frame
+    instead of a TCP and websocket handshake.
+    """
+
+    def __init__(self, websocket: ClientConnection):
+        self.websocket = websocket
+        self.channels: dict[int, Channel] = {}
+        self.next_id = 0
+        self.reader = asyncio.create_task(self._read())
+
+    @property
+    def closed(self) -> bool:
+        return self.reader.done()
+
+    async def send(self, kind: int, channel_id: int, payload: bytes = b""):
+        await self.websocket.send(MUX_HEADER.pack(kind, channel_id) + payload)
+
+    async def open(self, session_secret: str) -> Channel:
+        self.next_id += 1
+        channel = self.channels[self.next_id] = Channel(self, self.next_id)
+        await self.send(MUX_OPEN, channel.id, session_secret.encode())
+        return channel
+
+    async def close(self):
+        await self.websocket.close()
+        await asyncio.gather(self.reader, return_exceptions=True)
+
+    async def _read(self):
+        try:
+            async for message in self.websocket:
+                if not isinstance(message, bytes) or len(message) < MUX_HEADER.size:
+                    log.error("Malformed message on the multiplexed connection. Closing it.")
+                    await self.websocket.close()
+                    break
+                kind, channel_id = MUX_HEADER.unpack_from(message)
+                channel = self.channels.get(channel_id)
+                if channel is None:
+                    # Closed here while the server was still sending.
+                    continue
+                payload = message[MUX_HEADER.size:]
+                if kind == MUX_TEXT:
+                    channel.feed(payload.decode(errors="replace"), len(payload))
+                elif kind == MUX_BINARY:
+                    channel.feed(payload, len(payload))
+                elif kind == MUX_WINDOW:
+                    channel.grant(MUX_CREDIT.unpack(payload)[0])
+                elif kind == MUX_CLOSE:
+                    channel.hang_up()
+                    del self.channels[channel_id]
+                else:
+                    log.warning("Unknown multiplexed message type: %s", kind)
+        except ConnectionClosed:
+            pass
+        finally:
+            log.info("Multiplexed connection closed; ending its %s sessions.", len(self.channels))
+            for channel in self.channels.values():
+                channel.hang_up()
+            self.channels.clear()
+
+
+class MuxConnector:
+    """
+    Connects sessions the way websockets' connect does, but as channels of
+    one Multiplexer per server, opened by the first session and reopened by
+    the first after it drops. A server without /ws/mux gets a websocket per
+    session, as before. options are passed on to websockets' connect.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.multiplexers: dict[str, Multiplexer] = {}
+        self.unsupported: set[str] = set()
+        self._connecting = asyncio.Lock()
+
+    @asynccontextmanager
+    async def connect(self, websocket_url: str):
+        url, session_secret = mux_url(websocket_url)
+        try:
+            multiplexer = await self._multiplexer(url)
+        except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+            if isinstance(e, InvalidStatus):
+                self.unsupported.add(url)
+            log.warning("Cannot multiplex sessions over %s (%s); using a websocket of their own.", url, e)
+            multiplexer = None
+
+        if multiplexer is None:
+            async with connect(websocket_url, **self.options) as websocket:
+                yield websocket
+            return
+
+        channel = await multiplexer.open(session_secret)
+        try:
+            yield channel
+        finally:
+            await channel.close()
+
+    async def _multiplexer(self, url: str) -> Multiplexer | None:
+        if url in self.unsupported:
+            return None
+        async with self._connecting:
+            multiplexer = self.multiplexers.get(url)
+            if multiplexer is None or multiplexer.closed:
+                log.info("Opening multiplexed connection to %s.", url)
+                multiplexer = self.multiplexers[url] = Multiplexer(await connect(url, open_timeout=10, **self.options))
+            return multiplexer
+
+    async def close(self):
+        for multiplexer in self.multiplexers.values():
+            await multiplexer.close()
+        self.multiplexers.clear()
@@ -0,0 +1,80 @@
+import time
+import asyncio
+
+
+class OutputBatcher:
+    """
+    Pipeline stage that collects raw shell output and sends it in batches.
+
+    Bytes written to it are flushed to the sink once max_bytes are pending,
+    or max_delay seconds after the first pending byte, whichever comes
+    first. Every send is awaited and sends never overlap, so output stays in
+    order, and write() blocks while a full batch is being sent, which pushes
+    back on the shell.
+    """
+
+    def __init__(self, sink, max_bytes: int = 32 * 1024, max_delay: float = 0.005):
+        self.sink = sink
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.buffer = bytearray()
+        self._flush_lock = asyncio.Lock()
+        self._timer = None
+
+    async def write(self, data: bytes):
+        self._reap_timer()
+        self.buffer += data
+        if len(self.buffer) >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self.buffer:
+                batch = bytes(self.buffer[:self.max_bytes])
+                del self.buffer[:self.max_bytes]
+                await self.sink(batch)
+
+    async def close(self):
+        """Send whatever is still pending."""
+        if self._timer is not None:
+            # At most max_delay away; cancelling could cut a send in half.
+            await asyncio.gather(self._timer, return_exceptions=True)
+            self._timer = None
+        await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        await self.flush()
+
+    def _reap_timer(self):
+        """Forget a finished timed flush, raising its error (e.g. a closed connection)."""
+        timer = self._timer
+        if timer is not None and timer.done():
+            self._timer = None
+            timer.result()
+
+
+class TokenBucket:
+    """
+    Output rate limit of a session: bursts of up to `burst` bytes, refilled
+    at `rate` bytes per second. take() may overdraw and then sleeps off the
+    debt, so a batch larger than the burst still goes out whole. A sink
+    that takes before each send is held to the rate, and the OutputBatcher
+    and the shell behind it back up and coalesce instead.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def take(self, n: int):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= n
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
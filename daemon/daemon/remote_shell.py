@@ -1,36 +1,120 @@
 import asyncio
+import codecs
 import logging as log
 from websockets.asyncio.client import connect
 from websockets.exceptions import ConnectionClosed
 from daemon.shell import Shell
+from daemon.output import OutputBatcher, TokenBucket
+
+# How long a rejected session waits for the server to hang up, so the
+# reason reaches the client before the connection drops.
+REJECT_LINGER = 5
 
 class RemoteShell:
-    def __init__(self, shell: "Shell"):
+    def __init__(
+        self,
+        shell: "Shell",
+        batch_bytes: int = 32 * 1024,
+        batch_delay: float = 0.005,
+        output_rate: int = 0,
+        output_burst: int = 0,
+        idle_timeout: float = 0,
+        connector=None,
+    ):
+        """
+        output_rate caps the session's output in bytes per second, with
+        bursts of output_burst; idle_timeout closes the session after that
+        many seconds without input or output. 0 disables either. connector
+        opens the session's connection, by default a websocket of its own.
+        """
         self.shell = shell
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+        self.output_rate = output_rate
+        self.output_burst = output_burst
+        self.idle_timeout = idle_timeout
+        self.connector = connector or connect
+        self.last_activity = 0.0
+
+    @staticmethod
+    async def reject(websocket_url: str, reason: str):
+        """Tell the client why its session will not start, then close it."""
+        try:
+            async with connect(websocket_url) as websocket:
+                await websocket.send(reason)
+                try:
+                    await asyncio.wait_for(websocket.wait_closed(), REJECT_LINGER)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            log.error(f"Error rejecting remote shell: {e}")
+
+    async def close_when_idle(self, websocket):
+        """Close the session once it has seen no input or output for idle_timeout seconds."""
+        loop = asyncio.get_running_loop()
+        while (idle_for := loop.time() - self.last_activity) < self.idle_timeout:
+            await asyncio.sleep(self.idle_timeout - idle_for)
+        log.info("Session idle for %s seconds. Closing it.", self.idle_timeout)
+        await websocket.send(f"\nSession closed after {self.idle_timeout:g} seconds of inactivity.\n")
+        await websocket.close()
 
     async def enter(self, websocket_url: str):
         log.info("Connecting to remote shell at %s.", websocket_url)
 
+        # Fork the shell while the connection is being set up, unless it
+        # came warm from a ShellPool.
+        starting = asyncio.create_task(asyncio.to_thread(self.shell.start))
         try:
-            async with connect(websocket_url) as websocket:
+            async with self.connector(websocket_url) as websocket:
                 log.info("Connected to remote shell.")
+                await starting
+                loop = asyncio.get_running_loop()
+                self.last_activity = loop.time()
 
                 async def recv_input():
-                    return await websocket.recv()
+                    data = await websocket.recv()
+                    self.last_activity = loop.time()
+                    return data
+
+                bucket = None
+                if self.output_rate:
+                    bucket = TokenBucket(self.output_rate, self.output_burst or self.output_rate)
+
+                # Batches may split a multi-byte character; the decoder
+                # holds the partial bytes back until the next batch.
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
 
-                async def send_output(data: str):
-                    await websocket.send(data)
+                async def send_output(data: bytes):
+                    self.last_activity = loop.time()
+                    text = decoder.decode(data)
+                    if text:
+                        if bucket:
+                            await bucket.take(len(data))
+                        await websocket.send(text)
 
+                batcher = OutputBatcher(
+                    send_output,
+                    max_bytes=self.batch_bytes,
+                    max_delay=self.batch_delay,
+                )
                 self.shell.set_input_source(recv_input)
-                self.shell.set_output_sink(send_output)
+                self.shell.set_output_sink(batcher.write)
 
-                await self.shell.enter()
+                reaper = asyncio.create_task(self.close_when_idle(websocket)) if self.idle_timeout else None
+                try:
+                    await self.shell.enter()
+                finally:
+                    if reaper:
+                        reaper.cancel()
+                    await batcher.close()
 
         except ConnectionClosed:
             log.info("WebSocket connection closed by remote. Exiting shell.")
         except Exception as e:
             log.error(f"Error in remote shell: {e}")
         finally:
+            # Let a start still underway finish, so exit() can stop its shell.
+            await asyncio.gather(starting, return_exceptions=True)
             await self.shell.exit()
             log.info("Exited remote shell session.")
 
@@ -1,11 +1,26 @@
 import os
+import re
+import pty
+import termios
 import subprocess
 import logging as log
 import asyncio
+from functools import lru_cache
 from websockets.exceptions import ConnectionClosed
 
+try:
+    import resource
+except ImportError:  # Not available on every platform.
+    resource = None
+
 SHELL_PROMPT_PREFIX = "[easyshell] "
 
+ENGINE_PTY = "pty"
+ENGINE_PIPE = "pipe"
+READ_CHUNK_SIZE = 64 * 1024
+# The terminal's CRLF, and readline's CR CR LF at the end of a line.
+CRLF = re.compile(rb"\r+\n")
+
 class ShellProfile:
     def __init__(self, ps1="", shell_args=[]):
         self.ps1 = ps1
@@ -29,11 +44,58 @@ class ShProfile(ShellProfile):
     def __init__(self):
         super().__init__(ps1=SHELL_PROMPT_PREFIX + "$ ")
 
+class ResourceLimits:
+    """
+    Limits set on a session's shell as soon as it starts, and inherited by
+    everything it runs: CPU seconds and address space per process, and a
+    nice value so that heavy sessions yield the CPU to the daemon and to
+    other sessions. 0 leaves a limit unset.
+    """
+    def __init__(self, cpu_seconds=0, memory_bytes=0, nice=0):
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.nice = nice
+
+    def apply(self, pid: int):
+        try:
+            if self.cpu_seconds or self.memory_bytes:
+                if resource is None or not hasattr(resource, "prlimit"):
+                    raise OSError("rlimits of other processes cannot be set on this platform")
+                if self.cpu_seconds:
+                    resource.prlimit(pid, resource.RLIMIT_CPU, (self.cpu_seconds, self.cpu_seconds))
+                if self.memory_bytes:
+                    resource.prlimit(pid, resource.RLIMIT_AS, (self.memory_bytes, self.memory_bytes))
+            if self.nice:
+                os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+        except (OSError, ValueError) as e:
+            log.warning("Could not limit the resources of the shell: %s", e)
+
+@lru_cache(maxsize=None)
+def session_environment(shell: str, ps1: str) -> dict[str, str]:
+    """
+    The environment sessions run with: the daemon's own, read once, with
+    the profile's overrides on top. Shared between sessions; do not modify.
+    Clients render plain lines, so TERM=dumb keeps readline from emitting
+    bracketed-paste and other escape sequences.
+    """
+    return {**os.environ, "SHELL": shell, "PS1": ps1, "TERM": "dumb"}
+
+def normalize_line_endings(output: bytes) -> tuple[bytes, bytes]:
+    """
+    Terminal output with its line endings turned into LF, and the CRs it
+    ends with, held back to go in front of the next read in case an LF
+    follows.
+    """
+    stripped = output.rstrip(b"\r")
+    return CRLF.sub(b"\n", stripped), output[len(stripped):]
+
 class Shell:
     """Class to interface with the system shell."""
 
-    def __init__(self, forced_shell=None):
+    def __init__(self, forced_shell=None, engine=ENGINE_PTY, limits: ResourceLimits | None = None):
         self.shell = self.get_shell(forced_shell)
+        self.engine = engine
+        self.limits = limits
         self.home_directory = self.get_home_directory()
         self.username = self.get_username()
 
@@ -50,6 +112,9 @@ class Shell:
         
         self.alive = asyncio.Event()
         self._tasks = []
+        # Set by start(), possibly long before enter().
+        self.process = None
+        self.master_fd = None
 
     def get_shell(self, forced=None):
         """Get the user's preferred shell from the environment."""
@@ -68,27 +133,48 @@ class Shell:
     
     def get_environment_variables(self):
         """Get a dictionary of relevant environment variables."""
-        
-        output = subprocess.check_output(["printenv"], text=True)
-        env_vars = {}
-        for line in output.splitlines():
-            if '=' in line:
-                key, value = line.split('=', 1)
-                env_vars[key] = value
-
-        env_vars["SHELL"] = self.shell
-        env_vars["PS1"] = self.shell_profile.ps1
-
-        return env_vars
+        return session_environment(self.shell, self.shell_profile.ps1)
     
     def set_input_source(self, input_func):
         """Set the input source for the shell."""
         self.input_func = input_func
 
     def set_output_sink(self, output_func):
-        """Set the output sink for the shell."""
+        """
+        Set the output sink for the shell: an async function taking raw
+        output bytes. The shell stops reading until each call returns.
+        """
         self.output_func = output_func
 
+    def start(self):
+        """
+        Start the shell process without entering it yet, e.g. to keep it warm
+        in a ShellPool. Blocking; safe to call from a worker thread. enter()
+        starts the shell itself if this was not called.
+        """
+        if self.process is not None:
+            return
+        if self.engine == ENGINE_PTY:
+            self.process, self.master_fd = self._spawn_pty()
+        else:
+            self.process = self._spawn_pipe()
+        if self.limits:
+            self.limits.apply(self.process.pid)
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def discard(self):
+        """Stop a started shell that will not be (or was not) entered."""
+        if self.master_fd is not None:
+            os.close(self.master_fd)
+            self.master_fd = None
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
     async def enter(self):
         """
         Enter an interactive shell session.
@@ -98,10 +184,137 @@ class Shell:
         if not self.input_func or not self.output_func:
             raise ValueError("Input source and output sink must be set before entering shell.")
 
-        log.info(f"Running: {[self.shell, *self.shell_profile.shell_args]}")
-        
+        log.info(f"Running: {[self.shell, *self.shell_profile.shell_args]} ({self.engine} engine)")
+
         self.alive.set()
-        process = subprocess.Popen(
+        if self.engine == ENGINE_PTY:
+            await self._enter_pty()
+        else:
+            await self._enter_pipe()
+
+    async def _run_tasks(self, *coroutines):
+        """Run the session's I/O tasks until the first one finishes."""
+        self._tasks = [asyncio.create_task(c) for c in coroutines]
+        try:
+            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks.clear()
+            self.alive.clear()
+
+    async def _stop_process(self, process):
+        if process.poll() is None:
+            process.terminate()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, process.wait)
+            except Exception:
+                process.kill()
+
+    def _spawn_pty(self):
+        master_fd, slave_fd = pty.openpty()
+
+        # Input arrives as whole lines and clients do not expect them back.
+        attrs = termios.tcgetattr(slave_fd)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(slave_fd, termios.TCSANOW, attrs)
+
+        try:
+            process = subprocess.Popen(
+                [self.shell, *self.shell_profile.shell_args],
+                env=self.get_environment_variables(),
+                stdin=slave_fd,
+                stdout=slave_fd,
+                stderr=slave_fd,
+                start_new_session=True,
+            )
+        except Exception:
+            os.close(master_fd)
+            raise
+        finally:
+            os.close(slave_fd)
+        os.set_blocking(master_fd, False)
+        return process, master_fd
+
+    async def _enter_pty(self):
+        """
+        Run the shell on a pseudo-terminal. The master fd is read by the
+        event loop itself in chunks of up to READ_CHUNK_SIZE bytes, so output
+        without a trailing newline (prompts, progress bars) arrives at once,
+        stderr is merged into the same stream, and no executor threads are
+        involved. A shell started early has its prompt waiting in the
+        terminal by then.
+        """
+        self.start()
+        process, master_fd = self.process, self.master_fd
+
+        async def read_output():
+            carriage_returns = b""
+            while True:
+                try:
+                    output = os.read(master_fd, READ_CHUNK_SIZE)
+                except BlockingIOError:
+                    await self._wait_fd_readable(master_fd)
+                    continue
+                except OSError:  # EIO once the shell has exited
+                    break
+                if not output:
+                    break
+                output, carriage_returns = normalize_line_endings(carriage_returns + output)
+                # Not reading while the sink is busy lets the terminal
+                # buffer fill up, which pauses the shell.
+                if output:
+                    await self.output_func(output)
+            if carriage_returns:
+                await self.output_func(carriage_returns)
+
+        async def feed_input():
+            while self.alive.is_set():
+                try:
+                    input_data = await self.input_func()
+                    if input_data:
+                        await self._write_fd(master_fd, (input_data + "\n").encode())  # 'enter'
+                except ConnectionClosed:
+                    log.info("Input connection closed. Exiting shell input.")
+                    break
+                except Exception as e:
+                    log.info(f"Error while writing to shell: {e}")
+
+        try:
+            await self._run_tasks(read_output(), feed_input())
+        finally:
+            # Closing the master hangs up the terminal, which ends the shell.
+            os.close(master_fd)
+            self.master_fd = None
+            await self._stop_process(process)
+            self.process = None
+
+    async def _wait_fd_readable(self, fd):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(fd, readable.set_result, None)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fd)
+
+    async def _write_fd(self, fd, data: bytes):
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(fd, view):]
+            except BlockingIOError:
+                writable = loop.create_future()
+                loop.add_writer(fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    loop.remove_writer(fd)
+
+    def _spawn_pipe(self):
+        return subprocess.Popen(
             [self.shell, *self.shell_profile.shell_args],
             env=self.get_environment_variables(),
             stdin=subprocess.PIPE,
@@ -111,13 +324,17 @@ class Shell:
             bufsize=1
         )
 
+    async def _enter_pipe(self):
+        self.start()
+        process = self.process
+
         async def read_stdout():
             try:
                 loop = asyncio.get_running_loop()
                 while self.alive.is_set():
                     output = await loop.run_in_executor(None, process.stdout.readline)
                     if output:
-                        self.output_func(output)
+                        await self.output_func(output.encode())
                     if process.poll() is not None:  # returns int (exit status) or none
                         break
             except asyncio.CancelledError:
@@ -139,29 +356,16 @@ class Shell:
             except asyncio.CancelledError:
                 raise
 
-        self._tasks = [
-            asyncio.create_task(read_stdout()),
-            asyncio.create_task(feed_stdin())
-        ]
-
         try:
-            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+            await self._run_tasks(read_stdout(), feed_stdin())
         finally:
-            for task in self._tasks:
-                task.cancel()
-            await asyncio.gather(*self._tasks, return_exceptions=True)
-            self._tasks.clear()
-            self.alive.clear()
-            if process.poll() is None:
-                process.terminate()
-                try:
-                    await asyncio.get_running_loop().run_in_executor(None, process.wait)
-                except Exception:
-                    process.kill()
+            await self._stop_process(process)
+            self.process = None
 
     async def exit(self):
         self.alive.clear()
         for t in self._tasks:
             t.cancel()
         self._tasks.clear()
+        self.discard()
         log.info("Shell session ended.")
\ No newline at end of file
@@ -0,0 +1,56 @@
+import asyncio
+import logging as log
+from collections import deque
+from typing import Callable
+
+from daemon.shell import Shell
+
+
+class ShellPool:
+    """
+    Shells started ahead of sessions, so a shell request gets a shell that
+    has already forked, exec'd and printed its prompt. Every shell taken is
+    replaced in the background. A size of 0 starts shells on demand only.
+    """
+
+    def __init__(self, size: int, factory: Callable[[], Shell]):
+        self.size = size
+        self.factory = factory
+        self.idle: deque[Shell] = deque()
+        self._filling: asyncio.Task | None = None
+
+    def take(self) -> Shell:
+        """A warm shell if one is alive, a new (not yet started) one otherwise."""
+        shell = None
+        while self.idle and shell is None:
+            shell = self.idle.popleft()
+            if not shell.is_running():
+                log.warning("A warm shell exited while idle; discarding it.")
+                shell.discard()
+                shell = None
+        self.fill()
+        return shell or self.factory()
+
+    def fill(self):
+        """Start shells in the background until the pool is full."""
+        if self.size and (self._filling is None or self._filling.done()):
+            self._filling = asyncio.create_task(self._fill())
+
+    async def _fill(self):
+        while len(self.idle) < self.size:
+            shell = self.factory()
+            try:
+                # Forking a shell takes milliseconds; keep it off the loop.
+                await asyncio.to_thread(shell.start)
+            except Exception as e:
+                log.error("Could not start a warm shell: %s", e)
+                return
+            self.idle.append(shell)
+
+    async def close(self):
+        # Cancelling would orphan a shell mid-start; let the fill stop by itself.
+        self.size = 0
+        if self._filling is not None:
+            await asyncio.gather(self._filling, return_exceptions=True)
+        while self.idle:
+            self.idle.popleft().discard()
@@ -1,57 +1,183 @@
-import time
 import logging as log
 import asyncio
+from functools import partial
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
 
 from daemon.logging import Logger
-from daemon.heartbeat import Heartbeat
+from daemon.heartbeat import Heartbeat, BatchHeartbeat
 from daemon.config import Config
-from daemon.shell import Shell
-from daemon.remote_shell import RemoteShell
 from daemon.auth import Auth
 
+if TYPE_CHECKING:
+    from daemon.remote_shell import RemoteShell
+
 class Main:
+    """
+    Runs heartbeating and every shell session side by side on one event
+    loop. Each session gets its own Shell process and I/O tasks, up to
+    Config.MAX_SESSIONS at a time.
+
+    Most daemons never open a session, so the websocket, subprocess and
+    shell machinery is only imported and set up by the first shell request
+    (or at start, to fill a warm shell pool); until then the daemon is the
+    heartbeat loop alone.
+    """
+
     def __init__(self):
-        shell = Shell(Config.FORCED_SHELL)
         self.auth = Auth()
-        self.remote_shell = RemoteShell(shell)
+        self.sessions: set[asyncio.Task] = set()
+        self.shell_pool = None
+        self.mux = None
+        self.connector = None
+
+    def prepare_sessions(self):
+        """Set up what sessions need, once."""
+        if self.shell_pool is not None:
+            return
+        from websockets.asyncio.client import connect
+        from daemon.shell import Shell, ResourceLimits
+        from daemon.shell_pool import ShellPool
+        from daemon.mux import MuxConnector
+        from daemon.compression import connect_options
+
+        log.info("Loading the session machinery.")
+        limits = ResourceLimits(
+            cpu_seconds=Config.SESSION_CPU_SECONDS,
+            memory_bytes=Config.SESSION_MEMORY_MB * 1024 * 1024,
+            nice=Config.SESSION_NICE,
+        )
+        self.shell_pool = ShellPool(
+            Config.SHELL_POOL_SIZE,
+            lambda: Shell(Config.FORCED_SHELL, engine=Config.SHELL_ENGINE, limits=limits),
+        )
+        options = connect_options(Config.COMPRESSION, Config.COMPRESSION_MIN_BYTES)
+        if Config.SESSION_TRANSPORT == "mux":
+            self.mux = MuxConnector(**options)
+            self.connector = self.mux.connect
+        else:
+            self.connector = partial(connect, **options)
+
+    def new_remote_shell(self) -> "RemoteShell":
+        from daemon.remote_shell import RemoteShell
+
+        return RemoteShell(
+            self.shell_pool.take(),
+            batch_bytes=Config.OUTPUT_BATCH_BYTES,
+            batch_delay=Config.OUTPUT_BATCH_DELAY_MS / 1000,
+            output_rate=Config.SESSION_OUTPUT_RATE,
+            output_burst=Config.SESSION_OUTPUT_BURST,
+            idle_timeout=Config.SESSION_IDLE_TIMEOUT,
+            connector=self.connector,
+        )
 
     def handle_shell_session(self, websocket_url: str, auth_type: str, auth_value: str):
         if not self.auth.validate(auth_type, auth_value):
             log.error("Authentication failed. Cannot enter remote shell session.")
             return
 
+        self.prepare_sessions()
+        if len(self.sessions) >= Config.MAX_SESSIONS:
+            from daemon.remote_shell import RemoteShell
+
+            log.warning("Session limit of %s reached. Rejecting remote shell session.", Config.MAX_SESSIONS)
+            self.start_task(RemoteShell.reject(websocket_url, "Too many open sessions on this device."))
+            return
+
         log.info("Authentication passed. Accepting remote shell session.")
-        asyncio.run(self.remote_shell.enter(websocket_url))
+        self.start_task(self.new_remote_shell().enter(websocket_url))
 
-    def run(self):
-        heartbeat = Heartbeat(
-            instance_id=Config.INSTANCE_ID,
-            auth=self.auth,
-            endpoint=Config.HEARTBEAT_ENDPOINT,
+    def start_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.sessions.add(task)
+        task.add_done_callback(self.sessions.discard)
+
+    def handle_response(self, response: int, response_body: dict) -> bool:
+        """Act on an instruction from the server. Returns False to stop the daemon."""
+        match response:
+            case Heartbeat.RESPONSE_SHELL_REQUEST:
+                # A batched tick can carry one shell request per instance.
+                for instruction in response_body.get("instructions", [response_body]):
+                    websocket_url = instruction.get("ws_url")
+                    self.handle_shell_session(websocket_url, "", "")
+            case Heartbeat.RESPONSE_EMPTY:
+                pass
+            case Heartbeat.RESPONSE_STOP:
+                log.info("Received stop signal. Exiting.")
+                return False
+        return True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        intervals = dict(
             port=Config.HEARTBEAT_PORT,
+            interval=Config.HEARTBEAT_INTERVAL,
+            max_interval=Config.HEARTBEAT_MAX_INTERVAL,
+            fast_interval=Config.HEARTBEAT_FAST_INTERVAL,
+            timeout=Config.HEARTBEAT_TIMEOUT,
         )
+        if Config.AGGREGATE_INSTANCE_IDS:
+            log.info("Aggregating heartbeats of %s instances.", len(Config.AGGREGATE_INSTANCE_IDS))
+            heartbeat = BatchHeartbeat(
+                instance_ids=Config.AGGREGATE_INSTANCE_IDS,
+                auth=self.auth,
+                endpoint=Config.HEARTBEAT_ENDPOINT,
+                **intervals,
+            )
+        else:
+            heartbeat = Heartbeat(
+                instance_id=Config.INSTANCE_ID,
+                auth=self.auth,
+                endpoint=Config.HEARTBEAT_ENDPOINT,
+                **intervals,
+            )
+
+        control_channel = None
+        if Config.CONTROL_MODE == "push" and Config.AGGREGATE_INSTANCE_IDS:
+            log.warning("Push mode is per instance; aggregated instances keep polling.")
+        elif Config.CONTROL_MODE == "push":
+            from daemon.control_channel import ControlChannel
+
+            control_channel = ControlChannel(
+                instance_id=Config.INSTANCE_ID,
+                endpoint=Config.HEARTBEAT_ENDPOINT,
+                port=Config.HEARTBEAT_PORT,
+                interval=Config.HEARTBEAT_INTERVAL,
+            )
+        next_push_attempt = 0
 
         running = True
+        if Config.SHELL_POOL_SIZE:
+            self.prepare_sessions()
+            self.shell_pool.fill()
 
         try:
             while running:
-                response, response_body = heartbeat.tick()
+                if control_channel and loop.time() >= next_push_attempt:
+                    if await control_channel.run(self.handle_response):
+                        break
+                    log.info("Falling back to heartbeat polling.")
+                    next_push_attempt = loop.time() + Config.CONTROL_RETRY_INTERVAL
 
-                match response:
-                    case Heartbeat.RESPONSE_SHELL_REQUEST:
-                        websocket_url = response_body.get("ws_url")
-                        self.handle_shell_session(websocket_url, "", "")
-                    case Heartbeat.RESPONSE_EMPTY:
-                        pass
-                    case Heartbeat.RESPONSE_STOP:
-                        running = False
-                        log.info("Received stop signal. Exiting.")
+                # The heartbeat blocks on its http.client connection, on
+                # purpose (see Heartbeat); keep it off the loop the sessions
+                # run on. HEARTBEAT_TIMEOUT bounds the tick.
+                response, response_body = await asyncio.to_thread(heartbeat.tick)
+                running = self.handle_response(response, response_body)
 
-                time.sleep(Config.HEARTBEAT_INTERVAL)
+                await asyncio.sleep(heartbeat.next_interval())
 
-        except KeyboardInterrupt:
-            log.info("Shutting down.")
+        finally:
+            # A tick still in its thread would hold up asyncio.run's exit.
+            heartbeat.interrupt()
+            for task in self.sessions:
+                task.cancel()
+            await asyncio.gather(*self.sessions, return_exceptions=True)
+            if self.shell_pool:
+                await self.shell_pool.close()
+            if self.mux:
+                await self.mux.close()
+            heartbeat.close()
 
 def main():
     load_dotenv()
@@ -59,7 +185,10 @@ def main():
     Config.init()
 
     app = Main()
-    app.run()
+    try:
+        asyncio.run(app.run())
+    except KeyboardInterrupt:
+        log.info("Shutting down.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,45 @@
+import time
+import socket
+import threading
+
+import pytest
+
+from daemon.heartbeat import Heartbeat
+
+NOP = b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 17\r\n\r\n{"status": "nop"}'
+
+
+def serve_once_then_hang(server: socket.socket, connections: list):
+    """Answer the first request on the first connection, then read every request and never answer."""
+    connection, _ = server.accept()
+    connections.append(connection)
+    connection.recv(65536)
+    connection.sendall(NOP)
+    while connection.recv(65536):
+        pass
+
+
+def test_interrupt_ends_a_blocked_tick_without_reconnecting():
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        connections = []
+        threading.Thread(target=serve_once_then_hang, args=(server, connections), daemon=True).start()
+        heartbeat = Heartbeat("instance", None, "127.0.0.1", port=server.getsockname()[1], timeout=30)
+        assert heartbeat.tick() == (Heartbeat.RESPONSE_EMPTY, {"status": "nop"})
+
+        # The next tick reuses the connection and waits on the answer.
+        tick = threading.Thread(target=heartbeat.tick)
+        tick.start()
+        time.sleep(0.1)
+        assert tick.is_alive()
+
+        start = time.perf_counter()
+        heartbeat.interrupt()
+        tick.join(5)
+        assert time.perf_counter() - start < 1
+        assert heartbeat.failed_ticks == 1
+        assert heartbeat.connection is None
+        # No new connection was opened for a retry.
+        server.settimeout(0.1)
+        with pytest.raises(TimeoutError):
+            server.accept()
+        assert len(connections) == 1
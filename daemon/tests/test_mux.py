@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+from websockets.exceptions import ConnectionClosed
+
+from daemon.mux import (
+    Multiplexer,
+    MUX_HEADER,
+    MUX_CREDIT,
+    MUX_OPEN,
+    MUX_TEXT,
+    MUX_BINARY,
+    MUX_WINDOW,
+    MUX_CLOSE,
+    INITIAL_WINDOW,
+)
+
+
+class FakeConnection:
+    """The daemon's end of an in-memory websocket; the test plays the server."""
+
+    def __init__(self):
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.outgoing: asyncio.Queue = asyncio.Queue()
+
+    async def send(self, message):
+        await self.outgoing.put(message)
+
+    async def close(self):
+        await self.incoming.put(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+
+class Server:
+    def __init__(self, connection: FakeConnection):
+        self.connection = connection
+
+    async def send(self, kind: int, channel_id: int, payload: bytes = b""):
+        await self.connection.incoming.put(MUX_HEADER.pack(kind, channel_id) + payload)
+
+    async def recv(self) -> tuple[int, int, bytes]:
+        message = await asyncio.wait_for(self.connection.outgoing.get(), 1)
+        kind, channel_id = MUX_HEADER.unpack_from(message)
+        return kind, channel_id, message[MUX_HEADER.size:]
+
+
+async def blocked(task: asyncio.Task) -> bool:
+    await asyncio.sleep(0.05)
+    return not task.done()
+
+
+def with_two_channels(test):
+    async def run():
+        connection = FakeConnection()
+        multiplexer = Multiplexer(connection)
+        server = Server(connection)
+        first = await multiplexer.open("secret-1")
+        second = await multiplexer.open("secret-2")
+        assert await server.recv() == (MUX_OPEN, first.id, b"secret-1")
+        assert await server.recv() == (MUX_OPEN, second.id, b"secret-2")
+        try:
+            await test(server, first, second)
+        finally:
+            await multiplexer.close()
+
+    asyncio.run(run())
+
+
+def test_sender_without_credit_waits_for_window():
+    async def test(server, first, second):
+        await first.send(b"x" * INITIAL_WINDOW)
+        assert await server.recv() == (MUX_BINARY, first.id, b"x" * INITIAL_WINDOW)
+
+        waiting = asyncio.create_task(first.send("more"))
+        assert await blocked(waiting)
+
+        await second.send("other")
+        assert await server.recv() == (MUX_TEXT, second.id, b"other")
+
+        await server.send(MUX_WINDOW, first.id, MUX_CREDIT.pack(INITIAL_WINDOW))
+        await asyncio.wait_for(waiting, 1)
+        assert await server.recv() == (MUX_TEXT, first.id, b"more")
+
+    with_two_channels(test)
+
+
+def test_closing_a_channel_leaves_the_others_running():
+    async def test(server, first, second):
+        await first.send(b"x" * INITIAL_WINDOW)
+        await server.recv()
+        waiting = asyncio.create_task(first.send("more"))
+        assert await blocked(waiting)
+
+        await server.send(MUX_CLOSE, first.id)
+        with pytest.raises(ConnectionClosed):
+            await asyncio.wait_for(waiting, 1)
+
+        await server.send(MUX_TEXT, second.id, b"ls")
+        assert await asyncio.wait_for(second.recv(), 1) == "ls"
+        await second.send("output")
+        assert await server.recv() == (MUX_TEXT, second.id, b"output")
+
+        await second.close()
+        assert await server.recv() == (MUX_CLOSE, second.id, b"")
+
+    with_two_channels(test)
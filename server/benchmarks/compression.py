@@ -0,0 +1,163 @@
+"""
+Websocket compression benchmark: how much permessage-deflate shrinks
+terminal output, and what it costs in CPU.
+
+Run from the server directory:
+
+    python -m benchmarks.compression [--mbytes 8]
+
+Each corpus is cut into frames the way the daemon batches output (up to
+32 KiB; interactive frames are a few bytes of echo and prompt) and
+compressed with SelectivePerMessageDeflate as a server connection would,
+then decompressed as the client would, checking every frame comes back
+intact. Compared:
+
+- off: sent as-is.
+- deflate 12/5: the server's settings, window_bits=12 and memLevel=5,
+  leaving frames under COMPRESSION_MIN_BYTES uncompressed.
+- every frame: the same, compressing even the smallest frames.
+- deflate 15/8: zlib's defaults, a larger window and more memory.
+
+ratio is bytes in over bytes on the wire; the us/frame columns are the CPU
+time per frame to compress and to decompress.
+"""
+import time
+import random
+import base64
+import argparse
+
+from websockets.frames import Frame, Opcode
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+
+from easyshell_server.compression import SelectivePerMessageDeflate, COMPRESSION_MIN_BYTES
+from benchmarks.common import print_table
+
+BATCH_BYTES = 32 * 1024
+
+SETTINGS = [
+    ("deflate 12/5", 12, 5, COMPRESSION_MIN_BYTES),
+    ("every frame", 12, 5, 0),
+    ("deflate 15/8", 15, 8, COMPRESSION_MIN_BYTES),
+]
+
+
+def file_listing(rng: random.Random, n_bytes: int) -> str:
+    """Like ls -l of a large directory."""
+    lines, size = [], 0
+    while size < n_bytes:
+        line = (
+            f"-rw-r--r-- 1 root root {rng.randint(100, 9_999_999):>8} "
+            f"Oct {rng.randint(1, 31):>2} {rng.randint(0, 23):02}:{rng.randint(0, 59):02} "
+            f"lib{rng.choice(['ssl', 'crypto', 'z', 'curl', 'xml2', 'gtk-3'])}.so.{rng.randint(0, 9)}.{rng.randint(0, 99)}\r\n"
+        )
+        lines.append(line)
+        size += len(line)
+    return "".join(lines)
+
+
+def log_tail(rng: random.Random, n_bytes: int) -> str:
+    """Like tail -f of an application log."""
+    lines, size = [], 0
+    while size < n_bytes:
+        line = (
+            f"2026-10-18T12:{rng.randint(0, 59):02}:{rng.uniform(0, 60):06.3f}Z "
+            f"{rng.choice(['INFO', 'INFO', 'INFO', 'WARN', 'DEBUG'])} worker[{rng.randint(1000, 1100)}]: "
+            f"{rng.choice(['GET', 'POST', 'PUT'])} /api/v1/items/{rng.randint(1, 99999)} "
+            f"{rng.choice([200, 200, 200, 201, 404, 500])} in {rng.randint(1, 900)} ms\r\n"
+        )
+        lines.append(line)
+        size += len(line)
+    return "".join(lines)
+
+
+def numbers(_, n_bytes: int) -> str:
+    """Like seq."""
+    lines, size, i = [], 0, 0
+    while size < n_bytes:
+        i += 1
+        line = f"{i}\r\n"
+        lines.append(line)
+        size += len(line)
+    return "".join(lines)
+
+
+def random_text(rng: random.Random, n_bytes: int) -> str:
+    """Like cat of a base64-encoded binary: next to incompressible."""
+    return base64.b64encode(rng.randbytes(n_bytes * 3 // 4)).decode()
+
+
+def batches(text: str) -> list[str]:
+    return [text[i:i + BATCH_BYTES] for i in range(0, len(text), BATCH_BYTES)]
+
+
+def interactive(rng: random.Random, n_bytes: int) -> list[str]:
+    """Echoed keystrokes and short command output between prompts."""
+    frames, size = [], 0
+    while size < n_bytes:
+        frame = rng.choice(["l", "s", " ", "-", "\r\n", "cd src\r\n", "user@host:~/src$ ", "README.md  main.py\r\n"])
+        frames.append(frame)
+        size += len(frame)
+    return frames
+
+
+def run(frames: list[bytes], window_bits: int, mem_level: int, min_bytes: int) -> list:
+    sender = SelectivePerMessageDeflate(
+        False, False, window_bits, window_bits, {"memLevel": mem_level}, min_bytes=min_bytes
+    )
+    receiver = PerMessageDeflate(False, False, window_bits, window_bits)
+
+    encoded, started = [], time.process_time()
+    for data in frames:
+        encoded.append(sender.encode(Frame(Opcode.TEXT, data)))
+    compress_time = time.process_time() - started
+
+    started = time.process_time()
+    decoded = [receiver.decode(frame) for frame in encoded]
+    decompress_time = time.process_time() - started
+
+    assert [frame.data for frame in decoded] == frames
+    return [
+        sum(len(frame) for frame in frames) / sum(len(frame.data) for frame in encoded),
+        compress_time / len(frames) * 1e6,
+        decompress_time / len(frames) * 1e6,
+        sum(frame.rsv1 for frame in encoded) / len(frames),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mbytes", type=int, default=8)
+    args = parser.parse_args()
+    n_bytes = args.mbytes * 1024 * 1024
+    rng = random.Random(0)
+
+    corpora = [
+        ("file listing", batches(file_listing(rng, n_bytes))),
+        ("log tail", batches(log_tail(rng, n_bytes))),
+        ("seq", batches(numbers(rng, n_bytes))),
+        ("random", batches(random_text(rng, n_bytes))),
+        ("interactive", interactive(rng, n_bytes // 64)),
+    ]
+    rows = []
+    for corpus, texts in corpora:
+        frames = [text.encode() for text in texts]
+        rows.append([corpus, "off", len(frames), "1.00", "0.0", "0.0", "0%"])
+        for name, window_bits, mem_level, min_bytes in SETTINGS:
+            ratio, compress_us, decompress_us, compressed = run(frames, window_bits, mem_level, min_bytes)
+            rows.append([
+                corpus,
+                name,
+                len(frames),
+                f"{ratio:.2f}",
+                f"{compress_us:.1f}",
+                f"{decompress_us:.1f}",
+                f"{compressed:.0%}",
+            ])
+    print_table(
+        ["corpus", "compression", "frames", "ratio", "compress us/frame", "decompress us/frame", "compressed"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
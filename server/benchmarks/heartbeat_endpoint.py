@@ -0,0 +1,67 @@
+"""
+/heartbeat request handling benchmark, without the network.
+
+Run from the server directory:
+
+    python -m benchmarks.heartbeat_endpoint [--requests 200000] [--devices 10000]
+
+Decodes, validates and answers `requests` heartbeat bodies from `devices`
+distinct devices, the way the handler does: first the generic path
+(request.json, HeartbeatSchema.model_validate, sanic.response.json), then
+the fast path (fast_json, parse_heartbeat, the prebuilt NOP body). For the
+whole server under load, see benchmarks.load_test.
+"""
+import json
+import time
+import uuid
+import argparse
+
+from sanic.response import json as json_response, HTTPResponse
+
+from easyshell_server import fast_json
+from easyshell_server.validation.heartbeat import HeartbeatSchema, parse_heartbeat
+from benchmarks.common import print_table
+
+NOP_RESPONSE_BODY = fast_json.dumps({"status": "nop"})
+
+
+def generic(body: bytes):
+    heartbeat = HeartbeatSchema.model_validate(json.loads(body))
+    return heartbeat.id, json_response({"status": "nop"})
+
+
+def fast(body: bytes):
+    device_id, _ = parse_heartbeat(fast_json.loads(body))
+    return device_id, HTTPResponse(NOP_RESPONSE_BODY, content_type="application/json")
+
+
+def run(handle, bodies: list[bytes], n_requests: int) -> float:
+    started = time.perf_counter()
+    for i in range(n_requests):
+        handle(bodies[i % len(bodies)])
+    return n_requests / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--devices", type=int, default=10_000)
+    args = parser.parse_args()
+
+    bodies = [
+        json.dumps({"id": str(uuid.uuid4()), "auth_type": "otp"}).encode() for _ in range(args.devices)
+    ]
+    before = run(generic, bodies, args.requests)
+    after = run(fast, bodies, args.requests)
+    print_table(
+        ["path", "req/s", "us/req"],
+        [
+            ["generic", f"{before:,.0f}", f"{1e6 / before:.2f}"],
+            ["fast", f"{after:,.0f}", f"{1e6 / after:.2f}"],
+        ],
+    )
+    print(f"\nfast path: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Heartbeat ingestion benchmark.
+
+Run from the server directory:
+
+    python -m benchmarks.heartbeat_manager [--rounds 5]
+
+For each fleet size, every device heartbeats `rounds` times in shuffled order
+while a reader lists devices every 10000 heartbeats, as the /devices poll does.
+"""
+import time
+import uuid
+import random
+import asyncio
+import argparse
+
+from easyshell_server.auth import AuthType
+from easyshell_server.heartbeat_manager import HeartbeatManager
+from benchmarks.common import percentile, print_table
+
+FLEET_SIZES = [1_000, 10_000, 100_000]
+
+
+async def run(n_devices: int, rounds: int):
+    manager = HeartbeatManager()
+    device_ids = [uuid.uuid4() for _ in range(n_devices)]
+    latencies = []
+
+    for _ in range(rounds):
+        random.shuffle(device_ids)
+        for i, device_id in enumerate(device_ids):
+            start = time.perf_counter()
+            await manager.heartbeat(device_id, AuthType.OTP)
+            latencies.append(time.perf_counter() - start)
+            if i % 10_000 == 0:
+                await manager.list_devices()
+
+    total = sum(latencies)
+    return [
+        n_devices,
+        len(latencies),
+        f"{len(latencies) / total:,.0f}",
+        f"{percentile(latencies, 50) * 1e6:.2f}",
+        f"{percentile(latencies, 99) * 1e6:.2f}",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = [asyncio.run(run(n, args.rounds)) for n in FLEET_SIZES]
+    print_table(["devices", "heartbeats", "hb/s", "p50 us", "p99 us"], rows)
+
+
+if __name__ == "__main__":
+    main()
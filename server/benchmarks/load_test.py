@@ -0,0 +1,325 @@
+"""
+End-to-end load test of the whole control plane.
+
+Run from the server directory:
+
+    python -m benchmarks.load_test [--daemons 200] [--sessions 20] [--output results.json]
+    python -m benchmarks.load_test --compare results.json   # against an earlier run
+
+Starts main.py on a free port and drives it with simulated daemons and
+clients, all speaking the real protocol:
+
+- heartbeats: every daemon posts /heartbeat back to back over a keep-alive
+  connection for --duration seconds, as daemon.heartbeat.Heartbeat does
+  with its pooled session, only without the sleep between ticks.
+- sessions: --sessions clients request a session from daemons holding a
+  push-mode control channel. Setup latency runs from POST /session until
+  the daemon's websocket is connected.
+- interactive: every client sends --keystrokes single characters, each
+  echoed by its daemon, and times the round trip.
+- bulk: every daemon streams --bulk-mbytes of output to its client.
+
+The load generator shares the host with the server, so compare runs made on
+the same machine. Results are saved as JSON; --compare prints the change of
+each figure against a previous file.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+from urllib.parse import urlparse
+
+from websockets.asyncio.client import connect
+
+from benchmarks.common import percentile, print_table
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BULK_CHUNK = 4096
+BULK_DONE = "\x04"
+
+
+class HttpConnection:
+    """Minimal keep-alive HTTP/1.1 client, enough for the server's JSON routes."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, body: dict | None = None) -> tuple[int, dict]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode()
+            + payload
+        )
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode().partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        return status, json.loads(await self.reader.readexactly(length)) if length else {}
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class SimulatedDaemon:
+    """
+    A daemon in push mode whose "shell" echoes every input frame and, for
+    an input of "bulk <n>", writes n bytes of output followed by BULK_DONE.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.device_id = str(uuid.uuid4())
+        # Session secret -> time its daemon websocket connected.
+        self.connected_at: dict[str, float] = {}
+        self.connected = {}
+        self._tasks = set()
+
+    async def heartbeat_loop(self, deadline: float, latencies: list[float]):
+        http = HttpConnection(self.host, self.port)
+        body = {"id": self.device_id, "auth_type": "otp"}
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                status, _ = await http.request("POST", "/heartbeat", body)
+                latencies.append(time.perf_counter() - started)
+                if status != 200:
+                    raise RuntimeError(f"/heartbeat returned {status}")
+        finally:
+            http.close()
+
+    async def control_channel(self, ready: asyncio.Event):
+        async with connect(f"ws://{self.host}:{self.port}/ws/control") as ws:
+            await ws.send(json.dumps({"id": self.device_id, "auth_type": "otp"}))
+            ready.set()
+            async for message in ws:
+                body = json.loads(message)
+                if body.get("status") == "shell_request":
+                    task = asyncio.create_task(self.shell(body["ws_url"]))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+
+    async def shell(self, ws_url: str):
+        secret = urlparse(ws_url).path.rsplit("/", 1)[-1]
+        async with connect(ws_url, max_size=None) as ws:
+            self.connected_at[secret] = time.perf_counter()
+            self.connected.setdefault(secret, asyncio.Event()).set()
+            async for message in ws:
+                if message.startswith("bulk "):
+                    remaining = int(message.split()[1])
+                    chunk = "x" * BULK_CHUNK
+                    while remaining > 0:
+                        await ws.send(chunk[:remaining])
+                        remaining -= BULK_CHUNK
+                    await ws.send(BULK_DONE)
+                else:
+                    await ws.send(message)
+
+    async def wait_connected(self, secret: str):
+        await self.connected.setdefault(secret, asyncio.Event()).wait()
+
+
+async def run_heartbeats(host: str, port: int, daemons: int, duration: float) -> dict:
+    latencies: list[float] = []
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        SimulatedDaemon(host, port).heartbeat_loop(deadline, latencies) for _ in range(daemons)
+    ))
+    elapsed = time.perf_counter() - started
+    return {
+        "heartbeats": len(latencies),
+        "heartbeats_per_second": len(latencies) / elapsed,
+        "latency_p50_ms": percentile(latencies, 50) * 1e3,
+        "latency_p99_ms": percentile(latencies, 99) * 1e3,
+    }
+
+
+async def run_session(host: str, port: int, daemon: SimulatedDaemon, keystrokes: int, bulk_bytes: int, results: dict):
+    http = HttpConnection(host, port)
+    try:
+        started = time.perf_counter()
+        status, body = await http.request("POST", "/session", {
+            "client_id": str(uuid.uuid4()),
+            "remote_id": daemon.device_id,
+            "auth_type": "otp",
+            "auth_value": "000000",
+        })
+        if status != 200:
+            raise RuntimeError(f"/session returned {status}: {body}")
+    finally:
+        http.close()
+
+    secret = body["session_secret"]
+    async with connect(body["websocket_url"], max_size=None) as ws:
+        await daemon.wait_connected(secret)
+        results["setup"].append(daemon.connected_at[secret] - started)
+
+        for i in range(keystrokes):
+            key = chr(ord("a") + i % 26)
+            sent = time.perf_counter()
+            await ws.send(key)
+            if await ws.recv() != key:
+                raise RuntimeError("Keystroke echo mismatch.")
+            results["rtt"].append(time.perf_counter() - sent)
+
+        sent = time.perf_counter()
+        await ws.send(f"bulk {bulk_bytes}")
+        received = 0
+        # The relay may join the marker onto the last chunk of output.
+        while not (message := await ws.recv()).endswith(BULK_DONE):
+            received += len(message)
+        received += len(message) - len(BULK_DONE)
+        results["bulk"].append((received, time.perf_counter() - sent))
+
+
+async def wait_listed(host: str, port: int, device_ids: set[str]):
+    """Wait until /devices lists every device, i.e. their control channels are registered."""
+    http = HttpConnection(host, port)
+    try:
+        while True:
+            _, body = await http.request("GET", "/devices")
+            if device_ids <= {device["id"] for device in body["devices"]}:
+                return
+            await asyncio.sleep(0.05)
+    finally:
+        http.close()
+
+
+async def run_sessions(host: str, port: int, sessions: int, keystrokes: int, bulk_bytes: int) -> dict:
+    daemons = [SimulatedDaemon(host, port) for _ in range(sessions)]
+    ready = [asyncio.Event() for _ in daemons]
+    channels = [asyncio.create_task(d.control_channel(r)) for d, r in zip(daemons, ready)]
+    try:
+        await asyncio.gather(*(r.wait() for r in ready))
+        await wait_listed(host, port, {daemon.device_id for daemon in daemons})
+        results = {"setup": [], "rtt": [], "bulk": []}
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_session(host, port, daemon, keystrokes, bulk_bytes, results) for daemon in daemons
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        for channel in channels:
+            channel.cancel()
+
+    bulk_bytes_total = sum(received for received, _ in results["bulk"])
+    bulk_time = max(took for _, took in results["bulk"])
+    return {
+        "sessions": sessions,
+        "wall_seconds": elapsed,
+        "setup_p50_ms": percentile(results["setup"], 50) * 1e3,
+        "setup_p99_ms": percentile(results["setup"], 99) * 1e3,
+        "keystroke_rtt_p50_ms": percentile(results["rtt"], 50) * 1e3,
+        "keystroke_rtt_p99_ms": percentile(results["rtt"], 99) * 1e3,
+        "bulk_mbytes_per_second": bulk_bytes_total / bulk_time / 1024 / 1024,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_server(port: int, env: dict) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd=SERVER_DIR,
+        env={**os.environ, **env, "PORT": str(port)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    http = HttpConnection("127.0.0.1", port)
+    for _ in range(200):
+        try:
+            await http.request("GET", "/devices")
+            http.close()
+            return server
+        except OSError:
+            http = HttpConnection("127.0.0.1", port)
+            await asyncio.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Server did not start.")
+
+
+async def run(args) -> dict:
+    port = free_port()
+    env = {"WORKERS": str(args.workers), "STATE_BACKEND": args.state_backend}
+    server = await start_server(port, env)
+    try:
+        heartbeats = await run_heartbeats("127.0.0.1", port, args.daemons, args.duration)
+        sessions = await run_sessions(
+            "127.0.0.1", port, args.sessions, args.keystrokes, args.bulk_mbytes * 1024 * 1024
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        "config": {**vars(args), "python": platform.python_version(), "machine": platform.machine()},
+        "timestamp": int(time.time()),
+        "heartbeats": heartbeats,
+        "sessions": sessions,
+    }
+
+
+def print_results(results: dict, previous: dict | None):
+    for section in ("heartbeats", "sessions"):
+        rows = []
+        for name, value in results[section].items():
+            row = [name, f"{value:,.2f}"]
+            if previous is not None:
+                before = previous.get(section, {}).get(name)
+                row += [f"{before:,.2f}", f"{(value - before) / before * 100:+.1f}%"] if before else ["-", "-"]
+            rows.append(row)
+        headers = [section, "value"] + (["previous", "change"] if previous is not None else [])
+        print_table(headers, rows)
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--daemons", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--keystrokes", type=int, default=100)
+    parser.add_argument("--bulk-mbytes", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--state-backend", default="memory")
+    parser.add_argument("--output", help="Save the results to this JSON file.")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with.")
+    args = parser.parse_args()
+    if args.workers > 1 and args.state_backend == "memory":
+        parser.error("--workers > 1 needs a shared --state-backend, e.g. sqlite:///tmp/easyshell-load.db")
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    results = asyncio.run(run(args))
+    print_results(results, previous)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import asyncio
+
+
+class LocalWebsocket:
+    """
+    In-process stand-in for the server side of a websocket, with the same
+    recv/send/close behaviour as Sanic's. Frames sent to it by the remote end
+    go through feed(); frames the server sends are handed to on_send.
+    """
+
+    def __init__(self, on_send=None):
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.on_send = on_send
+        self.closed = asyncio.Event()
+
+    def feed(self, data):
+        self.incoming.put_nowait(data)
+
+    async def recv(self, timeout: float | None = None):
+        if timeout is None:
+            return await self.incoming.get()
+        if timeout <= 0:
+            try:
+                return self.incoming.get_nowait()
+            except asyncio.QueueEmpty:
+                return None
+        try:
+            return await asyncio.wait_for(self.incoming.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def send(self, data):
+        if self.on_send:
+            await self.on_send(data)
+
+    async def close(self):
+        self.closed.set()
@@ -0,0 +1,101 @@
+"""
+Session recording benchmark.
+
+Run from the server directory:
+
+    python -m benchmarks.recording [--megabytes 256] [--frame-bytes 4096] [--max-pending-chunks N]
+
+Records `megabytes` of shell output in frames of `frame_bytes`, timing
+record() as the relay calls it, then seeks into the recording at several
+points and times reading the first chunk from there. Peak memory during
+replay stays around one chunk regardless of the recording size.
+
+Output arrives here far faster than over any websocket, so by default
+nothing is dropped; pass the server's RECORDING_MAX_PENDING_CHUNKS to see
+what its cap leaves out at that rate.
+"""
+import os
+import time
+import random
+import string
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from easyshell_server.relay import DAEMON
+from easyshell_server.recording import Recorder, RecordingReader
+from benchmarks.common import percentile, print_table
+
+
+def output_frame(size: int) -> str:
+    # Shell output compresses well but not trivially; mimic a log scroll.
+    line = "".join(random.choices(string.ascii_letters + string.digits + " ", k=100)) + "\r\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+async def record(recorder: Recorder, megabytes: int, frame_bytes: int):
+    recording = recorder.open("benchmark")
+    frames = [output_frame(frame_bytes) for _ in range(64)]
+    latencies = []
+    for i in range(megabytes * 1024 * 1024 // frame_bytes):
+        start = time.perf_counter()
+        recording.record(DAEMON, frames[i % len(frames)])
+        latencies.append(time.perf_counter() - start)
+        if i % 256 == 0:
+            # Let the loop breathe as it would between websocket frames.
+            await asyncio.sleep(0)
+    started = time.perf_counter()
+    await recording.close()
+    return latencies, time.perf_counter() - started, recording.dropped_events
+
+
+def replay(path: str) -> list[list]:
+    rows = []
+    with RecordingReader(path) as reader:
+        chunks = reader.chunks()
+        last = None
+        for events in chunks:
+            last = events[-1].time
+        for fraction in (0.0, 0.5, 0.99):
+            at = last * fraction
+            tracemalloc.start()
+            start = time.perf_counter()
+            next(reader.chunks(at))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            rows.append([f"{at:.3f}s", f"{elapsed * 1e3:.2f}", f"{peak / 1024:,.0f}"])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=256)
+    parser.add_argument("--frame-bytes", type=int, default=4096)
+    parser.add_argument("--max-pending-chunks", type=int, default=1 << 20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        recorder = Recorder(directory, max_pending_chunks=args.max_pending_chunks)
+        latencies, close_time, dropped = asyncio.run(record(recorder, args.megabytes, args.frame_bytes))
+        size = os.path.getsize(recorder.path("benchmark"))
+
+        print_table(
+            ["frames", "dropped", "p50 us", "p99 us", "close ms", "file MiB", "ratio"],
+            [[
+                len(latencies),
+                dropped,
+                f"{percentile(latencies, 50) * 1e6:.2f}",
+                f"{percentile(latencies, 99) * 1e6:.2f}",
+                f"{close_time * 1e3:.1f}",
+                f"{size / 1024 / 1024:.1f}",
+                f"{args.megabytes * 1024 * 1024 / size:.1f}x",
+            ]],
+        )
+        print()
+        print_table(["seek to", "first chunk ms", "peak KiB"], replay(recorder.path("benchmark")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Relay throughput benchmark for one session.
+
+Run from the server directory:
+
+    python -m benchmarks.relay [--mbytes 64]
+
+A daemon stand-in pushes `mbytes` of output in frames of each size through a
+SessionRelay to a client stand-in, with coalescing off and on. The peak column shows how much the relay buffered,
+which the watermarks bound.
+"""
+import time
+import asyncio
+import argparse
+
+from easyshell_server.relay import SessionRelay, CLIENT, DAEMON
+from benchmarks.common import print_table
+from benchmarks.local_websocket import LocalWebsocket
+
+FRAME_SIZES = [64, 1024, 16 * 1024]
+
+
+async def run(frame_size: int, total_bytes: int, coalesce_max_bytes: int, coalesce_delay: float):
+    n_frames = total_bytes // frame_size
+    frame = b"x" * frame_size
+    received = {"bytes": 0, "frames": 0, "peak_in_flight": 0}
+    done = asyncio.Event()
+
+    async def client_recv(data):
+        received["bytes"] += len(data)
+        received["frames"] += 1
+        received["peak_in_flight"] = max(received["peak_in_flight"], relay.bytes_in_flight)
+        if received["bytes"] >= n_frames * frame_size:
+            done.set()
+
+    relay = SessionRelay("bench", coalesce_delay=coalesce_delay, coalesce_max_bytes=coalesce_max_bytes)
+    daemon = LocalWebsocket()
+    relay.attach(CLIENT, LocalWebsocket(on_send=client_recv))
+    relay.attach(DAEMON, daemon)
+
+    start = time.perf_counter()
+    task = asyncio.create_task(relay.forward(DAEMON))
+    for i in range(n_frames):
+        daemon.feed(frame)
+        if i % 64 == 0:
+            await asyncio.sleep(0)
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    task.cancel()
+
+    return [
+        frame_size,
+        "on" if coalesce_max_bytes else "off",
+        f"{total_bytes / elapsed / 1e6:,.1f}",
+        f"{n_frames / elapsed:,.0f}",
+        received["frames"],
+        f"{received['peak_in_flight'] / 1024:,.0f}",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mbytes", type=int, default=64)
+    parser.add_argument("--coalesce-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    total = args.mbytes * 1024 * 1024
+    rows = []
+    for frame_size in FRAME_SIZES:
+        for coalesce_max_bytes in (0, 64 * 1024):
+            rows.append(asyncio.run(
+                run(frame_size, total, coalesce_max_bytes, args.coalesce_ms / 1000)
+            ))
+    print_table(["frame B", "coalesce", "MB/s", "frames in/s", "frames out", "peak KiB in flight"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Warm restart benchmark: what StateSnapshotter costs while serving, and how
+long a restart takes to get the state back.
+
+Run from the server directory:
+
+    python -m benchmarks.snapshot [--devices 100000] [--sessions 10000]
+
+Fills a HeartbeatManager and SessionManager with `devices` devices and
+`sessions` pending sessions, then times:
+
+- capture: copying both checkpoints, the only part that runs on the event
+  loop and so holds up requests.
+- write: serializing and writing the snapshot, done in a thread.
+- journal: appending the records of `sessions` new devices and sessions.
+- load: reading the snapshot and journal back into fresh managers, the
+  time from start-up to serving with the previous run's state.
+"""
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+
+from easyshell_server.auth import AuthType
+from easyshell_server.heartbeat_manager import HeartbeatManager
+from easyshell_server.session_manager import SessionManager
+from easyshell_server.snapshot import StateSnapshotter
+from benchmarks.common import print_table
+
+
+async def fill(heartbeat_manager: HeartbeatManager, session_manager: SessionManager, devices: int, sessions: int):
+    device_ids = [uuid.uuid4() for _ in range(devices)]
+    await heartbeat_manager.heartbeat_many([(device_id, AuthType.OTP) for device_id in device_ids])
+    for device_id in device_ids[:sessions]:
+        await session_manager.session_request(
+            client_id=uuid.uuid4(), remote_id=device_id, auth_type=AuthType.OTP, auth_value="123456"
+        )
+
+
+async def bench(devices: int, sessions: int) -> list[list]:
+    heartbeat_manager, session_manager = HeartbeatManager(), SessionManager()
+    await fill(heartbeat_manager, session_manager, devices, sessions)
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/state"
+        snapshotter = StateSnapshotter(path, heartbeat_manager, session_manager)
+
+        started = time.perf_counter()
+        heartbeat_manager.checkpoint()
+        session_manager.checkpoint()
+        capture = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await snapshotter.snapshot()
+        write = time.perf_counter() - started - capture
+
+        await fill(heartbeat_manager, session_manager, sessions, sessions)
+        started = time.perf_counter()
+        await snapshotter.flush_journal()
+        journal = time.perf_counter() - started
+
+        restored_heartbeats, restored_sessions = HeartbeatManager(), SessionManager()
+        started = time.perf_counter()
+        await StateSnapshotter(path, restored_heartbeats, restored_sessions).load()
+        load = time.perf_counter() - started
+        assert len(restored_heartbeats.heartbeats) == devices + sessions
+        assert len(restored_sessions.sessions) == 2 * sessions
+
+    return [
+        ["capture (on the loop)", f"{capture * 1000:.1f}"],
+        ["write (in a thread)", f"{write * 1000:.1f}"],
+        [f"journal {2 * sessions} records", f"{journal * 1000:.1f}"],
+        ["load", f"{load * 1000:.1f}"],
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=100_000)
+    parser.add_argument("--sessions", type=int, default=10_000)
+    args = parser.parse_args()
+    print(f"{args.devices} devices, {args.sessions} pending sessions")
+    print_table(["step", "ms"], asyncio.run(bench(args.devices, args.sessions)))
+
+
+if __name__ == "__main__":
+    main()
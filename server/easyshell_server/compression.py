@@ -0,0 +1,70 @@
+from sanic.server.protocols import websocket_protocol
+from websockets.frames import Frame, Opcode
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+
+# Whole messages shorter than this are sent uncompressed: keystrokes and
+# their echo would barely shrink, and would wait on the compressor.
+COMPRESSION_MIN_BYTES = 256
+
+
+class SelectivePerMessageDeflate(PerMessageDeflate):
+    """
+    permessage-deflate that leaves messages under min_bytes uncompressed.
+    RFC 7692 lets any message go without RSV1 and such messages do not touch
+    either end's compression context, so the dictionary built from earlier
+    output still serves the next large one.
+    """
+
+    def __init__(self, *args, min_bytes: int = COMPRESSION_MIN_BYTES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_bytes = min_bytes
+
+    def encode(self, frame: Frame) -> Frame:
+        if frame.fin and frame.opcode in (Opcode.TEXT, Opcode.BINARY) and len(frame.data) < self.min_bytes:
+            return frame
+        return super().encode(frame)
+
+
+class SelectiveDeflateFactory(ServerPerMessageDeflateFactory):
+    """Accepts a client's permessage-deflate offer with a SelectivePerMessageDeflate."""
+
+    def __init__(self, min_bytes: int = COMPRESSION_MIN_BYTES, **kwargs):
+        super().__init__(**kwargs)
+        self.min_bytes = min_bytes
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, SelectivePerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_bytes=self.min_bytes,
+        )
+
+
+def enable_websocket_compression(min_bytes: int = COMPRESSION_MIN_BYTES, window_bits: int = 12, mem_level: int = 5):
+    """
+    Have every websocket route negotiate permessage-deflate with clients
+    that offer it; browsers and the daemon's websockets client do. Each
+    connection keeps its context, about (1 << window_bits + 2) + (1 <<
+    mem_level + 9) bytes for the compressor, across messages.
+
+    Sanic builds its websockets ServerProtocol without extensions and has
+    no setting for them, so this swaps in a subclass that adds one. Call it
+    before the server starts.
+    """
+    factory = SelectiveDeflateFactory(
+        min_bytes=min_bytes,
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings={"memLevel": mem_level},
+    )
+    base = websocket_protocol.ServerProtocol
+
+    class CompressingServerProtocol(base):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, extensions=[factory], **kwargs)
+
+    websocket_protocol.ServerProtocol = CompressingServerProtocol
@@ -0,0 +1,44 @@
+import json
+import uuid
+from dataclasses import dataclass
+
+from sanic.log import logger
+
+
+@dataclass(slots=True)
+class ControlChannel:
+    device_id: uuid.UUID
+    ws: object
+    host: str
+
+
+class ControlChannelManager:
+    """
+    Open control websockets of daemons running in push mode, by device id.
+    Instructions sent through them reach the daemon at once instead of on
+    its next /heartbeat poll.
+    """
+
+    def __init__(self):
+        self.channels: dict[uuid.UUID, ControlChannel] = {}
+
+    def register(self, device_id: uuid.UUID, ws, host: str) -> ControlChannel:
+        channel = ControlChannel(device_id=device_id, ws=ws, host=host)
+        self.channels[device_id] = channel
+        return channel
+
+    def unregister(self, channel: ControlChannel):
+        # A reconnecting daemon may already have replaced this channel.
+        if self.channels.get(channel.device_id) is channel:
+            del self.channels[channel.device_id]
+
+    def get(self, device_id: uuid.UUID) -> ControlChannel | None:
+        return self.channels.get(device_id)
+
+    async def push(self, channel: ControlChannel, message: dict) -> bool:
+        try:
+            await channel.ws.send(json.dumps(message))
+            return True
+        except Exception as e:
+            logger.error(f"Error pushing to control channel of {channel.device_id}: {e}")
+            return False
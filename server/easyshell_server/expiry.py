@@ -0,0 +1,45 @@
+from collections import OrderedDict
+from typing import Generic, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+
+class ExpiryQueue(Generic[K]):
+    """
+    Keys ordered by the time they were last touched.
+
+    Every entry of a queue shares the same timeout, so last-touch order is
+    also deadline order: touching a key moves it to the back, and expiring
+    only pops from the front until the first entry that is still alive.
+    Both cost O(1) per key, never a scan of the whole population.
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict[K, int] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def touch(self, key: K, timestamp: int):
+        self._entries[key] = timestamp
+        self._entries.move_to_end(key)
+
+    def discard(self, key: K):
+        self._entries.pop(key, None)
+
+    def next_deadline(self, timeout: int) -> int | None:
+        """First time at which expire() will return something, or None if empty."""
+        for timestamp in self._entries.values():
+            return timestamp + timeout + 1
+        return None
+
+    def expire(self, now: int, timeout: int) -> list[K]:
+        """Pop and return every key last touched more than timeout seconds ago."""
+        expired = []
+        while self._entries:
+            key, timestamp = next(iter(self._entries.items()))
+            if now - timestamp <= timeout:
+                break
+            del self._entries[key]
+            expired.append(key)
+        return expired
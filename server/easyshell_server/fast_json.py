@@ -0,0 +1,29 @@
+"""
+JSON for the hot paths: orjson when it is installed, the standard library
+otherwise. dumps() returns bytes either way, ready to be sent.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson's own error is a subclass of it.
+DecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    dumps = orjson.dumps
+
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than the standard library, e.g. about NaN
+            # and numbers out of float range; accept what it accepts.
+            return json.loads(data)
+else:
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
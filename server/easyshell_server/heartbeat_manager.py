@@ -1,57 +1,234 @@
 import time
 import uuid
 import asyncio
+from bisect import bisect_right
+from itertools import islice
+from operator import attrgetter
+from collections import deque
 from dataclasses import dataclass, field
 
 from easyshell_server.auth import AuthType
+from easyshell_server.expiry import ExpiryQueue
+from easyshell_server.metrics import LOCK_WAIT, TimedLock
 
 
-@dataclass
+EVENT_JOIN = "join"
+EVENT_LEAVE = "leave"
+
+# Joins and leaves kept for changes_since; a client further behind re-lists.
+CHANGE_LOG_SIZE = 10_000
+
+
+@dataclass(slots=True)
 class Heartbeat:
     client_id: uuid.UUID
     auth_type: AuthType
     timestamp: int = field(default_factory=lambda: int(time.time()))
+    # Version of the device's join, which orders list_devices pages.
+    seq: int = 0
+
+
+def device_dict(device_id, auth_type: str, timestamp: int) -> dict:
+    return {"id": str(device_id), "auth_type": auth_type, "timestamp": timestamp}
+
+
+def change_dict(version: int, event: str, device_id, auth_type: str, timestamp: int) -> dict:
+    return {"version": version, "event": event, **device_dict(device_id, auth_type, timestamp)}
 
 
 class HeartbeatManager:
+    """
+    Keeps the last heartbeat of every device.
+
+    All methods run on the event loop and never await between reading and
+    writing self.heartbeats, so single-device upserts, listings and
+    checkpoints are atomic without a lock. heartbeat_lock only serializes
+    multi-step maintenance such as cleanup_heartbeats.
+
+    Devices are also kept in an ExpiryQueue, so cleanup only touches the
+    devices that actually timed out.
+
+    Every join and leave bumps self.version and goes into a bounded change
+    log, so dashboards can follow the fleet by deltas instead of re-listing.
+    Devices sit in self.heartbeats in join order, which is what pages of
+    list_devices follow. They are also kept by seq, in self.by_seq, with
+    every seq in order in self.join_order, so that a page seeks straight to
+    its cursor. Seqs of devices that left stay in join_order until half of
+    it is made of them.
+    """
+
     def __init__(self):
         self.heartbeats: dict[uuid.UUID, Heartbeat] = {}
-        self.heartbeat_lock: asyncio.Lock = asyncio.Lock()
+        self.by_seq: dict[int, Heartbeat] = {}
+        self.join_order: list[int] = []
+        self.heartbeat_lock: asyncio.Lock = TimedLock(LOCK_WAIT.labels("heartbeat_lock"))
+        self.expiry: ExpiryQueue[uuid.UUID] = ExpiryQueue()
+        self.version = 0
+        self.changes: deque[tuple] = deque(maxlen=CHANGE_LOG_SIZE)
+        self._changed = asyncio.Event()
 
-    async def heartbeat(self, client_id: str, auth_type: AuthType):
-        hb = Heartbeat(client_id=client_id, auth_type=auth_type)
-        async with self.heartbeat_lock:
+    def _record_change(self, event: str, hb: Heartbeat, timestamp: int) -> int:
+        self.version += 1
+        self.changes.append((self.version, event, hb.client_id, hb.auth_type.value, timestamp))
+        return self.version
+
+    def _joined(self, hb: Heartbeat):
+        self.by_seq[hb.seq] = hb
+        self.join_order.append(hb.seq)
+
+    def _left(self, hb: Heartbeat):
+        del self.by_seq[hb.seq]
+        if len(self.join_order) > 2 * len(self.by_seq):
+            self.join_order = sorted(self.by_seq)
+
+    def _notify(self):
+        # Waiters hold on to the event they started waiting on.
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def heartbeat(self, client_id: uuid.UUID, auth_type: AuthType):
+        hb = self.heartbeats.get(client_id)
+        if hb is None:
+            hb = Heartbeat(client_id=client_id, auth_type=auth_type)
+            hb.seq = self._record_change(EVENT_JOIN, hb, hb.timestamp)
             self.heartbeats[client_id] = hb
+            self._joined(hb)
+            self._notify()
+        else:
+            hb.auth_type = auth_type
+            hb.timestamp = int(time.time())
+        self.expiry.touch(client_id, hb.timestamp)
+
+    async def heartbeat_many(self, heartbeats: list[tuple[uuid.UUID, AuthType]]):
+        """
+        Record a batch of heartbeats, as sent by a gateway for the devices
+        behind it, in one pass with a single timestamp. Like heartbeat, this
+        never awaits, so the whole batch lands atomically.
+        """
+        timestamp = int(time.time())
+        known = self.heartbeats
+        touch = self.expiry.touch
+        version = self.version
+        for client_id, auth_type in heartbeats:
+            hb = known.get(client_id)
+            if hb is None:
+                hb = Heartbeat(client_id=client_id, auth_type=auth_type, timestamp=timestamp)
+                hb.seq = self._record_change(EVENT_JOIN, hb, timestamp)
+                known[client_id] = hb
+                self._joined(hb)
+            else:
+                hb.auth_type = auth_type
+                hb.timestamp = timestamp
+            touch(client_id, timestamp)
+        if self.version != version:
+            self._notify()
 
     async def cleanup_heartbeats(self, timeout: int = 60):
         """Remove heartbeats older than the timeout."""
         current_time = int(time.time())
         async with self.heartbeat_lock:
-            to_delete = [
-                device_id
-                for device_id, obj in self.heartbeats.items()
-                if current_time - obj.timestamp > timeout
-            ]
+            to_delete = self.expiry.expire(current_time, timeout)
             for device_id in to_delete:
-                del self.heartbeats[device_id]
+                hb = self.heartbeats.pop(device_id)
+                self._left(hb)
+                self._record_change(EVENT_LEAVE, hb, current_time)
+            if to_delete:
+                self._notify()
 
         return len(to_delete)
 
-    async def get_heartbeats(self):
-        async with self.heartbeat_lock:
-            devices = []
-            for device_id, obj in self.heartbeats.items():
-                devices.append(
-                    {
-                        "id": str(device_id),
-                        "auth_type": obj.auth_type.value,
-                        "timestamp": obj.timestamp,
-                    }
-                )
-            return devices
+    async def next_expiry(self, timeout: int = 60) -> int | None:
+        """Earliest time at which cleanup_heartbeats will remove a device."""
+        return self.expiry.next_deadline(timeout)
+
+    async def count(self) -> int:
+        return len(self.heartbeats)
+
+    def checkpoint(self) -> tuple[int, list[Heartbeat]]:
+        """
+        The version and every device, in join order, for a snapshot of the
+        state. Copied without awaiting, so the set of devices is consistent
+        with the version without taking heartbeat_lock. Only references are
+        copied: a device's auth_type and timestamp may move on afterwards,
+        which only makes them fresher.
+        """
+        return self.version, list(self.heartbeats.values())
+
+    def restore(self, version: int, heartbeats: list[Heartbeat]):
+        """
+        Load devices saved by an earlier run, in join order, before serving.
+        The change log starts out empty at `version`, so followers from
+        before the restart list the devices again.
+        """
+        for hb in heartbeats:
+            self.heartbeats[hb.client_id] = hb
+            self.by_seq[hb.seq] = hb
+        self.join_order = sorted(self.by_seq)
+        for hb in sorted(heartbeats, key=attrgetter("timestamp")):
+            self.expiry.touch(hb.client_id, hb.timestamp)
+        self.version = version
+        self.changes.clear()
+
+    async def list_devices(
+        self,
+        cursor: int = 0,
+        limit: int | None = None,
+        auth_type: AuthType | None = None,
+        seen_after: int | None = None,
+        seen_before: int | None = None,
+    ) -> tuple[list[dict], int | None]:
+        """
+        One page of devices, in join order, that joined after `cursor` and
+        match the filters; with the cursor of the next page, or None after
+        the last one. The page starts where join_order bisects to the cursor;
+        devices filtered out cost a comparison each, and only the page itself
+        is built.
+        """
+        page = []
+        join_order, by_seq = self.join_order, self.by_seq
+        for position in range(bisect_right(join_order, cursor), len(join_order)):
+            hb = by_seq.get(join_order[position])
+            if hb is None:
+                continue
+            if auth_type is not None and hb.auth_type is not auth_type:
+                continue
+            if seen_after is not None and hb.timestamp < seen_after:
+                continue
+            if seen_before is not None and hb.timestamp >= seen_before:
+                continue
+            page.append(hb)
+            if len(page) == limit:
+                break
+        devices = [device_dict(hb.client_id, hb.auth_type.value, hb.timestamp) for hb in page]
+        next_cursor = page[-1].seq if page and len(page) == limit else None
+        return devices, next_cursor
+
+    async def current_version(self) -> int:
+        return self.version
+
+    async def changes_since(self, version: int) -> list[dict] | None:
+        """
+        Joins and leaves after `version`, oldest first. None if the change
+        log no longer reaches back that far, or never had that version: the
+        caller has to list the devices again.
+        """
+        oldest = self.version - len(self.changes)
+        if not oldest <= version <= self.version:
+            return None
+        return [change_dict(*change) for change in islice(self.changes, version - oldest, None)]
+
+    async def wait_for_change(self, version: int, timeout: float):
+        """Return once the version has moved past `version`, or after timeout seconds."""
+        changed = self._changed
+        if self.version != version:
+            return
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
     async def find_by_remote_id(self, remote_id: uuid.UUID):
-        async with self.heartbeat_lock:
-            if remote_id not in self.heartbeats:
-                raise ValueError("Device not found.")
-            return self.heartbeats[remote_id]
+        hb = self.heartbeats.get(remote_id)
+        if hb is None:
+            raise ValueError("Device not found.")
+        return hb
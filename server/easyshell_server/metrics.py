@@ -0,0 +1,218 @@
+import time
+import asyncio
+from bisect import bisect_left
+
+# Seconds; tuned for handlers and lock waits that mostly take microseconds.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+
+class Registry:
+    """
+    Metrics in the Prometheus text format. Values are plain attributes bumped
+    on the event loop, so recording costs a few integer operations and no
+    locking; exposition does the formatting, once per scrape.
+    """
+
+    def __init__(self):
+        self.metrics: list["Metric"] = []
+        # Called before each exposition to refresh gauges that are cheaper
+        # to read on demand than to keep up to date.
+        self.collectors = []
+
+    def register(self, metric: "Metric"):
+        self.metrics.append(metric)
+
+    def collector(self, fn):
+        """Register an async function to run before each exposition."""
+        self.collectors.append(fn)
+        return fn
+
+    async def expose(self) -> str:
+        for collect in self.collectors:
+            await collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], object] = {}
+        registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        The child for one set of label values. Hot paths should look their
+        children up once and keep them, rather than per event.
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}.")
+            child = self._children[key] = self._new_child()
+        return child
+
+    def clear(self):
+        self._children.clear()
+
+    def expose(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, child in self._children.items():
+            lines.extend(self._expose_child(key, child))
+        return lines
+
+    def _expose_child(self, key, child) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {child.value}"]
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int | float = 1):
+        self.value += amount
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: int | float = 1):
+        self.value -= amount
+
+    def set(self, value: int | float):
+        self.value = value
+
+
+class HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        # Per bucket, not cumulative; the last one is +Inf.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return CounterChild()
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return GaugeChild()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def _expose_child(self, key, child) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class TimedLock(asyncio.Lock):
+    """An asyncio.Lock that observes how long acquire() waited."""
+
+    def __init__(self, wait_time: HistogramChild):
+        super().__init__()
+        self.wait_time = wait_time
+
+    async def acquire(self):
+        if not self.locked():
+            self.wait_time.observe(0.0)
+            return await super().acquire()
+        started = time.perf_counter()
+        try:
+            return await super().acquire()
+        finally:
+            self.wait_time.observe(time.perf_counter() - started)
+
+
+HEARTBEATS = Counter(
+    "easyshell_heartbeats_total", "Heartbeats received, by how the daemon sent them.", ("source",)
+)
+REQUEST_DURATION = Histogram(
+    "easyshell_request_duration_seconds", "Time to handle an HTTP request, by route.", ("route",)
+)
+LOCK_WAIT = Histogram(
+    "easyshell_lock_wait_seconds", "Time spent waiting to acquire a state lock.", ("lock",)
+)
+SESSIONS = Gauge("easyshell_sessions", "Sessions known to the server, by status.", ("status",))
+DEVICES = Gauge("easyshell_devices", "Devices with a live heartbeat.")
+RELAY_FRAMES = Counter(
+    "easyshell_relay_frames_total", "Frames relayed, by direction (input: client to daemon).", ("direction",)
+)
+RELAY_BYTES = Counter(
+    "easyshell_relay_bytes_total", "Payload relayed, by direction, in characters of text frames and bytes of binary ones.", ("direction",)
+)
+RELAY_IN_FLIGHT = Gauge(
+    "easyshell_relay_bytes_in_flight", "Payload read from one side of a session and not yet sent to the other."
+)
+RELAY_IN_FLIGHT_MAX = Gauge(
+    "easyshell_relay_bytes_in_flight_max", "Payload in flight in the single most backed-up session."
+)
+CLEANUP_DURATION = Histogram(
+    "easyshell_cleanup_duration_seconds", "Time taken by one expiry sweep of heartbeats and sessions."
+)
+OPEN_WEBSOCKETS = Gauge("easyshell_open_websockets", "Open websockets, by kind.", ("kind",))
+VIEWERS_DROPPED = Counter(
+    "easyshell_viewers_dropped_total", "Read-only viewers dropped for falling too far behind a session's output."
+)
+RECORDING_EVENTS_DROPPED = Counter(
+    "easyshell_recording_events_dropped_total", "Frames left out of recordings because their writer thread fell behind."
+)
+MUX_CHANNELS = Gauge(
+    "easyshell_mux_channels", "Session channels open on multiplexed daemon connections."
+)
@@ -0,0 +1,189 @@
+import struct
+import asyncio
+from collections import deque
+
+from sanic.log import logger
+
+from easyshell_server.metrics import MUX_CHANNELS
+
+# Every message on a multiplexed connection is one binary websocket frame:
+# a header, then the payload. The daemon's daemon.mux speaks the same.
+MUX_HEADER = struct.Struct("!BI")  # message type, channel id
+MUX_CREDIT = struct.Struct("!I")  # payload of MUX_WINDOW
+
+MUX_OPEN = 0  # Daemon to server; payload: the session secret.
+MUX_TEXT = 1
+MUX_BINARY = 2
+MUX_WINDOW = 3  # Bytes the receiver consumed, which the sender may send again.
+MUX_CLOSE = 4
+
+# Bytes either side of a channel may have unconsumed at the other, give or
+# take the frame that crosses it.
+INITIAL_WINDOW = 256 * 1024
+
+MUX_CHANNELS_OPEN = MUX_CHANNELS.labels()
+
+
+class MuxChannelClosed(ConnectionError):
+    """The channel ended, the way a websocket ends with a close frame."""
+
+
+class MuxChannel:
+    """
+    The daemon leg of one session on a multiplexed connection. It has the
+    recv/send/close surface of a Sanic websocket, so a SessionRelay can use
+    it like a daemon websocket of its own.
+
+    Flow control is per channel: frames wait in the channel's own queue
+    until recv() takes them, and only then is the daemon granted the window
+    to send more. A session whose client is slow stops its own output
+    without holding up the others on the connection.
+    """
+
+    def __init__(self, connection: "MuxConnection", channel_id: int):
+        self.connection = connection
+        self.id = channel_id
+        self.frames: deque[tuple[str | bytes, int]] = deque()
+        self.buffered = 0
+        self.send_window = INITIAL_WINDOW
+        # Consumed bytes not yet granted back to the daemon.
+        self.consumed = 0
+        self.closed = False
+        self._readable = asyncio.Event()
+        self._window_open = asyncio.Event()
+        self._window_open.set()
+
+    def feed(self, frame: str | bytes, size: int):
+        self.frames.append((frame, size))
+        self.buffered += size
+        self._readable.set()
+
+    def grant(self, size: int):
+        self.send_window += size
+        if self.send_window > 0:
+            self._window_open.set()
+
+    def hang_up(self):
+        """Stop the channel, as the daemon closed it or the connection is gone."""
+        self.closed = True
+        self._readable.set()
+        self._window_open.set()
+
+    async def recv(self):
+        # Frames that arrived before the channel closed are still delivered.
+        while not self.frames:
+            if self.closed:
+                raise MuxChannelClosed("Multiplexed channel closed.")
+            self._readable.clear()
+            await self._readable.wait()
+
+        frame, size = self.frames.popleft()
+        self.buffered -= size
+        self.consumed += size
+        if self.consumed >= INITIAL_WINDOW // 2 and not self.closed:
+            credit, self.consumed = self.consumed, 0
+            await self.connection.send(MUX_WINDOW, self.id, MUX_CREDIT.pack(credit))
+        return frame
+
+    async def send(self, data):
+        if isinstance(data, str):
+            payload, kind = data.encode(), MUX_TEXT
+        else:
+            payload, kind = data, MUX_BINARY
+        while self.send_window <= 0 and not self.closed:
+            self._window_open.clear()
+            await self._window_open.wait()
+        if self.closed:
+            raise MuxChannelClosed("Multiplexed channel closed.")
+        self.send_window -= len(payload)
+        await self.connection.send(kind, self.id, payload)
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        # Channels have no close codes; the daemon only sees the channel end.
+        if self.closed:
+            return
+        self.hang_up()
+        self.connection.forget(self)
+        try:
+            await self.connection.send(MUX_CLOSE, self.id)
+        except Exception:
+            pass
+
+
+class MuxConnection:
+    """
+    A daemon's multiplexed websocket, carrying the daemon legs of many
+    sessions. Each session is a channel, opened by the daemon with a single
+    MUX_OPEN frame instead of a websocket handshake of its own; serve()
+    runs on_open(channel, session_secret) for it as a task of its own.
+    """
+
+    def __init__(self, ws, on_open):
+        self.ws = ws
+        self.on_open = on_open
+        self.channels: dict[int, MuxChannel] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def send(self, kind: int, channel_id: int, payload: bytes = b""):
+        await self.ws.send(MUX_HEADER.pack(kind, channel_id) + payload)
+
+    def forget(self, channel: MuxChannel):
+        if self.channels.get(channel.id) is channel:
+            del self.channels[channel.id]
+
+    async def serve(self):
+        """Read the connection until it closes, then hang up every channel still open."""
+        try:
+            while True:
+                message = await self.ws.recv()
+                if not isinstance(message, bytes) or len(message) < MUX_HEADER.size:
+                    logger.error("Malformed message on a multiplexed connection. Closing it.")
+                    await self.ws.close()
+                    return
+                kind, channel_id = MUX_HEADER.unpack_from(message)
+                self._dispatch(kind, channel_id, message[MUX_HEADER.size:])
+        finally:
+            for channel in self.channels.values():
+                channel.hang_up()
+            self.channels.clear()
+
+    def _dispatch(self, kind: int, channel_id: int, payload: bytes):
+        if kind == MUX_OPEN:
+            if channel_id in self.channels:
+                logger.warning(f"Multiplexed channel {channel_id} is already open.")
+                return
+            channel = self.channels[channel_id] = MuxChannel(self, channel_id)
+            self._start(self._run(channel, payload.decode(errors="replace")))
+            return
+
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            # Closed here while the daemon was still sending.
+            return
+        if kind in (MUX_TEXT, MUX_BINARY) and channel.buffered > 2 * INITIAL_WINDOW:
+            logger.error(f"Daemon overran the window of channel {channel_id}. Closing it.")
+            self._start(channel.close())
+        elif kind == MUX_TEXT:
+            channel.feed(payload.decode(errors="replace"), len(payload))
+        elif kind == MUX_BINARY:
+            channel.feed(payload, len(payload))
+        elif kind == MUX_WINDOW:
+            channel.grant(MUX_CREDIT.unpack(payload)[0])
+        elif kind == MUX_CLOSE:
+            channel.hang_up()
+            self.forget(channel)
+        else:
+            logger.warning(f"Unknown multiplexed message type: {kind}")
+
+    def _start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, channel: MuxChannel, session_secret: str):
+        MUX_CHANNELS_OPEN.inc()
+        try:
+            await self.on_open(channel, session_secret)
+        finally:
+            MUX_CHANNELS_OPEN.dec()
+            await channel.close()
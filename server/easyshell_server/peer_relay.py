@@ -0,0 +1,229 @@
+import hmac
+import json
+import struct
+import asyncio
+import ipaddress
+
+from sanic.log import logger
+
+from easyshell_server.relay import RelayManager, SessionRelay, CLIENT, DAEMON
+
+FRAME_HEADER = struct.Struct("!BI")  # frame type, payload length
+FRAME_TEXT = 0
+FRAME_BINARY = 1
+
+KIND_RELAY = "relay"
+KIND_NOTIFY = "notify"
+KIND_RESUME = "resume"
+KIND_VIEW = "view"
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class PeerSocket:
+    """
+    A relay leg held by another worker, reached over a TCP stream between
+    the two workers. It has the recv/send/close surface of a Sanic websocket,
+    so a SessionRelay can use it as the missing side of a session.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def recv(self):
+        frame_type, length = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))
+        payload = await self.reader.readexactly(length)
+        return payload.decode() if frame_type == FRAME_TEXT else payload
+
+    async def send(self, data):
+        if isinstance(data, str):
+            payload, frame_type = data.encode(), FRAME_TEXT
+        else:
+            payload, frame_type = data, FRAME_BINARY
+        self.writer.write(FRAME_HEADER.pack(frame_type, len(payload)))
+        self.writer.write(payload)
+        await self.writer.drain()
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        # The stream has no close codes; the worker at the other end only
+        # sees it end.
+        self.writer.close()
+
+
+class PeerRouter:
+    """
+    Connects the two legs of a session when they land on different workers
+    or hosts, and forwards control-channel notifications between workers.
+
+    Every worker listens for peer connections and records in the shared
+    routing table where each of its legs lives. When both legs of a session
+    are registered on different workers, the leg registered last dials the
+    other worker and each side attaches the connection as a PeerSocket in
+    place of the remote leg.
+
+    A client resuming on another worker than the one keeping its session is
+    linked to that worker, which resumes the session over the link. Viewers
+    are linked the same way to the worker holding the client leg.
+
+    Peer connections carry session traffic, so every hello has to bring
+    peer_secret, shared by all workers. Without one, the listener only
+    accepts connections on a loopback address.
+    """
+
+    def __init__(
+        self, routing_table, relay_manager: RelayManager, on_notify, on_resume, on_view, peer_secret: str = ""
+    ):
+        self.routing_table = routing_table
+        self.peer_secret = peer_secret
+        self.relay_manager = relay_manager
+        self.on_notify = on_notify
+        self.on_resume = on_resume
+        self.on_view = on_view
+        self.address = None
+        self._server = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def start(self, host: str, advertise_host: str):
+        if not self.peer_secret and not is_loopback(host):
+            raise ValueError(f"A peer relay listening on {host} needs RELAY_PEER_SECRET.")
+        self._server = await asyncio.start_server(self._handle, host, 0)
+        port = self._server.sockets[0].getsockname()[1]
+        self.address = f"{advertise_host}:{port}"
+        logger.info(f"Peer relay listening on {self.address}.")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+        for task in self._tasks:
+            task.cancel()
+
+    async def attach(self, session_secret: str, side: str, ws) -> SessionRelay:
+        relay = self.relay_manager.attach(session_secret, side, ws)
+        peer_side = SessionRelay.other(side)
+        if relay.sockets[peer_side] is not None:
+            return relay
+
+        leg_id = await self.routing_table.register_leg(session_secret, side, self.address)
+        peer = await self.routing_table.find_leg(session_secret, peer_side)
+        if peer is None or peer.address == self.address or peer.id > leg_id:
+            # The peer will dial us when it arrives, if it is elsewhere.
+            return relay
+
+        peer_socket = await self._dial(peer.address, {"kind": KIND_RELAY, "secret": session_secret, "side": side})
+        self._serve(self._forward(session_secret, peer_side, peer_socket))
+        return relay
+
+    async def detach(self, session_secret: str, side: str):
+        await self.relay_manager.detach(session_secret, side)
+        await self.routing_table.unregister_leg(session_secret, side, self.address)
+
+    async def resume(self, session_secret: str, ws, offset: int) -> SessionRelay | None:
+        """Link a resuming client to the worker keeping its session, if that is another one."""
+        leg = await self.routing_table.find_leg(session_secret, CLIENT)
+        if leg is None or leg.address == self.address:
+            return None
+
+        peer_socket = await self._dial(leg.address, {"kind": KIND_RESUME, "secret": session_secret, "offset": offset})
+        relay = self.relay_manager.attach(session_secret, CLIENT, ws, link=True)
+        self._serve(self._forward(session_secret, DAEMON, peer_socket))
+        return relay
+
+    async def watch(self, session_secret: str, ws) -> bool:
+        """
+        Link a viewer to the worker holding the session's client leg, if that
+        is another one, and relay its output until either end leaves.
+        """
+        leg = await self.routing_table.find_leg(session_secret, CLIENT)
+        if leg is None or leg.address == self.address:
+            return False
+
+        peer_socket = await self._dial(leg.address, {"kind": KIND_VIEW, "secret": session_secret})
+
+        async def pump():
+            while True:
+                await ws.send(await peer_socket.recv())
+
+        async def discard_input():
+            while True:
+                await ws.recv()
+
+        tasks = [asyncio.create_task(pump()), asyncio.create_task(discard_input())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await peer_socket.close()
+        await ws.close()
+        return True
+
+    async def notify(self, address: str, device_id):
+        """Ask the worker at address to push pending sessions to device_id."""
+        peer_socket = await self._dial(address, {"kind": KIND_NOTIFY, "device_id": str(device_id)})
+        await peer_socket.close()
+
+    async def _dial(self, address: str, hello: dict) -> PeerSocket:
+        host, port = address.rsplit(":", 1)
+        reader, writer = await asyncio.open_connection(host, int(port))
+        writer.write(json.dumps({**hello, "auth": self.peer_secret}).encode() + b"\n")
+        await writer.drain()
+        return PeerSocket(reader, writer)
+
+    def _serve(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _forward(self, session_secret: str, side: str, peer_socket: PeerSocket):
+        """Relay frames arriving from the remote leg until either leg leaves."""
+        relay = self.relay_manager.attach(session_secret, side, peer_socket, link=True)
+        try:
+            await relay.forward(side)
+        except Exception as e:
+            logger.info(f"Peer leg of session {session_secret} closed: {e!r}")
+        finally:
+            await self.relay_manager.detach(session_secret, side)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            hello = json.loads(await reader.readline())
+        except ValueError:
+            writer.close()
+            return
+        if not isinstance(hello, dict) or not hmac.compare_digest(
+            str(hello.get("auth", "")).encode(), self.peer_secret.encode()
+        ):
+            logger.warning("Peer connection without the shared peer secret. Closing it.")
+            writer.close()
+            return
+
+        match hello.get("kind"):
+            case "relay":
+                relay = self.relay_manager.relays.get(hello["secret"])
+                if relay is None or (
+                    relay.sockets[SessionRelay.other(hello["side"])] is None and not relay.suspended
+                ):
+                    # Our leg left while the peer was dialing; hang up so
+                    # the peer closes its leg too.
+                    writer.close()
+                    return
+                await self._forward(hello["secret"], hello["side"], PeerSocket(reader, writer))
+            case "notify":
+                writer.close()
+                await self.on_notify(hello["device_id"])
+            case "resume":
+                await self.on_resume(PeerSocket(reader, writer), hello["secret"], hello["offset"])
+            case "view":
+                await self.on_view(PeerSocket(reader, writer), hello["secret"])
+            case kind:
+                logger.warning(f"Unknown peer connection kind: {kind}")
+                writer.close()
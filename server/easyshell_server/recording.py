@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import zlib
+import struct
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from sanic.log import logger
+
+from easyshell_server.metrics import RECORDING_EVENTS_DROPPED
+from easyshell_server.relay import CLIENT
+
+# A recording is a header followed by zlib-compressed chunks of events:
+#
+#   header:  magic, wall clock time the recording started
+#   chunk:   time of its first event, event count, compressed size, data
+#   event:   seconds since the start, direction, kind, length, payload
+#
+# Every chunk also gets an entry in a sidecar "<name>.idx" file, which is a
+# flat array of (first event time, chunk offset) that replay bisects to
+# find where to start reading. Both files are only ever appended to; a
+# recording opened again carries on from the time it was first started.
+MAGIC = b"ESREC\x01"
+HEADER = struct.Struct("!6sd")
+CHUNK = struct.Struct("!dII")
+EVENT = struct.Struct("!dBBI")
+INDEX_ENTRY = struct.Struct("!dQ")
+
+INPUT = ord("i")
+OUTPUT = ord("o")
+TEXT = 0
+BINARY = 1
+
+EXTENSION = ".esrec"
+INDEX_EXTENSION = ".idx"
+
+EVENTS_DROPPED = RECORDING_EVENTS_DROPPED.labels()
+
+
+@dataclass(slots=True)
+class Event:
+    time: float
+    direction: str
+    data: str | bytes
+
+
+class RecordingWriter:
+    """
+    Records the frames of one session.
+
+    record() is called by the relay for every frame and only packs it into
+    the current chunk. Full chunks, or chunks older than chunk_interval,
+    are compressed and written by the recorder's thread, so the relay never
+    waits on zlib or the disk. At most max_pending chunks wait for that
+    thread; while it is that far behind, further chunks are dropped and
+    counted in dropped_events rather than queued without bound.
+    """
+
+    def __init__(
+        self, path: str, executor: ThreadPoolExecutor, chunk_bytes: int, chunk_interval: float, max_pending: int = 64
+    ):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.chunk_interval = chunk_interval
+        self.max_pending = max_pending
+        self.dropped_events = 0
+        self._executor = executor
+        self._started = time.monotonic()
+        self._chunk = bytearray()
+        self._chunk_time = 0.0
+        self._chunk_events = 0
+        self._flush_timer = None
+        self._closed = False
+        self._file = None
+        self._index = None
+        # Seconds between the recording's first start and this one's, added
+        # to the times of its events by the writer thread.
+        self._time_offset = 0.0
+        self._pending = deque()
+        self._last = executor.submit(self._open, time.time())
+
+    def _open(self, started_at: float):
+        self._file = open(self.path, "ab")
+        self._index = open(self.path + INDEX_EXTENSION, "ab")
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, started_at))
+            return
+        # Opened again, e.g. for a session whose relay was rebuilt. Its
+        # events go after the ones already there, so the index stays in
+        # time order.
+        with open(self.path, "rb") as f:
+            _, first_started_at = HEADER.unpack(f.read(HEADER.size))
+        last_time = 0.0
+        index_size = self._index.tell() - self._index.tell() % INDEX_ENTRY.size
+        if index_size:
+            with open(self.path + INDEX_EXTENSION, "rb") as f:
+                f.seek(index_size - INDEX_ENTRY.size)
+                last_time, _ = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+        self._time_offset = max(started_at - first_started_at, last_time)
+
+    def record(self, side: str, data: str | bytes):
+        if self._closed:
+            return
+        now = time.monotonic() - self._started
+        if isinstance(data, str):
+            kind, payload = TEXT, data.encode()
+        else:
+            kind, payload = BINARY, data
+
+        if not self._chunk_events:
+            self._chunk_time = now
+            self._flush_timer = asyncio.get_running_loop().call_later(self.chunk_interval, self.flush)
+        self._chunk += EVENT.pack(now, INPUT if side == CLIENT else OUTPUT, kind, len(payload))
+        self._chunk += payload
+        self._chunk_events += 1
+
+        if len(self._chunk) >= self.chunk_bytes:
+            self.flush()
+
+    def flush(self):
+        """Hand the current chunk to the writer thread."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._chunk_events:
+            return
+        # The writer thread finishes chunks in order.
+        while self._pending and self._pending[0].done():
+            self._pending.popleft()
+        if len(self._pending) >= self.max_pending:
+            if not self.dropped_events:
+                logger.warning(f"Recording {self.path} cannot keep up; dropping output until it does.")
+            self.dropped_events += self._chunk_events
+            EVENTS_DROPPED.inc(self._chunk_events)
+        else:
+            chunk = bytes(self._chunk)
+            self._last = self._executor.submit(self._write_chunk, chunk, self._chunk_time, self._chunk_events)
+            self._pending.append(self._last)
+        self._chunk.clear()
+        self._chunk_events = 0
+
+    def _shift(self, chunk: bytes) -> bytes:
+        """chunk with _time_offset added to the time of every event."""
+        shifted = bytearray(chunk)
+        position = 0
+        while position < len(shifted):
+            at, direction, kind, length = EVENT.unpack_from(shifted, position)
+            EVENT.pack_into(shifted, position, at + self._time_offset, direction, kind, length)
+            position += EVENT.size + length
+        return bytes(shifted)
+
+    def _write_chunk(self, chunk: bytes, first_time: float, events: int):
+        if self._time_offset:
+            chunk = self._shift(chunk)
+            first_time += self._time_offset
+        data = zlib.compress(chunk, 1)
+        offset = self._file.tell()
+        self._file.write(CHUNK.pack(first_time, events, len(data)))
+        self._file.write(data)
+        self._file.flush()
+        self._index.write(INDEX_ENTRY.pack(first_time, offset))
+        self._index.flush()
+
+    def _close(self):
+        self._file.close()
+        self._index.close()
+
+    async def close(self):
+        """Write what is left and close the files."""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._last = self._executor.submit(self._close)
+        try:
+            await asyncio.wrap_future(self._last)
+        except Exception as e:
+            logger.error(f"Error writing recording {self.path}: {e}")
+
+
+class RecordingReader:
+    """
+    Reads a recording back chunk by chunk, so memory use is bounded by the
+    chunk size no matter how long the recording is. Blocking; run it off
+    the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        magic, self.started_at = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC:
+            self._file.close()
+            raise ValueError(f"{path} is not a recording.")
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _seek_index(self, start: float) -> int:
+        """Offset of the last chunk that begins at or before start."""
+        try:
+            index = open(self.path + INDEX_EXTENSION, "rb")
+        except FileNotFoundError:
+            return self._seek_scan(start)
+
+        with index:
+            low, high = 0, os.fstat(index.fileno()).st_size // INDEX_ENTRY.size
+            offset = HEADER.size
+            # Entries are in time order; bisect them in place.
+            while low < high:
+                middle = (low + high) // 2
+                index.seek(middle * INDEX_ENTRY.size)
+                first_time, chunk_offset = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))
+                if first_time <= start:
+                    offset = chunk_offset
+                    low = middle + 1
+                else:
+                    high = middle
+            return offset
+
+    def _seek_scan(self, start: float) -> int:
+        """Like _seek_index, for a recording without an index: hop over the chunk headers."""
+        offset = found = HEADER.size
+        while True:
+            self._file.seek(offset)
+            header = self._file.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return found
+            first_time, _, size = CHUNK.unpack(header)
+            if first_time > start:
+                return found
+            found = offset
+            offset += CHUNK.size + size
+
+    def chunks(self, start: float = 0.0):
+        """Yield the events from start onwards, one list per chunk."""
+        self._file.seek(self._seek_index(start) if start > 0 else HEADER.size)
+        while True:
+            header = self._file.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return
+            _, _, size = CHUNK.unpack(header)
+            data = self._file.read(size)
+            if len(data) < size:
+                # A chunk still being written.
+                return
+            events = list(self._decode(zlib.decompress(data), start))
+            if events:
+                yield events
+
+    @staticmethod
+    def _decode(chunk: bytes, start: float):
+        position = 0
+        while position < len(chunk):
+            at, direction, kind, length = EVENT.unpack_from(chunk, position)
+            position += EVENT.size
+            payload = chunk[position:position + length]
+            position += length
+            if at < start:
+                continue
+            yield Event(at, chr(direction), payload.decode() if kind == TEXT else payload)
+
+
+def asciicast_header(reader: RecordingReader) -> str:
+    return json.dumps({"version": 2, "width": 80, "height": 24, "timestamp": int(reader.started_at)}) + "\n"
+
+
+def asciicast_lines(events: list[Event]) -> str:
+    """Events as asciicast v2 event lines, so any asciicast player can replay them."""
+    return "".join(
+        json.dumps([
+            round(event.time, 6),
+            event.direction,
+            event.data if isinstance(event.data, str) else event.data.decode(errors="replace"),
+        ]) + "\n"
+        for event in events
+    )
+
+
+class Recorder:
+    """
+    Opens recordings in a directory, one file per session. All of them share
+    one writer thread, which keeps chunks of a file in order.
+    """
+
+    def __init__(
+        self, directory: str, chunk_bytes: int = 64 * 1024, chunk_interval: float = 1.0, max_pending_chunks: int = 64
+    ):
+        self.directory = directory
+        self.chunk_bytes = chunk_bytes
+        self.chunk_interval = chunk_interval
+        self.max_pending_chunks = max_pending_chunks
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recording")
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, session_secret: str) -> str:
+        return os.path.join(self.directory, session_secret + EXTENSION)
+
+    def open(self, session_secret: str) -> RecordingWriter:
+        return RecordingWriter(
+            self.path(session_secret), self._executor, self.chunk_bytes, self.chunk_interval, self.max_pending_chunks
+        )
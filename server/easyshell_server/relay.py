@@ -0,0 +1,390 @@
+import asyncio
+from collections import deque
+
+from sanic.log import logger
+
+from easyshell_server.metrics import RELAY_BYTES, RELAY_FRAMES
+from easyshell_server.viewers import ViewerFanout
+
+CLIENT = "client"
+DAEMON = "daemon"
+
+# How long a side that disconnected waits for its last frames to reach the peer.
+DRAIN_TIMEOUT = 1.0
+
+# Keyed by the side frames are read from, like SessionRelay.buffers.
+FRAMES_SENT = {CLIENT: RELAY_FRAMES.labels("input"), DAEMON: RELAY_FRAMES.labels("output")}
+BYTES_SENT = {CLIENT: RELAY_BYTES.labels("input"), DAEMON: RELAY_BYTES.labels("output")}
+
+
+class RelayBuffer:
+    """
+    Bounded frame queue for one direction of a relay.
+
+    put() blocks once high_watermark bytes are queued and resumes only when
+    the writer has drained the queue down to low_watermark, so a slow
+    receiver stops the reader instead of growing server memory.
+    """
+
+    def __init__(self, high_watermark: int, low_watermark: int):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.frames = deque()
+        self.size = 0
+        self.closed = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        # Set by the writer once everything put has been sent.
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._writable.is_set()
+
+    async def put(self, frame):
+        await self._writable.wait()
+        if self.closed:
+            return
+        self.frames.append(frame)
+        self.size += len(frame)
+        self._readable.set()
+        self.drained.clear()
+        if self.size >= self.high_watermark:
+            self._writable.clear()
+
+    async def wait_readable(self):
+        await self._readable.wait()
+
+    def close(self):
+        """Drop queued frames and release anyone waiting on the buffer."""
+        self.closed = True
+        self.frames.clear()
+        self.size = 0
+        self._readable.set()
+        self._writable.set()
+        self.drained.set()
+
+    def get(self, max_bytes: int = 0):
+        """
+        Pop the next frame. With max_bytes, also join the frames of the same
+        type that follow it, up to max_bytes in total.
+        """
+        frame = self.frames.popleft()
+        size = len(frame)
+
+        if max_bytes and size < max_bytes and self.frames:
+            parts = [frame]
+            while self.frames:
+                following = self.frames[0]
+                if type(following) is not type(frame) or size + len(following) > max_bytes:
+                    break
+                parts.append(self.frames.popleft())
+                size += len(following)
+            if len(parts) > 1:
+                frame = (b"" if isinstance(frame, bytes) else "").join(parts)
+
+        self.size -= size
+        if not self.frames:
+            self._readable.clear()
+        if self.size <= self.low_watermark:
+            self._writable.set()
+        return frame
+
+
+class SessionRelay:
+    """
+    The client and daemon websockets of one session.
+
+    Each side runs forward() in its own websocket handler: it reads frames
+    into that direction's RelayBuffer while a writer task sends them to the
+    peer. The peer socket is resolved once and then frames go straight
+    through, text or binary, with no per-frame lookups or decoding. Daemon
+    output is coalesced: queued frames are joined into frames of at most
+    coalesce_max_bytes, waiting up to coalesce_delay seconds for more.
+
+    With a recording, every frame is recorded as it is sent to the peer.
+    With a scrollback, daemon output is also kept there, and the relay
+    outlives its client: output waits for a client to resume the session,
+    which is first sent what it missed.
+
+    Daemon output is also published to the session's read-only viewers,
+    if it has any, ahead of the client.
+    """
+
+    def __init__(
+        self,
+        session_secret: str,
+        coalesce_delay: float = 0.0,
+        coalesce_max_bytes: int = 64 * 1024,
+        high_watermark: int = 1024 * 1024,
+        low_watermark: int = 256 * 1024,
+        viewer_max_lag: int = 1024 * 1024,
+    ):
+        self.session_secret = session_secret
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_max_bytes = coalesce_max_bytes
+        self.viewer_max_lag = viewer_max_lag
+        self.sockets = {CLIENT: None, DAEMON: None}
+        self.attached = {CLIENT: asyncio.Event(), DAEMON: asyncio.Event()}
+        # Keyed by the side that reads into the buffer.
+        self.buffers = {
+            CLIENT: RelayBuffer(high_watermark, low_watermark),
+            DAEMON: RelayBuffer(high_watermark, low_watermark),
+        }
+        self.recording = None
+        self.scrollback = None
+        self.viewers: ViewerFanout | None = None
+        # Whether the client leg attached here rather than on another worker.
+        self.home = False
+        # Bumped whenever the client leaves a resumable session.
+        self.client_departures = 0
+        self._client_changed = asyncio.Event()
+
+    @staticmethod
+    def other(side: str) -> str:
+        return DAEMON if side == CLIENT else CLIENT
+
+    @property
+    def bytes_in_flight(self) -> int:
+        """Bytes read from one side and not yet sent to the other."""
+        return self.buffers[CLIENT].size + self.buffers[DAEMON].size
+
+    @property
+    def suspended(self) -> bool:
+        """Whether the client left and the session waits for it to resume."""
+        return self.scrollback is not None and self.sockets[CLIENT] is None
+
+    def attach(self, side: str, ws):
+        self.sockets[side] = ws
+        self.attached[side].set()
+        if side == CLIENT:
+            self._client_changed.set()
+
+    def suspend_client(self, ws) -> bool:
+        """Detach a client that dropped, keeping the session for it to resume."""
+        if self.scrollback is None or self.sockets[CLIENT] is not ws:
+            return False
+        self.sockets[CLIENT] = None
+        self.attached[CLIENT].clear()
+        self.client_departures += 1
+        return True
+
+    async def resume_client(self, ws, offset: int):
+        """
+        Attach ws as the client, after sending it the output since offset.
+        A client still attached is taken over and closed.
+        """
+        previous = self.sockets[CLIENT]
+        self.sockets[CLIENT] = None
+        self.attached[CLIENT].clear()
+
+        # Output the writer keeps meanwhile is only in the scrollback.
+        while data := self.scrollback.since(offset):
+            offset = self.scrollback.end
+            await ws.send(data.decode(errors="replace"))
+        self.attach(CLIENT, ws)
+
+        if previous is not None:
+            try:
+                await previous.close()
+            except Exception as e:
+                logger.error(f"Error closing replaced client websocket: {e}")
+
+    async def _send_resumable(self, client, frame):
+        """Send daemon output to client, or keep it for the next one. Returns the client now attached."""
+        self.scrollback.append(frame)
+        if self.sockets[CLIENT] is client:
+            try:
+                await client.send(frame)
+                return client
+            except Exception:
+                pass
+        # The client left or was replaced; resuming sends the frame from the scrollback.
+        return await self._next_client(client)
+
+    async def _next_client(self, gone):
+        """Wait for a client other than gone to attach."""
+        while self.sockets[CLIENT] in (gone, None):
+            self._client_changed.clear()
+            await self._client_changed.wait()
+        return self.sockets[CLIENT]
+
+    async def watch(self, ws):
+        """Send ws the session's output, read-only, starting with its scrollback if kept."""
+        if self.viewers is None:
+            self.viewers = ViewerFanout(self.viewer_max_lag)
+        backlog = self.scrollback.since(0) if self.scrollback is not None else b""
+        await self.viewers.watch(ws, backlog)
+
+    def close(self):
+        for buffer in self.buffers.values():
+            buffer.close()
+        if self.viewers is not None:
+            self.viewers.close()
+
+    async def forward(self, side: str):
+        """Forward frames from one side to its peer until that side disconnects."""
+        ws = self.sockets[side]
+        buffer = self.buffers[side]
+        writer = asyncio.create_task(self._drain(side))
+
+        try:
+            while True:
+                data = await ws.recv()
+                if writer.done():
+                    # Surface the writer's error, e.g. the peer went away.
+                    writer.result()
+                    return
+                await buffer.put(data)
+                if buffer.closed:
+                    return
+        except (Exception, asyncio.CancelledError):
+            # This side is gone; let what it sent last reach the peer.
+            # Sanic's recv() raises CancelledError on a close frame.
+            if not writer.done():
+                drained = asyncio.create_task(buffer.drained.wait())
+                await asyncio.wait(
+                    [writer, drained],
+                    timeout=DRAIN_TIMEOUT,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                drained.cancel()
+            raise
+        finally:
+            writer.cancel()
+
+    async def _drain(self, side: str):
+        """Send everything read from side to its peer, once the peer is attached."""
+        peer_side = self.other(side)
+        buffer = self.buffers[side]
+        # Client input is line-oriented, so only daemon output may be joined.
+        max_bytes = self.coalesce_max_bytes if side == DAEMON else 0
+        frames_sent = FRAMES_SENT[side]
+        bytes_sent = BYTES_SENT[side]
+
+        if not self.attached[peer_side].is_set():
+            logger.warning(f"No {peer_side} connected for session {self.session_secret} yet.")
+            await self.attached[peer_side].wait()
+        peer = self.sockets[peer_side]
+
+        while True:
+            await buffer.wait_readable()
+            if buffer.closed:
+                return
+            if max_bytes and self.coalesce_delay and buffer.size < max_bytes:
+                await asyncio.sleep(self.coalesce_delay)
+            frame = buffer.get(max_bytes)
+            frames_sent.inc()
+            bytes_sent.inc(len(frame))
+            if self.recording:
+                self.recording.record(side, frame)
+            if self.viewers is not None and side == DAEMON:
+                self.viewers.publish(frame)
+            if self.scrollback is not None and side == DAEMON:
+                peer = await self._send_resumable(peer, frame)
+            else:
+                await peer.send(frame)
+            if not buffer.frames:
+                buffer.drained.set()
+
+
+class RelayManager:
+    def __init__(
+        self,
+        coalesce_delay: float = 0.0,
+        coalesce_max_bytes: int = 64 * 1024,
+        high_watermark: int = 1024 * 1024,
+        low_watermark: int = 256 * 1024,
+        viewer_max_lag: int = 1024 * 1024,
+    ):
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_max_bytes = coalesce_max_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.viewer_max_lag = viewer_max_lag
+        # An easyshell_server.recording.Recorder, when sessions are recorded.
+        self.recorder = None
+        # An easyshell_server.scrollback.ScrollbackBudget, when clients may resume.
+        self.scrollback_budget = None
+        self.relays: dict[str, SessionRelay] = {}
+
+    def attach(self, session_secret: str, side: str, ws, link: bool = False) -> SessionRelay:
+        """
+        Attach one side of a session. The relay its client websocket attaches
+        to records the session and keeps its scrollback; link=True is for
+        legs that only connect to the relay of another worker.
+        """
+        relay = self.relays.get(session_secret)
+        if relay is None:
+            relay = SessionRelay(
+                session_secret,
+                coalesce_delay=self.coalesce_delay,
+                coalesce_max_bytes=self.coalesce_max_bytes,
+                high_watermark=self.high_watermark,
+                low_watermark=self.low_watermark,
+                viewer_max_lag=self.viewer_max_lag,
+            )
+            self.relays[session_secret] = relay
+        relay.attach(side, ws)
+        if side == CLIENT and not link:
+            relay.home = True
+            if self.recorder and relay.recording is None:
+                relay.recording = self.recorder.open(session_secret)
+            if self.scrollback_budget and relay.scrollback is None:
+                relay.scrollback = self.scrollback_budget.open()
+        return relay
+
+    def suspend(self, session_secret: str, ws) -> SessionRelay | None:
+        """Keep the session of a client that dropped, if it can resume. Returns the relay kept."""
+        relay = self.relays.get(session_secret)
+        if relay is not None and relay.suspend_client(ws):
+            return relay
+        return None
+
+    async def resume(self, session_secret: str, ws, offset: int) -> SessionRelay | None:
+        """Give a kept session to a reconnecting client, from byte offset of the daemon output."""
+        relay = self.relays.get(session_secret)
+        if relay is None or relay.scrollback is None:
+            return None
+        await relay.resume_client(ws, offset)
+        return relay
+
+    async def watch(self, session_secret: str, ws) -> bool:
+        """
+        Attach ws as a read-only viewer until it leaves or the session ends.
+        False, at once, if the session's client leg is not on this worker.
+        """
+        relay = self.relays.get(session_secret)
+        if relay is None or not relay.home:
+            return False
+        await relay.watch(ws)
+        return True
+
+    def bytes_in_flight(self) -> dict[str, int]:
+        """Bytes queued in each session's relay, by session secret."""
+        return {secret: relay.bytes_in_flight for secret, relay in self.relays.items()}
+
+    async def detach(self, session_secret: str, side: str):
+        """Drop one side of a session and close the other, ending the relay."""
+        relay = self.relays.pop(session_secret, None)
+        if relay is None:
+            return
+
+        relay.close()
+        relay.sockets[side] = None
+        peer_side = SessionRelay.other(side)
+        peer = relay.sockets[peer_side]
+        if peer is not None:
+            relay.sockets[peer_side] = None
+            try:
+                await peer.close()
+                logger.info(f"Closed {peer_side} connection for {session_secret}.")
+            except Exception as e:
+                logger.error(f"Error closing {peer_side} websocket: {e}")
+
+        if relay.scrollback is not None:
+            self.scrollback_budget.release(relay.scrollback)
+        if relay.recording:
+            await relay.recording.close()
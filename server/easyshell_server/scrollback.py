@@ -0,0 +1,110 @@
+from collections import deque
+
+
+class ScrollbackBudget:
+    """
+    Caps the daemon output kept for resuming clients: session_bytes per
+    session and total_bytes across all sessions of the worker. Over the
+    total, the session being written is trimmed to its fair share, and if
+    that is not enough, so is every other session over it, idle ones
+    included.
+    """
+
+    def __init__(self, session_bytes: int, total_bytes: int):
+        self.session_bytes = session_bytes
+        self.total_bytes = total_bytes
+        self.size = 0
+        self.buffers: set["Scrollback"] = set()
+
+    def open(self) -> "Scrollback":
+        scrollback = Scrollback(self)
+        self.buffers.add(scrollback)
+        return scrollback
+
+    def fair_share(self) -> int:
+        return self.total_bytes // max(len(self.buffers), 1)
+
+    def evict(self):
+        """Trim every session down to its fair share, which brings the total within total_bytes."""
+        share = self.fair_share()
+        for scrollback in self.buffers:
+            if scrollback.size > share:
+                scrollback.trim(share)
+
+    def release(self, scrollback: "Scrollback"):
+        if scrollback in self.buffers:
+            self.buffers.discard(scrollback)
+            scrollback.trim(0)
+
+
+class Scrollback:
+    """
+    Ring buffer of the most recent daemon output of a session, addressed by
+    byte offset into everything the daemon sent. Text frames count as their
+    UTF-8 bytes, which is what a client counts as well.
+    """
+
+    def __init__(self, budget: ScrollbackBudget):
+        self.budget = budget
+        self.frames: deque[bytes] = deque()
+        self.start = 0  # Offset of the first byte kept.
+        self.end = 0  # Offset just past the last byte sent.
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+    def append(self, frame: str | bytes):
+        data = frame.encode() if isinstance(frame, str) else frame
+        self.frames.append(data)
+        self.end += len(data)
+        self.budget.size += len(data)
+
+        limit = self.budget.session_bytes
+        if self.budget.size > self.budget.total_bytes:
+            limit = min(limit, self.budget.fair_share())
+        if self.size > limit:
+            self.trim(limit)
+        # Sessions that went idle while over their share hold the rest.
+        if self.budget.size > self.budget.total_bytes:
+            self.budget.evict()
+
+    def trim(self, limit: int):
+        """
+        Drop the oldest bytes until at most limit are kept. A frame is cut
+        on a character boundary, past any UTF-8 continuation bytes, so what
+        is kept still decodes.
+        """
+        while self.frames and self.size > limit:
+            excess = self.size - limit
+            first = self.frames[0]
+            while excess < len(first) and first[excess] & 0xC0 == 0x80:
+                excess += 1
+            if len(first) <= excess:
+                self.frames.popleft()
+                dropped = len(first)
+            else:
+                self.frames[0] = first[excess:]
+                dropped = excess
+            self.start += dropped
+            self.budget.size -= dropped
+
+    def since(self, offset: int) -> bytes:
+        """
+        Everything from offset to the end. If offset was already trimmed,
+        from the oldest byte still kept instead.
+        """
+        offset = max(offset, self.start)
+        if offset >= self.end:
+            return b""
+
+        parts = []
+        position = self.end
+        # Walk back from the newest frame; resumes are usually near the end.
+        for frame in reversed(self.frames):
+            if position <= offset:
+                break
+            position -= len(frame)
+            parts.append(frame[max(offset - position, 0):])
+        parts.reverse()
+        return b"".join(parts)
@@ -1,9 +1,16 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import uuid
 import time
-import asyncio
 
 from easyshell_server.auth import AuthType
+from easyshell_server.expiry import ExpiryQueue
+from easyshell_server.metrics import LOCK_WAIT, TimedLock
+
+JOURNAL_REQUEST = "request"
+JOURNAL_CLAIM = "claim"
+JOURNAL_UNCLAIM = "unclaim"
+# A pending session that connected, closed or expired.
+JOURNAL_END = "end"
 
 
 @dataclass
@@ -19,12 +26,60 @@ class Session:
     auth_value: str
     timestamp: int
     status: str = STATUS_PENDING
+    # Lets viewers watch the session without being able to take it over
+    # with the secret.
+    viewer_token: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+
+def session_row(session: Session, claimed: bool) -> tuple:
+    """A pending session as a JSON-ready row, for snapshots and their journal."""
+    return (
+        session.secret,
+        str(session.client_id),
+        str(session.remote_id),
+        session.auth_type.value,
+        session.auth_value,
+        session.timestamp,
+        session.viewer_token,
+        claimed,
+    )
 
 
 class SessionManager:
     def __init__(self):
-        self.sessions: dict[Session] = {}
-        self.session_lock = asyncio.Lock()
+        self.sessions: dict[str, Session] = {}
+        # viewer_token -> secret, for every session in self.sessions.
+        self.viewer_tokens: dict[str, str] = {}
+        # remote_id -> {secret: session}, only for sessions still waiting
+        # for their daemon, in request order.
+        self.pending_by_remote: dict[uuid.UUID, dict[str, Session]] = {}
+        # PENDING and CLOSED sessions, the only ones cleanup_sessions reaps.
+        self.expiry: ExpiryQueue[str] = ExpiryQueue()
+        self.session_lock = TimedLock(LOCK_WAIT.labels("session_lock"))
+        # Set by a StateSnapshotter: changes to pending sessions since its
+        # last snapshot, as JOURNAL_* records, for it to write out.
+        self.journal: list[tuple] | None = None
+
+    def _log(self, *record):
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def _index_pending(self, session: Session):
+        self.pending_by_remote.setdefault(session.remote_id, {})[session.secret] = session
+
+    def _unindex_pending(self, session: Session):
+        pending = self.pending_by_remote.get(session.remote_id)
+        if pending is None:
+            return
+        pending.pop(session.secret, None)
+        if not pending:
+            del self.pending_by_remote[session.remote_id]
+
+    def _first_pending(self, remote_id: uuid.UUID):
+        pending = self.pending_by_remote.get(remote_id)
+        if not pending:
+            return None
+        return next(iter(pending.values()))
 
     async def session_request(
         self,
@@ -44,42 +99,83 @@ class SessionManager:
 
         async with self.session_lock:
             self.sessions[session.secret] = session
+            self.viewer_tokens[session.viewer_token] = session.secret
+            self._index_pending(session)
+            self.expiry.touch(session.secret, session.timestamp)
+            self._log(JOURNAL_REQUEST, *session_row(session, claimed=False))
 
         return session
 
     async def cleanup_sessions(self, timeout: int = 60) -> int:
         async with self.session_lock:
             now = int(time.time())
-            to_delete = [
-                s.secret
-                for s in self.sessions.values()
-                if (now - s.timestamp > timeout)
-                and s.status in {Session.STATUS_PENDING, Session.STATUS_CLOSED}
-            ]
+            to_delete = self.expiry.expire(now, timeout)
 
             for secret in to_delete:
-                del self.sessions[secret]
+                session = self.sessions.pop(secret)
+                self.viewer_tokens.pop(session.viewer_token, None)
+                self._unindex_pending(session)
+                if session.status == Session.STATUS_PENDING:
+                    self._log(JOURNAL_END, secret)
 
             return len(to_delete)
-        
-    async def remote_has_pending_session(self, heartbeat_id: uuid.UUID) -> bool:
+
+    async def next_expiry(self, timeout: int = 60) -> int | None:
+        """Earliest time at which cleanup_sessions will remove a session."""
+        return self.expiry.next_deadline(timeout)
+
+    async def claim_pending_session(self, remote_id: uuid.UUID):
+        """
+        Hand out the oldest pending session for a remote, if any.
+        A claimed session is handed out only once: it stays PENDING until its
+        daemon connects, and is reaped by cleanup_sessions if it never does.
+        """
         async with self.session_lock:
-            for session in self.sessions.values():
-                if session.remote_id == heartbeat_id and session.status == Session.STATUS_PENDING:
-                    return True
-            return False
-        
-    async def get_session_by_remote_id(self, remote_id: uuid.UUID):
+            session = self._first_pending(remote_id)
+            if session:
+                self._unindex_pending(session)
+                self._log(JOURNAL_CLAIM, session.secret)
+            return session
+
+    async def unclaim_session(self, session: Session):
+        """
+        Hand a claimed session out again, ahead of the remote's other pending
+        sessions, when it never reached its daemon.
+        """
         async with self.session_lock:
-            for session in self.sessions.values():
-                if session.remote_id == remote_id and session.status == Session.STATUS_PENDING:
-                    return session
-            return None
+            if self.sessions.get(session.secret) is not session or session.status != Session.STATUS_PENDING:
+                return
+            pending = self.pending_by_remote.get(session.remote_id, {})
+            self.pending_by_remote[session.remote_id] = {session.secret: session, **pending}
+            self._log(JOURNAL_UNCLAIM, session.secret)
+
+    async def claim_pending_sessions(self, remote_ids: list[uuid.UUID]) -> dict[uuid.UUID, Session]:
+        """
+        claim_pending_session for a whole batch of remotes under one
+        acquisition of the lock. Only remotes with a pending session appear
+        in the result.
+        """
+        async with self.session_lock:
+            if not self.pending_by_remote:
+                return {}
+            claimed = {}
+            for remote_id in remote_ids:
+                session = self._first_pending(remote_id)
+                if session:
+                    self._unindex_pending(session)
+                    self._log(JOURNAL_CLAIM, session.secret)
+                    claimed[remote_id] = session
+            return claimed
         
     async def start_session(self, secret: str):
         async with self.session_lock:
             session = self.sessions.get(secret)
-            if session:
+            # A session whose client already left cannot be started.
+            if session and session.status != Session.STATUS_CLOSED:
+                if session.status == Session.STATUS_PENDING:
+                    self._log(JOURNAL_END, secret)
+                self._unindex_pending(session)
+                self.expiry.discard(secret)
                 session.status = Session.STATUS_CONNECTED
                 session.timestamp = int(time.time())
                 return session
@@ -89,11 +185,48 @@ class SessionManager:
         async with self.session_lock:
             session = self.sessions.get(secret)
             if session:
+                if session.status == Session.STATUS_PENDING:
+                    self._log(JOURNAL_END, secret)
+                self._unindex_pending(session)
                 session.status = Session.STATUS_CLOSED
                 session.timestamp = int(time.time())
+                self.expiry.touch(secret, session.timestamp)
                 return session
             return None
         
     async def get_session(self, secret: str):
         async with self.session_lock:
-            return self.sessions.get(secret)
\ No newline at end of file
+            return self.sessions.get(secret)
+
+    async def get_session_by_viewer_token(self, viewer_token: str):
+        async with self.session_lock:
+            secret = self.viewer_tokens.get(viewer_token)
+            return self.sessions.get(secret) if secret else None
+
+    async def status_counts(self) -> dict[str, int]:
+        counts = dict.fromkeys((Session.STATUS_PENDING, Session.STATUS_CONNECTED, Session.STATUS_CLOSED), 0)
+        for session in list(self.sessions.values()):
+            counts[session.status] += 1
+        return counts
+
+    def checkpoint(self) -> list[tuple[Session, bool]]:
+        """
+        Every PENDING session and whether a daemon claimed it, for a snapshot
+        of the state. Only these outlive a restart: connected sessions lose
+        their websockets with it. Copied without awaiting, so consistent
+        without session_lock.
+        """
+        return [
+            (session, session.secret not in self.pending_by_remote.get(session.remote_id, ()))
+            for session in self.sessions.values()
+            if session.status == Session.STATUS_PENDING
+        ]
+
+    def restore(self, sessions: list[tuple[Session, bool]]):
+        """Load pending sessions saved by an earlier run, oldest first, before serving."""
+        for session, claimed in sessions:
+            self.sessions[session.secret] = session
+            self.viewer_tokens[session.viewer_token] = session.secret
+            if not claimed:
+                self._index_pending(session)
+            self.expiry.touch(session.secret, session.timestamp)
@@ -0,0 +1,279 @@
+import gc
+import os
+import glob
+import time
+import uuid
+import asyncio
+from itertools import islice
+from operator import itemgetter
+
+from sanic.log import logger
+
+from easyshell_server import fast_json
+from easyshell_server.heartbeat_manager import HeartbeatManager, Heartbeat, EVENT_JOIN, EVENT_LEAVE
+from easyshell_server.session_manager import (
+    SessionManager,
+    Session,
+    session_row,
+    JOURNAL_REQUEST,
+    JOURNAL_CLAIM,
+    JOURNAL_UNCLAIM,
+    JOURNAL_END,
+)
+from easyshell_server.validation.heartbeat import AUTH_TYPES
+
+SNAPSHOT_FORMAT = 2
+
+
+class StateSnapshotter:
+    """
+    Keeps the in-memory state across restarts: devices, so /session finds
+    them before they heartbeat again, and pending sessions, so requests made
+    just before a deploy still reach their daemon.
+
+    Every `interval` seconds the managers' checkpoints are copied on the
+    event loop, which takes no lock and never awaits, then serialized and
+    written to `path` in a thread, replacing the previous snapshot
+    atomically. In between, every `journal_interval` seconds, the changes
+    since (device joins and leaves from the change log, pending session
+    records from SessionManager.journal) are appended to a journal, so a
+    crash loses at most that much. 0 turns the journal off.
+
+    Journals are numbered by generation: the records after snapshot g was
+    taken go to path.journal.g, and are dropped once snapshot g + 1 is on
+    disk. load() replays every journal from the snapshot's generation on,
+    then starts a new one rather than append after a line a crash may have
+    torn; the first snapshot of the run folds them all.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        heartbeat_manager: HeartbeatManager,
+        session_manager: SessionManager,
+        interval: float = 10.0,
+        journal_interval: float = 0.2,
+    ):
+        self.path = path
+        self.heartbeat_manager = heartbeat_manager
+        self.session_manager = session_manager
+        self.interval = interval
+        self.journal_interval = journal_interval
+        self.generation = 0
+        # Version of the last device change written out.
+        self.journaled_version = 0
+        # Snapshots and journal appends go to disk one at a time, in order.
+        self._writing = asyncio.Lock()
+        if journal_interval:
+            session_manager.journal = []
+
+    def journal_path(self, generation: int) -> str:
+        return f"{self.path}.journal.{generation}"
+
+    async def load(self):
+        """Restore the state saved by the previous run, if any. Call before serving."""
+        started = time.perf_counter()
+        # Everything read is kept, so collections along the way, which a
+        # large fleet's worth of new objects would set off again and
+        # again, find nothing to free. Nothing is served yet to pause.
+        gc.disable()
+        try:
+            loaded = await asyncio.to_thread(self._read)
+            if loaded is not None:
+                self.generation, version, heartbeats, sessions = loaded
+                self.heartbeat_manager.restore(version, heartbeats)
+                self.session_manager.restore(sessions)
+        finally:
+            gc.enable()
+        if loaded is not None:
+            logger.info(
+                f"Restored {len(heartbeats)} devices and {len(sessions)} pending sessions "
+                f"in {time.perf_counter() - started:.3f}s."
+            )
+        self.generation += 1
+        self.journaled_version = self.heartbeat_manager.version
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = fast_json.loads(f.read())
+        except FileNotFoundError:
+            snapshot = {"format": SNAPSHOT_FORMAT, "generation": 0, "device_version": 0, "devices": [], "sessions": []}
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot read the state snapshot at {self.path}, starting empty: {e}")
+            self._set_aside()
+            return None
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            logger.error(f"Unknown state snapshot format {snapshot.get('format')}, starting empty.")
+            self._set_aside()
+            return None
+
+        generation = snapshot["generation"]
+        version = snapshot["device_version"]
+        devices = {row[0]: row for row in snapshot["devices"]}
+        sessions = {row[0]: row for row in snapshot["sessions"]}
+
+        journals = sorted(
+            (int(path.rsplit(".", 1)[1]), path)
+            for path in glob.glob(glob.escape(self.path) + ".journal.*")
+            if path.rsplit(".", 1)[1].isdigit()
+        )
+        for journal_generation, path in journals:
+            if journal_generation < generation:
+                continue
+            generation = journal_generation
+            for record in self._read_journal(path):
+                kind = record[0]
+                if kind == EVENT_JOIN:
+                    _, change_version, device_id, auth_type, timestamp = record
+                    devices[device_id] = [device_id, auth_type, timestamp, change_version]
+                    version = max(version, change_version)
+                elif kind == EVENT_LEAVE:
+                    devices.pop(record[2], None)
+                    version = max(version, record[1])
+                elif kind == JOURNAL_REQUEST:
+                    sessions[record[1]] = record[1:]
+                elif kind == JOURNAL_CLAIM and record[1] in sessions:
+                    sessions[record[1]][-1] = True
+                elif kind == JOURNAL_UNCLAIM and record[1] in sessions:
+                    sessions[record[1]][-1] = False
+                elif kind == JOURNAL_END:
+                    sessions.pop(record[1], None)
+
+        # Still in join order: the snapshot's devices are, and a device only
+        # joins again after leaving, which takes it out of the dict.
+        heartbeats = [
+            Heartbeat(uuid.UUID(device_id), AUTH_TYPES[auth_type], timestamp, seq)
+            for device_id, auth_type, timestamp, seq in devices.values()
+        ]
+        restored_sessions = [
+            (
+                Session(
+                    secret=secret,
+                    client_id=uuid.UUID(client_id),
+                    remote_id=uuid.UUID(remote_id),
+                    auth_type=AUTH_TYPES[auth_type],
+                    auth_value=auth_value,
+                    timestamp=timestamp,
+                    viewer_token=viewer_token,
+                ),
+                claimed,
+            )
+            for secret, client_id, remote_id, auth_type, auth_value, timestamp, viewer_token, claimed in sorted(
+                sessions.values(), key=itemgetter(5)
+            )
+        ]
+        return generation, version, heartbeats, restored_sessions
+
+    def _set_aside(self):
+        """
+        Keep a snapshot that cannot be loaded, and the journals that went on
+        top of it, for inspection rather than overwrite them.
+        """
+        for path in [self.path, *glob.glob(glob.escape(self.path) + ".journal.*")]:
+            try:
+                os.replace(path, f"{path}.bad")
+            except OSError:
+                pass
+
+    @staticmethod
+    def _read_journal(path: str):
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    yield fast_json.loads(line)
+                except ValueError:
+                    # The last line of a crash may be torn.
+                    logger.warning(f"Skipping the rest of journal {path} from a bad record.")
+                    return
+
+    async def run(self):
+        """Snapshot every interval and write the journal in between, until cancelled."""
+        loop = asyncio.get_running_loop()
+        next_snapshot = loop.time() + self.interval
+        while True:
+            await asyncio.sleep(min(self.journal_interval or self.interval, max(next_snapshot - loop.time(), 0)))
+            try:
+                if loop.time() >= next_snapshot:
+                    await self.snapshot()
+                    next_snapshot = loop.time() + self.interval
+                elif self.journal_interval and not await self.flush_journal():
+                    # The change log moved on too far to journal from.
+                    await self.snapshot()
+                    next_snapshot = loop.time() + self.interval
+            except OSError as e:
+                logger.error(f"Error saving the state to {self.path}: {e}")
+
+    async def flush_journal(self) -> bool:
+        """Append the changes since the last flush to the journal. False if some are no longer known."""
+        async with self._writing:
+            return await self._flush_journal()
+
+    async def _flush_journal(self) -> bool:
+        hm = self.heartbeat_manager
+        oldest = hm.version - len(hm.changes)
+        if self.journaled_version < oldest:
+            return False
+        records = [
+            (event, version, str(device_id), auth_type, timestamp)
+            for version, event, device_id, auth_type, timestamp in islice(hm.changes, self.journaled_version - oldest, None)
+        ]
+        self.journaled_version = hm.version
+        if self.session_manager.journal:
+            records += self.session_manager.journal
+            self.session_manager.journal = []
+        if records:
+            await asyncio.to_thread(self._append, self.journal_path(self.generation), records)
+        return True
+
+    @staticmethod
+    def _append(path: str, records: list[tuple]):
+        with open(path, "ab") as f:
+            f.write(b"".join(fast_json.dumps(record) + b"\n" for record in records))
+
+    async def snapshot(self):
+        async with self._writing:
+            if self.journal_interval:
+                # Should this snapshot not make it to disk, the previous one
+                # and its journal still have everything up to here.
+                await self._flush_journal()
+            # Copied in one go on the loop; everything after goes to the
+            # next generation's journal.
+            version, devices = self.heartbeat_manager.checkpoint()
+            sessions = self.session_manager.checkpoint()
+            self.journaled_version = version
+            if self.session_manager.journal is not None:
+                self.session_manager.journal = []
+            self.generation += 1
+            started = time.perf_counter()
+            await asyncio.to_thread(self._write, self.generation, version, devices, sessions)
+            logger.debug(
+                f"Saved {len(devices)} devices and {len(sessions)} pending sessions "
+                f"in {time.perf_counter() - started:.3f}s."
+            )
+
+    def _write(self, generation: int, version: int, devices: list[Heartbeat], sessions: list[tuple[Session, bool]]):
+        body = fast_json.dumps({
+            "format": SNAPSHOT_FORMAT,
+            "generation": generation,
+            "device_version": version,
+            "devices": [(str(hb.client_id), hb.auth_type.value, hb.timestamp, hb.seq) for hb in devices],
+            "sessions": [session_row(session, claimed) for session, claimed in sessions],
+        })
+        partial_path = f"{self.path}.partial"
+        # Sessions carry their auth values.
+        fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial_path, self.path)
+
+        for path in glob.glob(glob.escape(self.path) + ".journal.*"):
+            suffix = path.rsplit(".", 1)[1]
+            if suffix.isdigit() and int(suffix) < generation:
+                os.remove(path)
+
+    async def close(self):
+        """Take a last snapshot, e.g. as the server stops for a deploy."""
+        await self.snapshot()
@@ -0,0 +1,502 @@
+import time
+import uuid
+import sqlite3
+import asyncio
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from easyshell_server.auth import AuthType
+from easyshell_server.heartbeat_manager import (
+    Heartbeat,
+    EVENT_JOIN,
+    EVENT_LEAVE,
+    CHANGE_LOG_SIZE,
+    device_dict,
+    change_dict,
+)
+from easyshell_server.session_manager import Session
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS heartbeats (
+    id TEXT PRIMARY KEY,
+    auth_type TEXT NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS heartbeats_timestamp ON heartbeats (timestamp);
+
+CREATE TABLE IF NOT EXISTS device_changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    event TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    auth_type TEXT NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    secret TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    remote_id TEXT NOT NULL,
+    auth_type TEXT NOT NULL,
+    auth_value TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    claimed INTEGER NOT NULL DEFAULT 0,
+    viewer_token TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_pending ON sessions (remote_id, status, claimed);
+CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (status, timestamp);
+
+CREATE TABLE IF NOT EXISTS relay_legs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    secret TEXT NOT NULL,
+    side TEXT NOT NULL,
+    address TEXT NOT NULL,
+    UNIQUE (secret, side)
+);
+
+CREATE TABLE IF NOT EXISTS control_channels (
+    device_id TEXT PRIMARY KEY,
+    address TEXT NOT NULL
+);
+"""
+
+EXPIRABLE_STATUSES = (Session.STATUS_PENDING, Session.STATUS_CLOSED)
+
+# How often wait_for_change looks for changes made by any worker.
+CHANGE_POLL_INTERVAL = 1.0
+
+
+class SqliteStore:
+    """
+    A sqlite database shared by every worker on the host. Each process
+    talks to it through one connection owned by a single thread, so queries
+    (and waits on other workers' write locks) never block the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        if "viewer_token" not in {row[1] for row in connection.execute("PRAGMA table_info(sessions)")}:
+            # A database from before viewer tokens. Its sessions are
+            # short-lived, so those just cannot be watched.
+            connection.execute("ALTER TABLE sessions ADD COLUMN viewer_token TEXT")
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_viewer_token ON sessions (viewer_token)")
+        return connection
+
+    def _call(self, fn, args):
+        if self._connection is None:
+            self._connection = self._connect()
+        return fn(self._connection, *args)
+
+    async def run(self, fn, *args):
+        """Run fn(connection, *args) on the store's thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args)
+
+
+def _transaction(connection: sqlite3.Connection, fn, *args):
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(connection, *args)
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+    return result
+
+
+def _join(connection: sqlite3.Connection, rows: list[tuple[str, int, str]]):
+    """Upsert (auth_type, timestamp, id) rows, logging a join for each new device."""
+    connection.executemany(
+        "INSERT INTO device_changes (event, device_id, auth_type, timestamp) "
+        "SELECT ?1, ?4, ?2, ?3 WHERE NOT EXISTS (SELECT 1 FROM heartbeats WHERE id = ?4)",
+        [(EVENT_JOIN, *row) for row in rows],
+    )
+    connection.executemany(
+        "INSERT INTO heartbeats (auth_type, timestamp, id) VALUES (?, ?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET auth_type = excluded.auth_type, timestamp = excluded.timestamp",
+        rows,
+    )
+
+
+class SqliteHeartbeatManager:
+    """
+    HeartbeatManager with its state in a SqliteStore. Devices page in rowid
+    order, and the change log is the device_changes table, whose
+    AUTOINCREMENT key is the version.
+    """
+
+    def __init__(self, store: SqliteStore):
+        self.store = store
+
+    async def heartbeat(self, client_id: uuid.UUID, auth_type: AuthType):
+        row = (auth_type.value, int(time.time()), str(client_id))
+
+        def beat(connection):
+            # Known devices, i.e. nearly every heartbeat, take one statement.
+            if connection.execute("UPDATE heartbeats SET auth_type = ?, timestamp = ? WHERE id = ?", row).rowcount:
+                return
+            _transaction(connection, _join, [row])
+
+        await self.store.run(beat)
+
+    async def heartbeat_many(self, heartbeats: list[tuple[uuid.UUID, AuthType]]):
+        timestamp = int(time.time())
+        rows = [(auth_type.value, timestamp, str(client_id)) for client_id, auth_type in heartbeats]
+        await self.store.run(lambda c: _transaction(c, _join, rows))
+
+    async def cleanup_heartbeats(self, timeout: int = 60):
+        """Remove heartbeats older than the timeout."""
+        now = int(time.time())
+
+        def cleanup(connection):
+            connection.execute(
+                "INSERT INTO device_changes (event, device_id, auth_type, timestamp) "
+                "SELECT ?, id, auth_type, ? FROM heartbeats WHERE timestamp < ?",
+                (EVENT_LEAVE, now, now - timeout),
+            )
+            connection.execute(
+                "DELETE FROM device_changes WHERE version <= (SELECT MAX(version) FROM device_changes) - ?",
+                (CHANGE_LOG_SIZE,),
+            )
+            return connection.execute("DELETE FROM heartbeats WHERE timestamp < ?", (now - timeout,)).rowcount
+
+        return await self.store.run(lambda c: _transaction(c, cleanup))
+
+    async def next_expiry(self, timeout: int = 60) -> int | None:
+        """Earliest time at which cleanup_heartbeats will remove a device."""
+        oldest = await self.store.run(
+            lambda c: c.execute("SELECT MIN(timestamp) FROM heartbeats").fetchone()[0]
+        )
+        return None if oldest is None else oldest + timeout + 1
+
+    async def list_devices(
+        self,
+        cursor: int = 0,
+        limit: int | None = None,
+        auth_type: AuthType | None = None,
+        seen_after: int | None = None,
+        seen_before: int | None = None,
+    ) -> tuple[list[dict], int | None]:
+        conditions, args = ["rowid > ?"], [cursor]
+        if auth_type is not None:
+            conditions.append("auth_type = ?")
+            args.append(auth_type.value)
+        if seen_after is not None:
+            conditions.append("timestamp >= ?")
+            args.append(seen_after)
+        if seen_before is not None:
+            conditions.append("timestamp < ?")
+            args.append(seen_before)
+        args.append(-1 if limit is None else limit)
+
+        rows = await self.store.run(
+            lambda c: c.execute(
+                "SELECT rowid, id, auth_type, timestamp FROM heartbeats "
+                f"WHERE {' AND '.join(conditions)} ORDER BY rowid LIMIT ?",
+                args,
+            ).fetchall()
+        )
+        next_cursor = rows[-1][0] if rows and len(rows) == limit else None
+        return [device_dict(*row[1:]) for row in rows], next_cursor
+
+    @staticmethod
+    def _version(connection: sqlite3.Connection) -> int:
+        row = connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'device_changes'").fetchone()
+        return 0 if row is None else row[0]
+
+    async def current_version(self) -> int:
+        return await self.store.run(self._version)
+
+    async def changes_since(self, version: int) -> list[dict] | None:
+        def read(connection):
+            current = self._version(connection)
+            oldest = connection.execute("SELECT MIN(version) FROM device_changes").fetchone()[0]
+            if version > current or (oldest is not None and version < oldest - 1):
+                return None
+            return connection.execute(
+                "SELECT version, event, device_id, auth_type, timestamp FROM device_changes "
+                "WHERE version > ? ORDER BY version",
+                (version,),
+            ).fetchall()
+
+        rows = await self.store.run(read)
+        return None if rows is None else [change_dict(*row) for row in rows]
+
+    async def wait_for_change(self, version: int, timeout: float):
+        """Poll, since changes may come from any worker sharing the store."""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while await self.current_version() == version:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(CHANGE_POLL_INTERVAL, remaining))
+
+    async def count(self) -> int:
+        return await self.store.run(lambda c: c.execute("SELECT COUNT(*) FROM heartbeats").fetchone()[0])
+
+    async def find_by_remote_id(self, remote_id: uuid.UUID):
+        row = await self.store.run(
+            lambda c: c.execute(
+                "SELECT auth_type, timestamp FROM heartbeats WHERE id = ?", (str(remote_id),)
+            ).fetchone()
+        )
+        if row is None:
+            raise ValueError("Device not found.")
+        return Heartbeat(client_id=remote_id, auth_type=AuthType(row[0]), timestamp=row[1])
+
+
+SESSION_COLUMNS = "secret, client_id, remote_id, auth_type, auth_value, timestamp, status, viewer_token"
+
+
+def _session_from_row(row) -> Session | None:
+    if row is None:
+        return None
+    secret, client_id, remote_id, auth_type, auth_value, timestamp, status, viewer_token = row
+    return Session(
+        secret=secret,
+        client_id=uuid.UUID(client_id),
+        remote_id=uuid.UUID(remote_id),
+        auth_type=AuthType(auth_type),
+        auth_value=auth_value,
+        timestamp=timestamp,
+        status=status,
+        viewer_token=viewer_token,
+    )
+
+
+class SqliteSessionManager:
+    """SessionManager with its state in a SqliteStore."""
+
+    def __init__(self, store: SqliteStore):
+        self.store = store
+
+    async def session_request(
+        self,
+        client_id: uuid.UUID,
+        remote_id: uuid.UUID,
+        auth_type: AuthType,
+        auth_value: str,
+    ):
+        session = Session(
+            secret=str(uuid.uuid4()),
+            client_id=client_id,
+            remote_id=remote_id,
+            auth_type=auth_type,
+            auth_value=auth_value,
+            timestamp=int(time.time()),
+        )
+        await self.store.run(
+            lambda c: c.execute(
+                f"INSERT INTO sessions ({SESSION_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    session.secret,
+                    str(client_id),
+                    str(remote_id),
+                    auth_type.value,
+                    auth_value,
+                    session.timestamp,
+                    session.status,
+                    session.viewer_token,
+                ),
+            )
+        )
+        return session
+
+    async def cleanup_sessions(self, timeout: int = 60) -> int:
+        oldest_alive = int(time.time()) - timeout
+        return await self.store.run(
+            lambda c: c.execute(
+                "DELETE FROM sessions WHERE status IN (?, ?) AND timestamp < ?",
+                (*EXPIRABLE_STATUSES, oldest_alive),
+            ).rowcount
+        )
+
+    async def next_expiry(self, timeout: int = 60) -> int | None:
+        """Earliest time at which cleanup_sessions will remove a session."""
+        oldest = await self.store.run(
+            lambda c: c.execute(
+                "SELECT MIN(timestamp) FROM sessions WHERE status IN (?, ?)", EXPIRABLE_STATUSES
+            ).fetchone()[0]
+        )
+        return None if oldest is None else oldest + timeout + 1
+
+    @staticmethod
+    def _first_pending(connection: sqlite3.Connection, remote_id: uuid.UUID):
+        return connection.execute(
+            f"SELECT {SESSION_COLUMNS} FROM sessions "
+            "WHERE remote_id = ? AND status = ? AND claimed = 0 ORDER BY rowid LIMIT 1",
+            (str(remote_id), Session.STATUS_PENDING),
+        ).fetchone()
+
+    async def claim_pending_session(self, remote_id: uuid.UUID):
+        """
+        Hand out the oldest pending session for a remote, if any, once across
+        every worker sharing the store.
+        """
+        def claim(connection):
+            row = self._first_pending(connection, remote_id)
+            if row is not None:
+                connection.execute("UPDATE sessions SET claimed = 1 WHERE secret = ?", (row[0],))
+            return row
+
+        return _session_from_row(
+            await self.store.run(lambda c: _transaction(c, claim))
+        )
+
+    async def unclaim_session(self, session: Session):
+        """
+        Hand a claimed session out again when it never reached its daemon.
+        Claims go in request order, so it is the remote's next one again.
+        """
+        await self.store.run(
+            lambda c: c.execute(
+                "UPDATE sessions SET claimed = 0 WHERE secret = ? AND status = ?",
+                (session.secret, Session.STATUS_PENDING),
+            )
+        )
+
+    async def claim_pending_sessions(self, remote_ids: list[uuid.UUID]) -> dict[uuid.UUID, Session]:
+        """
+        claim_pending_session for a whole batch of remotes in one transaction.
+        Unclaimed pending sessions are few, so this reads all of them rather
+        than querying per remote.
+        """
+        wanted = {str(remote_id) for remote_id in remote_ids}
+
+        def claim(connection):
+            rows = {}
+            for row in connection.execute(
+                f"SELECT {SESSION_COLUMNS} FROM sessions WHERE status = ? AND claimed = 0 ORDER BY rowid",
+                (Session.STATUS_PENDING,),
+            ):
+                if row[2] in wanted and row[2] not in rows:
+                    rows[row[2]] = row
+            connection.executemany(
+                "UPDATE sessions SET claimed = 1 WHERE secret = ?", [(row[0],) for row in rows.values()]
+            )
+            return list(rows.values())
+
+        sessions = map(_session_from_row, await self.store.run(lambda c: _transaction(c, claim)))
+        return {session.remote_id: session for session in sessions}
+
+    async def _set_status(self, secret: str, status: str, unless_status: str | None = None):
+        def update(connection):
+            changed = connection.execute(
+                "UPDATE sessions SET status = ?, timestamp = ? WHERE secret = ? AND status IS NOT ?",
+                (status, int(time.time()), secret, unless_status),
+            ).rowcount
+            if not changed:
+                return None
+            return connection.execute(
+                f"SELECT {SESSION_COLUMNS} FROM sessions WHERE secret = ?", (secret,)
+            ).fetchone()
+
+        return _session_from_row(await self.store.run(lambda c: _transaction(c, update)))
+
+    async def start_session(self, secret: str):
+        # A session whose client already left cannot be started.
+        return await self._set_status(
+            secret, Session.STATUS_CONNECTED, unless_status=Session.STATUS_CLOSED
+        )
+
+    async def close_session(self, secret: str):
+        return await self._set_status(secret, Session.STATUS_CLOSED)
+
+    async def get_session(self, secret: str):
+        return _session_from_row(
+            await self.store.run(
+                lambda c: c.execute(
+                    f"SELECT {SESSION_COLUMNS} FROM sessions WHERE secret = ?", (secret,)
+                ).fetchone()
+            )
+        )
+
+    async def get_session_by_viewer_token(self, viewer_token: str):
+        return _session_from_row(
+            await self.store.run(
+                lambda c: c.execute(
+                    f"SELECT {SESSION_COLUMNS} FROM sessions WHERE viewer_token = ?", (viewer_token,)
+                ).fetchone()
+            )
+        )
+
+    async def status_counts(self) -> dict[str, int]:
+        rows = await self.store.run(
+            lambda c: c.execute("SELECT status, COUNT(*) FROM sessions GROUP BY status").fetchall()
+        )
+        counts = dict.fromkeys((Session.STATUS_PENDING, Session.STATUS_CONNECTED, Session.STATUS_CLOSED), 0)
+        counts.update(rows)
+        return counts
+
+
+@dataclass(slots=True)
+class RelayLeg:
+    id: int
+    address: str
+
+
+class SqliteRoutingTable:
+    """
+    Which worker holds each relay leg and each daemon control channel, by the
+    address of that worker's peer relay listener.
+    """
+
+    def __init__(self, store: SqliteStore):
+        self.store = store
+
+    async def register_leg(self, secret: str, side: str, address: str) -> int:
+        return await self.store.run(
+            lambda c: c.execute(
+                # REPLACE gives a re-registered leg a fresh, higher id.
+                "INSERT OR REPLACE INTO relay_legs (secret, side, address) VALUES (?, ?, ?) RETURNING id",
+                (secret, side, address),
+            ).fetchone()[0]
+        )
+
+    async def find_leg(self, secret: str, side: str) -> RelayLeg | None:
+        row = await self.store.run(
+            lambda c: c.execute(
+                "SELECT id, address FROM relay_legs WHERE secret = ? AND side = ?", (secret, side)
+            ).fetchone()
+        )
+        return None if row is None else RelayLeg(id=row[0], address=row[1])
+
+    async def unregister_leg(self, secret: str, side: str, address: str):
+        await self.store.run(
+            lambda c: c.execute(
+                "DELETE FROM relay_legs WHERE secret = ? AND side = ? AND address = ?",
+                (secret, side, address),
+            )
+        )
+
+    async def register_channel(self, device_id: uuid.UUID, address: str):
+        await self.store.run(
+            lambda c: c.execute(
+                "INSERT INTO control_channels (device_id, address) VALUES (?, ?) "
+                "ON CONFLICT (device_id) DO UPDATE SET address = excluded.address",
+                (str(device_id), address),
+            )
+        )
+
+    async def find_channel(self, device_id: uuid.UUID) -> str | None:
+        row = await self.store.run(
+            lambda c: c.execute(
+                "SELECT address FROM control_channels WHERE device_id = ?", (str(device_id),)
+            ).fetchone()
+        )
+        return None if row is None else row[0]
+
+    async def unregister_channel(self, device_id: uuid.UUID, address: str):
+        await self.store.run(
+            lambda c: c.execute(
+                "DELETE FROM control_channels WHERE device_id = ? AND address = ?",
+                (str(device_id), address),
+            )
+        )
@@ -0,0 +1,32 @@
+from easyshell_server.heartbeat_manager import HeartbeatManager
+from easyshell_server.session_manager import SessionManager
+
+BACKEND_MEMORY = "memory"
+BACKEND_SQLITE_PREFIX = "sqlite://"
+
+
+def create_state(backend: str = BACKEND_MEMORY):
+    """
+    Build the heartbeat manager, the session manager and the relay routing
+    table for a STATE_BACKEND setting:
+
+    - "memory": state lives in this process; one worker only. There is no
+      routing table, since both relay legs always land on the same worker.
+    - "sqlite:///path/to/state.db": state is shared by every worker that
+      opens the same file, and relay legs are routed between workers.
+    """
+    if backend == BACKEND_MEMORY:
+        return HeartbeatManager(), SessionManager(), None
+
+    if backend.startswith(BACKEND_SQLITE_PREFIX):
+        from easyshell_server.sqlite_state import (
+            SqliteStore,
+            SqliteHeartbeatManager,
+            SqliteSessionManager,
+            SqliteRoutingTable,
+        )
+
+        store = SqliteStore(backend.removeprefix(BACKEND_SQLITE_PREFIX))
+        return SqliteHeartbeatManager(store), SqliteSessionManager(store), SqliteRoutingTable(store)
+
+    raise ValueError(f"Unsupported state backend: {backend}")
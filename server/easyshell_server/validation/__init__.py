@@ -1,3 +1,4 @@
-from .heartbeat import HeartbeatSchema
+from .heartbeat import HeartbeatSchema, HeartbeatBatchSchema, parse_heartbeat, parse_heartbeats
+from .devices import DeviceQuerySchema
 
-__all__ = ["HeartbeatSchema"]
+__all__ = ["HeartbeatSchema", "HeartbeatBatchSchema", "parse_heartbeat", "parse_heartbeats", "DeviceQuerySchema"]
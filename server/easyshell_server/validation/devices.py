@@ -0,0 +1,16 @@
+from pydantic import BaseModel, Field
+from easyshell_server.auth import AuthType
+
+# Devices per page of /devices.
+MAX_PAGE_SIZE = 5_000
+
+
+class DeviceQuerySchema(BaseModel):
+    """Query of GET /devices. Without a limit, every matching device is listed."""
+
+    cursor: int = Field(0, ge=0)
+    limit: int | None = Field(None, ge=1, le=MAX_PAGE_SIZE)
+    auth_type: AuthType | None = None
+    # Last heartbeat at or after / before these Unix times.
+    seen_after: int | None = None
+    seen_before: int | None = None
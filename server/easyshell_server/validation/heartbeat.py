@@ -1,7 +1,17 @@
 import uuid
-from pydantic import BaseModel, field_validator
+from functools import lru_cache
+
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, field_validator
 from easyshell_server.auth import AuthType
 
+# Enough to keep every device of a large fleet parsed.
+DEVICE_ID_CACHE_SIZE = 1 << 17
+
+# Devices per /heartbeats request.
+MAX_BATCH_SIZE = 10_000
+
+AUTH_TYPES = {auth_type.value: auth_type for auth_type in AuthType}
+
 
 class HeartbeatSchema(BaseModel):
     id: uuid.UUID
@@ -13,3 +23,61 @@ class HeartbeatSchema(BaseModel):
         if not v:
             raise ValueError("auth_type must be a non-empty string")
         return v
+
+
+class HeartbeatBatchSchema(BaseModel):
+    devices: list[HeartbeatSchema] = Field(max_length=MAX_BATCH_SIZE)
+
+
+_uuid_adapter = TypeAdapter(uuid.UUID)
+
+
+@lru_cache(maxsize=DEVICE_ID_CACHE_SIZE)
+def _device_id(raw: str) -> uuid.UUID:
+    return _uuid_adapter.validate_python(raw)
+
+
+def _parse_common(data) -> tuple[uuid.UUID, AuthType] | None:
+    """(id, auth_type) for a heartbeat of the common shape, None for anything else."""
+    if type(data) is dict:
+        raw_id = data.get("id")
+        raw_auth_type = data.get("auth_type")
+        auth_type = AUTH_TYPES.get(raw_auth_type) if type(raw_auth_type) is str else None
+        if type(raw_id) is str and auth_type is not None:
+            try:
+                return _device_id(raw_id), auth_type
+            except ValidationError:
+                pass
+    return None
+
+
+def parse_heartbeat(data) -> tuple[uuid.UUID, AuthType]:
+    """
+    Validate a decoded heartbeat body into (id, auth_type).
+
+    Daemons send the same id every few seconds, so ids are parsed once and
+    cached, and auth types are a dict lookup. Anything off the common shape
+    goes through HeartbeatSchema, which raises the usual ValidationError.
+    """
+    parsed = _parse_common(data)
+    if parsed is not None:
+        return parsed
+    heartbeat = HeartbeatSchema.model_validate(data)
+    return heartbeat.id, heartbeat.auth_type
+
+
+def parse_heartbeats(data) -> list[tuple[uuid.UUID, AuthType]]:
+    """
+    Validate a decoded /heartbeats body, {"devices": [heartbeat, ...]}, into
+    a list of (id, auth_type). Same fast path as parse_heartbeat per device;
+    if any of them is off, the whole batch goes through HeartbeatBatchSchema
+    so the errors point at the offending entries.
+    """
+    if type(data) is dict:
+        devices = data.get("devices")
+        if type(devices) is list and len(devices) <= MAX_BATCH_SIZE:
+            parsed = [_parse_common(device) for device in devices]
+            if None not in parsed:
+                return parsed
+    batch = HeartbeatBatchSchema.model_validate(data)
+    return [(heartbeat.id, heartbeat.auth_type) for heartbeat in batch.devices]
@@ -0,0 +1,162 @@
+import asyncio
+from collections import deque
+
+from sanic.log import logger
+from websockets.frames import Frame, Opcode
+from websockets.protocol import State
+
+from easyshell_server.metrics import VIEWERS_DROPPED
+
+# Close code for a viewer dropped for falling behind: try again later.
+CLOSE_TRY_AGAIN_LATER = 1013
+
+VIEWERS_DROPPED_SLOW = VIEWERS_DROPPED.labels()
+
+
+def encode_frame(frame: str | bytes) -> bytes:
+    """
+    A server websocket frame carrying frame. Server frames are unmasked and
+    these go without RSV1, i.e. uncompressed, which is valid whether or not
+    a viewer negotiated permessage-deflate, so the same bytes serve every
+    viewer's connection.
+    """
+    if isinstance(frame, str):
+        return Frame(Opcode.TEXT, frame.encode()).serialize(mask=False)
+    return Frame(Opcode.BINARY, frame).serialize(mask=False)
+
+
+async def send_encoded(ws, frame: str | bytes, encoded: bytes):
+    """
+    Write a frame encoded by encode_frame straight to a Sanic websocket's
+    transport. Sockets that are not Sanic websockets, such as a PeerSocket
+    to another worker, are sent the frame itself.
+    """
+    io_proto = getattr(ws, "io_proto", None)
+    if io_proto is None:
+        await ws.send(frame)
+        return
+    async with ws.conn_mutex:
+        if ws.ws_proto.state is not State.OPEN:
+            raise ConnectionError("Viewer websocket is closed.")
+        # Waits while the transport is paused, i.e. this viewer is slow.
+        await io_proto.send(encoded)
+
+
+async def discard_input(ws):
+    """Read and ignore whatever a read-only viewer sends, until it leaves."""
+    while True:
+        await ws.recv()
+
+
+class Viewer:
+    __slots__ = ("ws", "position", "dropped", "writer")
+
+    def __init__(self, ws, position: int):
+        self.ws = ws
+        # Sequence number of the next frame to send.
+        self.position = position
+        self.dropped = False
+        self.writer: asyncio.Task | None = None
+
+    def drop(self):
+        """Stop sending to this viewer, even in the middle of a blocked send."""
+        self.dropped = True
+        VIEWERS_DROPPED_SLOW.inc()
+        if self.writer is not None:
+            self.writer.cancel()
+
+
+class ViewerFanout:
+    """
+    Daemon output of one session, shared by its read-only viewers.
+
+    Each frame is encoded once and appended to a single log; every viewer
+    has a position in it and a writer of its own. The log is trimmed
+    behind the slowest viewer and never holds more than max_lag_bytes: a
+    viewer that far behind is dropped, so a slow viewer holds up neither
+    the client, the daemon nor the other viewers.
+    """
+
+    def __init__(self, max_lag_bytes: int):
+        self.max_lag_bytes = max_lag_bytes
+        self.frames: deque[tuple[str | bytes, bytes]] = deque()
+        self.start = 0  # Sequence number of frames[0].
+        self.size = 0
+        self.viewers: set[Viewer] = set()
+        self.closed = False
+        self._appended = asyncio.Event()
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.frames)
+
+    def publish(self, frame: str | bytes):
+        if not self.viewers:
+            return
+        encoded = encode_frame(frame)
+        self.frames.append((frame, encoded))
+        self.size += len(encoded)
+        self._wake()
+        self._trim()
+
+    def _wake(self):
+        # Writers hold on to the event they started waiting on.
+        self._appended.set()
+        self._appended = asyncio.Event()
+
+    def _trim(self):
+        while self.size > self.max_lag_bytes:
+            self._pop()
+        for viewer in self.viewers:
+            if viewer.position < self.start and not viewer.dropped:
+                viewer.drop()
+        oldest = min((viewer.position for viewer in self.viewers if not viewer.dropped), default=self.end)
+        while self.start < oldest:
+            self._pop()
+
+    def _pop(self):
+        _, encoded = self.frames.popleft()
+        self.size -= len(encoded)
+        self.start += 1
+
+    async def watch(self, ws, backlog: bytes = b""):
+        """
+        Send ws the backlog, then the output from now on, until it leaves,
+        falls too far behind or the session ends.
+        """
+        viewer = Viewer(ws, self.end)
+        self.viewers.add(viewer)
+        writer = viewer.writer = asyncio.create_task(self._write(viewer, backlog))
+        reader = asyncio.create_task(discard_input(ws))
+        try:
+            await asyncio.wait([writer, reader], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            writer.cancel()
+            reader.cancel()
+            await asyncio.gather(writer, reader, return_exceptions=True)
+            self.viewers.discard(viewer)
+            self._trim()
+
+        if viewer.dropped:
+            logger.info("Dropped a viewer that fell behind.")
+            await ws.close(CLOSE_TRY_AGAIN_LATER, "Too far behind.")
+        elif self.closed:
+            await ws.close()
+
+    async def _write(self, viewer: Viewer, backlog: bytes):
+        if backlog:
+            await viewer.ws.send(backlog.decode(errors="replace"))
+        while not self.closed:
+            appended = self._appended
+            while viewer.position < self.end:
+                frame, encoded = self.frames[viewer.position - self.start]
+                viewer.position += 1
+                await send_encoded(viewer.ws, frame, encoded)
+            self._trim()
+            if viewer.position >= self.end:
+                await appended.wait()
+
+    def close(self):
+        """End every viewer's watch, as the session is over."""
+        self.closed = True
+        self._wake()
@@ -1,37 +1,120 @@
 import os
+import time
+import uuid
 import asyncio
 from typing import Type, Callable
-from functools import wraps
-from collections import defaultdict
+from functools import wraps, partial
 
 from dotenv import load_dotenv
 from sanic import Sanic, Request, response
-from sanic.response import json
+from sanic.response import json, HTTPResponse
+from sanic.exceptions import BadRequest, WebsocketClosed
 from sanic.log import logger
 
 from sanic_ext import Extend
 
 from pydantic import BaseModel, ValidationError
+from websockets.exceptions import ConnectionClosed
 
-from easyshell_server.validation.heartbeat import HeartbeatSchema
+from easyshell_server.validation.heartbeat import HeartbeatSchema, parse_heartbeat, parse_heartbeats
+from easyshell_server import fast_json
 from easyshell_server.validation.session_request import SessionRequestSchema
-from easyshell_server.session_manager import SessionManager
-from easyshell_server.heartbeat_manager import HeartbeatManager
+from easyshell_server.validation.devices import DeviceQuerySchema
+from easyshell_server.state import create_state
+from easyshell_server.session_manager import Session
+from easyshell_server.relay import RelayManager, CLIENT, DAEMON
+from easyshell_server.control_channel import ControlChannelManager
+from easyshell_server.peer_relay import PeerRouter
+from easyshell_server.mux import MuxConnection, MuxChannelClosed
+from easyshell_server.compression import enable_websocket_compression, COMPRESSION_MIN_BYTES
+from easyshell_server.recording import Recorder, RecordingReader, asciicast_header, asciicast_lines
+from easyshell_server.scrollback import ScrollbackBudget
+from easyshell_server.snapshot import StateSnapshotter
+from easyshell_server.metrics import (
+    REGISTRY,
+    HEARTBEATS,
+    REQUEST_DURATION,
+    SESSIONS,
+    DEVICES,
+    RELAY_IN_FLIGHT,
+    RELAY_IN_FLIGHT_MAX,
+    CLEANUP_DURATION,
+    OPEN_WEBSOCKETS,
+)
 
 RESPONSE_STATUS_NOP = "nop"
 RESPONSE_STATUS_STOP = "stop"
 RESPONSE_STATUS_SHELL_REQUEST = "shell_request"
 
+CLEANUP_MIN_INTERVAL = 0.5
+
+NOP_RESPONSE_BODY = fast_json.dumps({"status": RESPONSE_STATUS_NOP})
+NO_INSTRUCTIONS_RESPONSE_BODY = fast_json.dumps({"instructions": []})
+
+# Seconds between comments on an idle /devices/events stream, so proxies keep it open.
+DEVICE_EVENTS_KEEPALIVE = 15
+
+# Close code of a client that ended its session on purpose.
+CLOSE_NORMAL = 1000
+
+# Loaded before the state is built, since every worker imports this module.
+load_dotenv()
+
 app = Sanic("easyshell_api")
 app.config.CORS_ORIGINS = "*"
 Extend(app)
 
-session_manager = SessionManager()
-heartbeat_manager = HeartbeatManager()
-
-ws_connections = defaultdict(dict)  # session_secret -> {"client": ws, "daemon": ws}
+heartbeat_manager, session_manager, routing_table = create_state(
+    os.getenv("STATE_BACKEND", "memory")
+)
+
+relay_manager = RelayManager()
+# Only needed when state is in memory; the sqlite backend outlives restarts by itself.
+state_snapshotter = None
+control_channels = ControlChannelManager()
+# Only needed when state is shared, i.e. when legs may land on other workers.
+peer_router = None
+# Seconds a dropped client has to resume its session; 0 disables resuming.
+client_resume_grace = 0.0
 session_url_template = "ws://{host}/ws/{client_or_daemon}/{session_secret}"
 
+HEARTBEATS_POLLED = HEARTBEATS.labels("poll")
+HEARTBEATS_PUSHED = HEARTBEATS.labels("push")
+HEARTBEATS_BATCHED = HEARTBEATS.labels("batch")
+DEVICES_ALIVE = DEVICES.labels()
+RELAY_BYTES_IN_FLIGHT = RELAY_IN_FLIGHT.labels()
+RELAY_BYTES_IN_FLIGHT_MAX = RELAY_IN_FLIGHT_MAX.labels()
+CLEANUP_DURATION_SECONDS = CLEANUP_DURATION.labels()
+
+
+def counted_websocket(kind: str):
+    """Count the websockets a handler has open in easyshell_open_websockets."""
+    def decorator(handler: Callable):
+        open_websockets = OPEN_WEBSOCKETS.labels(kind)
+
+        @wraps(handler)
+        async def wrapper(request: Request, ws, *args, **kwargs):
+            open_websockets.inc()
+            try:
+                return await handler(request, ws, *args, **kwargs)
+            finally:
+                open_websockets.dec()
+        return wrapper
+    return decorator
+
+
+@app.on_request
+async def start_request_timer(request: Request):
+    request.ctx.started = time.perf_counter()
+
+
+@app.on_response
+async def observe_request_duration(request: Request, _):
+    started = getattr(request.ctx, "started", None)
+    if started is not None:
+        REQUEST_DURATION.labels(request.name or "unmatched").observe(time.perf_counter() - started)
+
+
 def validate_json(model: Type[BaseModel]):
     def decorator(handler: Callable):
         @wraps(handler)
@@ -48,32 +131,167 @@ def validate_json(model: Type[BaseModel]):
 
 
 @app.post("/heartbeat")
-@validate_json(HeartbeatSchema)
-async def heartbeat(request: Request, heartbeat: HeartbeatSchema):
-    await heartbeat_manager.heartbeat(heartbeat.id, heartbeat.auth_type)
-    logger.info(f"Received heartbeat from {heartbeat.id}.")
-
-    is_there_pending_session = await session_manager.remote_has_pending_session(heartbeat.id)
-    if is_there_pending_session:
-        logger.info(f"Pending session request for {heartbeat.id}.")
-        session = await session_manager.get_session_by_remote_id(heartbeat.id)
-        return json({
-            "status": RESPONSE_STATUS_SHELL_REQUEST,
-            "ws_url": session_url_template.format(
-                host=request.headers.get("host", "localhost"),
-                client_or_daemon="daemon",
-                session_secret=session.secret,
-            )
-        })
-    
-    return json({"status": RESPONSE_STATUS_NOP})
+async def heartbeat(request: Request):
+    """
+    Heartbeats are by far the most frequent request, so this skips
+    validate_json for parse_heartbeat and answers the usual case with a
+    prebuilt body. Invalid input gets the same errors as validate_json.
+    """
+    try:
+        data = fast_json.loads(request.body) if request.body else None
+        device_id, auth_type = parse_heartbeat(data)
+    except fast_json.DecodeError:
+        raise BadRequest("Failed when parsing body as json")
+    except ValidationError as e:
+        logger.error(f"Validation error: {e.errors()}")
+        return response.json({"error": e.errors()}, status=400)
+
+    await heartbeat_manager.heartbeat(device_id, auth_type)
+    HEARTBEATS_POLLED.inc()
+    logger.debug("Received heartbeat from %s.", device_id)
+
+    session = await session_manager.claim_pending_session(device_id)
+    if session:
+        logger.info(f"Pending session request for {device_id}.")
+        return HTTPResponse(
+            fast_json.dumps(shell_request_message(request.headers.get("host", "localhost"), session.secret)),
+            content_type="application/json",
+        )
+
+    return HTTPResponse(NOP_RESPONSE_BODY, content_type="application/json")
+
+
+@app.post("/heartbeats")
+async def heartbeats(request: Request):
+    """
+    Heartbeats for many devices at once, from a gateway daemon standing in
+    for the devices behind it: {"devices": [heartbeat, ...]}. The batch is
+    recorded in one bulk update and pending sessions are claimed in one go;
+    the answer lists a shell request for each device that has one.
+    """
+    try:
+        data = fast_json.loads(request.body) if request.body else None
+        devices = parse_heartbeats(data)
+    except fast_json.DecodeError:
+        raise BadRequest("Failed when parsing body as json")
+    except ValidationError as e:
+        logger.error(f"Validation error: {e.errors()}")
+        return response.json({"error": e.errors()}, status=400)
+
+    await heartbeat_manager.heartbeat_many(devices)
+    HEARTBEATS_BATCHED.inc(len(devices))
+    logger.debug("Received %s heartbeats in a batch.", len(devices))
+
+    sessions = await session_manager.claim_pending_sessions([device_id for device_id, _ in devices])
+    if not sessions:
+        return HTTPResponse(NO_INSTRUCTIONS_RESPONSE_BODY, content_type="application/json")
+
+    host = request.headers.get("host", "localhost")
+    instructions = []
+    for device_id, session in sessions.items():
+        logger.info(f"Pending session request for {device_id}.")
+        instructions.append({"id": str(device_id), **shell_request_message(host, session.secret)})
+    return HTTPResponse(fast_json.dumps({"instructions": instructions}), content_type="application/json")
+
+
+def shell_request_message(host: str, session_secret: str) -> dict:
+    return {
+        "status": RESPONSE_STATUS_SHELL_REQUEST,
+        "ws_url": session_url_template.format(
+            host=host,
+            client_or_daemon="daemon",
+            session_secret=session_secret,
+        )
+    }
+
+
+async def push_pending_session(channel):
+    """
+    Send a pending session request, if any, down a daemon's control channel.
+    A daemon in push mode never polls, so a request the channel failed to
+    carry is put back for its next channel or heartbeat.
+    """
+    session = await session_manager.claim_pending_session(channel.device_id)
+    if session:
+        logger.info(f"Pushing session request to {channel.device_id}.")
+        if not await control_channels.push(channel, shell_request_message(channel.host, session.secret)):
+            await session_manager.unclaim_session(session)
 
 
 @app.get("/devices")
-async def get_devices(_):
+async def get_devices(request: Request):
+    """
+    List devices, all at once or a page at a time with ?limit= and the
+    next_cursor of the previous page as ?cursor=, filtered by auth_type and
+    seen_after / seen_before. `version` is where the listing starts in the
+    change log: follow /devices/changes or /devices/events from there
+    rather than listing again.
+    """
+    try:
+        query = DeviceQuerySchema.model_validate({name: request.args.get(name) for name in request.args})
+    except ValidationError as e:
+        logger.error(f"Validation error: {e.errors()}")
+        return response.json({"error": e.errors()}, status=400)
+
     logger.info("A client requested devices.")
-    devices = await heartbeat_manager.get_heartbeats()
-    return json({"devices": devices})
+    version = await heartbeat_manager.current_version()
+    devices, next_cursor = await heartbeat_manager.list_devices(**query.model_dump())
+    return HTTPResponse(
+        fast_json.dumps({"devices": devices, "version": version, "next_cursor": next_cursor}),
+        content_type="application/json",
+    )
+
+
+@app.get("/devices/changes")
+async def get_device_changes(request: Request):
+    """
+    Devices that joined or left after ?since=<version>. 410 if the change
+    log no longer goes back that far; list the devices again then.
+    """
+    try:
+        since = int(request.args.get("since", ""))
+    except ValueError:
+        return json({"error": "Invalid or missing since."}, status=400)
+
+    changes = await heartbeat_manager.changes_since(since)
+    if changes is None:
+        return json({"error": "Changes since this version are gone, list the devices again."}, status=410)
+    version = changes[-1]["version"] if changes else since
+    return HTTPResponse(
+        fast_json.dumps({"version": version, "changes": changes}), content_type="application/json"
+    )
+
+
+def sse_event(event: str, version: int, data: dict) -> str:
+    return f"id: {version}\nevent: {event}\ndata: {fast_json.dumps(data).decode()}\n\n"
+
+
+@app.get("/devices/events")
+async def device_events(request: Request):
+    """
+    Server-sent events for devices joining and leaving, from ?since=<version>
+    (or Last-Event-ID when an EventSource reconnects), else from now. A
+    "reset" event means the changes since then are gone: list the devices
+    again and keep reading.
+    """
+    try:
+        since = request.headers.get("last-event-id") or request.args.get("since")
+        version = await heartbeat_manager.current_version() if since is None else int(since)
+    except ValueError:
+        return json({"error": "Invalid since."}, status=400)
+
+    stream = await request.respond(content_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+    while True:
+        changes = await heartbeat_manager.changes_since(version)
+        if changes is None:
+            version = await heartbeat_manager.current_version()
+            await stream.send(sse_event("reset", version, {"version": version}))
+        elif changes:
+            version = changes[-1]["version"]
+            await stream.send("".join(sse_event(change["event"], change["version"], change) for change in changes))
+        else:
+            await stream.send(": keepalive\n\n")
+        await heartbeat_manager.wait_for_change(version, DEVICE_EVENTS_KEEPALIVE)
 
 
 @app.post("/session")
@@ -99,22 +317,120 @@ async def request_session(request: Request, body: SessionRequestSchema):
         auth_value=body.auth_value,
     )
 
+    channel = control_channels.get(body.remote_id)
+    if channel:
+        await push_pending_session(channel)
+    elif peer_router:
+        address = await routing_table.find_channel(body.remote_id)
+        if address and address != peer_router.address:
+            try:
+                await peer_router.notify(address, body.remote_id)
+            except OSError as e:
+                logger.error(f"Error notifying worker at {address}: {e}")
+
+    host = request.headers.get("host", "localhost")
     client_websocket_url = session_url_template.format(
-        host=request.headers.get("host", "localhost"),
+        host=host,
         client_or_daemon="client",
         session_secret=session.secret,
     )
+    # Shareable with other operators, to watch the session read-only. The
+    # secret would let them take it over, so it carries the viewer token.
+    viewer_websocket_url = session_url_template.format(
+        host=host,
+        client_or_daemon="viewer",
+        session_secret=session.viewer_token,
+    )
 
     return json({
         "session_secret": session.secret, 
-        "websocket_url": client_websocket_url
+        "websocket_url": client_websocket_url,
+        "viewer_url": viewer_websocket_url,
     })
 
 
+async def attach_leg(session_secret: str, side: str, ws):
+    if peer_router:
+        return await peer_router.attach(session_secret, side, ws)
+    return relay_manager.attach(session_secret, side, ws)
+
+
+async def detach_leg(session_secret: str, side: str):
+    if peer_router:
+        await peer_router.detach(session_secret, side)
+    else:
+        await relay_manager.detach(session_secret, side)
+
+
+async def session_closed(session_secret: str) -> bool:
+    """
+    Whether the other leg already left. Checked after attaching, since a leg
+    that left before this one attached had no peer to close.
+    """
+    session = await session_manager.get_session(session_secret)
+    if session is None or session.status == Session.STATUS_CLOSED:
+        logger.info(f"Session {session_secret} is already closed.")
+        return True
+    return False
+
+
+async def end_leg(session_secret: str, side: str):
+    await session_manager.close_session(session_secret)
+    await detach_leg(session_secret, side)
+
+
+async def resume_leg(session_secret: str, ws, offset: int):
+    """
+    Give a kept session to a reconnecting client. Returns the relay, or None,
+    and whether ws is only linked to the worker keeping the session.
+    """
+    relay = await relay_manager.resume(session_secret, ws, offset)
+    if relay is None and peer_router:
+        return await peer_router.resume(session_secret, ws, offset), True
+    return relay, False
+
+
+def client_hung_up(ws) -> bool:
+    """Whether the client closed its websocket on purpose, rather than dropping."""
+    close = getattr(getattr(ws, "ws_proto", None), "close_rcvd", None)
+    return close is not None and close.code == CLOSE_NORMAL
+
+
+async def keep_for_resume(session_secret: str, relay):
+    departures = relay.client_departures
+    logger.info(f"Client dropped. Keeping session {session_secret} for {client_resume_grace}s.")
+    await asyncio.sleep(client_resume_grace)
+    if relay_manager.relays.get(session_secret) is relay:
+        if not relay.suspended or relay.client_departures != departures:
+            # Resumed, maybe left again; that departure has its own wait.
+            return
+        logger.info(f"Client did not resume. Closing session {session_secret}.")
+    await end_leg(session_secret, CLIENT)
+
+
 @app.websocket("/ws/client/<session_secret>")
+@counted_websocket(CLIENT)
 async def client_websocket_handler(request, ws, session_secret):
-    """Handle websocket communication for the client."""
+    """
+    Handle websocket communication for the client. A client that dropped
+    reconnects with ?offset=<bytes of output received> to resume.
+    """
     logger.info(f"Websocket connection established with a client, for session {session_secret}.")
+    try:
+        offset = request.args.get("offset")
+        offset = None if offset is None else int(offset)
+    except ValueError:
+        await ws.close()
+        return
+    # Sanic cancels a websocket handler once its socket drops. The leg runs
+    # shielded so it still attaches, flushes what the socket delivered and
+    # closes the session.
+    await asyncio.shield(client_leg(ws, session_secret, offset))
+
+
+async def client_leg(ws, session_secret: str, offset: int | None = None):
+    relay = None
+    linked = False
     try:
         session = await session_manager.get_session(session_secret)
         if not session:
@@ -122,35 +438,46 @@ async def client_websocket_handler(request, ws, session_secret):
             await ws.close()
             return
 
-        ws_connections[session_secret]["client"] = ws
-
-        while True:
-            data = await ws.recv()
-            if "daemon" in ws_connections[session_secret]:
-                await ws_connections[session_secret]["daemon"].send(data)
-            else:
-                logger.warning(f"No daemon connected for session {session_secret}.")
+        if offset is None:
+            relay = await attach_leg(session_secret, CLIENT, ws)
+        else:
+            relay, linked = await resume_leg(session_secret, ws, offset)
+            if relay is None:
+                logger.warning(f"Session {session_secret} cannot be resumed. Closing connection.")
+                await ws.close()
+                return
+            logger.info(f"Client resumed session {session_secret} from offset {offset}.")
+        if await session_closed(session_secret):
+            return
+        await relay.forward(CLIENT)
 
     except Exception as e:
         logger.error(f"Error in client websocket: {e}")
     finally:
-        logger.info(f"Client disconnected. Closing session {session_secret}.")
-        await session_manager.close_session(session_secret)
-        ws_connections.get(session_secret, {}).pop("client", None)
-        if "daemon" in ws_connections.get(session_secret, {}):
-            print("C")
-            try:
-                await ws_connections[session_secret]["daemon"].close()
-                logger.info(f"Closed daemon connection for {session_secret}.")
-            except Exception as e:
-                logger.error(f"Error closing daemon websocket: {e}")
-            ws_connections[session_secret].pop("daemon", None)
+        if linked:
+            # The worker keeping the session keeps it for the next resume.
+            await relay_manager.detach(session_secret, CLIENT)
+        elif offset is not None and relay is None:
+            # Nothing to resume, so nothing of this connection to close.
+            pass
+        elif relay is not None and relay.scrollback is not None and relay.sockets[CLIENT] not in (ws, None):
+            logger.info(f"Client of session {session_secret} was replaced by a resumed one.")
+        elif not client_hung_up(ws) and relay_manager.suspend(session_secret, ws):
+            await keep_for_resume(session_secret, relay)
+        else:
+            logger.info(f"Client disconnected. Closing session {session_secret}.")
+            await end_leg(session_secret, CLIENT)
+
 
 @app.websocket("/ws/daemon/<session_secret>")
+@counted_websocket(DAEMON)
 async def daemon_websocket_handler(request, ws, session_secret):
     """Handle websocket communication for the daemon."""
     logger.info(f"Websocket connection established with a daemon, for session {session_secret}.")
+    await asyncio.shield(daemon_leg(ws, session_secret))
+
 
+async def daemon_leg(ws, session_secret: str):
     try:
         session = await session_manager.start_session(session_secret)
         if not session:
@@ -158,31 +485,240 @@ async def daemon_websocket_handler(request, ws, session_secret):
             await ws.close()
             return
 
-        ws_connections[session_secret]["daemon"] = ws
-
-        while True:
-            data = await ws.recv()
-            print("AAAAAA")
-            print(data)
-            if "client" in ws_connections[session_secret]:
-                await ws_connections[session_secret]["client"].send(data)
-            else:
-                logger.warning(f"No client connected for session {session_secret}.")
+        relay = await attach_leg(session_secret, DAEMON, ws)
+        if await session_closed(session_secret):
+            return
+        await relay.forward(DAEMON)
 
+    except MuxChannelClosed:
+        pass
     except Exception as e:
         logger.error(f"Error in daemon websocket: {e}")
     finally:
         logger.info(f"Daemon disconnected. Closing session {session_secret}.")
-        await session_manager.close_session(session_secret)
-        ws_connections.get(session_secret, {}).pop("daemon", None)
+        await end_leg(session_secret, DAEMON)
+
+
+@app.websocket("/ws/mux")
+@counted_websocket("mux")
+async def mux_websocket_handler(request, ws):
+    """
+    Handle a daemon's multiplexed connection: the daemon legs of all its
+    sessions, each opened with one small frame on this websocket instead of
+    a websocket of its own.
+    """
+    logger.info("Multiplexed connection established with a daemon.")
+    try:
+        await MuxConnection(ws, daemon_leg).serve()
+    except Exception as e:
+        logger.error(f"Error in multiplexed websocket: {e}")
+    finally:
+        logger.info("Multiplexed connection with a daemon closed.")
+
+
+@app.websocket("/ws/viewer/<viewer_token>")
+@counted_websocket("viewer")
+async def viewer_websocket_handler(request, ws, viewer_token):
+    """
+    Watch a live session read-only: its recent output, then everything the
+    daemon sends. Input from a viewer is ignored. Takes the session's viewer
+    token, never its secret.
+    """
+    logger.info("Websocket connection established with a viewer.")
+    session = await session_manager.get_session_by_viewer_token(viewer_token)
+    if session is None:
+        logger.warning("No session found for viewer token. Closing connection.")
+        await ws.close()
+        return
+    await viewer_leg(ws, session.secret)
+
+
+async def viewer_leg(ws, session_secret: str, route: bool = True):
+    """Watch from the worker holding the session's client leg; route=False for viewers linked from another worker."""
+    try:
+        if await relay_manager.watch(session_secret, ws):
+            return
+        if route and peer_router and await peer_router.watch(session_secret, ws):
+            return
+        logger.warning(f"No live session {session_secret} to watch. Closing connection.")
+        await ws.close()
+    except Exception as e:
+        logger.error(f"Error in viewer websocket: {e}")
+    finally:
+        logger.info(f"Viewer of session {session_secret} left.")
 
-        if "client" in ws_connections.get(session_secret, {}):
-            try:
-                await ws_connections[session_secret]["client"].close()
-                logger.info(f"Closed client connection for {session_secret}.")
-            except Exception as e:
-                logger.error(f"Error closing client websocket: {e}")
-            ws_connections[session_secret].pop("client", None)
+
+@app.get("/recordings/<session_secret>")
+async def replay_recording(request: Request, session_secret: str):
+    """
+    Stream the recording of a session as asciicast v2, from `start` seconds
+    in if given. Read one chunk at a time, so any size streams in constant
+    memory. It holds the client's input, keystrokes typed at no-echo
+    prompts included, so it takes the session secret: never the viewer
+    token, which is meant to be shared.
+    """
+    if relay_manager.recorder is None:
+        return json({"error": "Recording is disabled."}, status=404)
+
+    try:
+        uuid.UUID(session_secret)
+        start = float(request.args.get("start", 0))
+    except ValueError:
+        return json({"error": "Invalid session secret or start."}, status=400)
+
+    try:
+        reader = await asyncio.to_thread(RecordingReader, relay_manager.recorder.path(session_secret))
+    except FileNotFoundError:
+        return json({"error": "Recording not found."}, status=404)
+    except ValueError as e:
+        return json({"error": str(e)}, status=400)
+
+    logger.info(f"Replaying session {session_secret} from {start}s.")
+    try:
+        stream = await request.respond(content_type="application/x-asciicast")
+        await stream.send(asciicast_header(reader))
+        chunks = reader.chunks(start)
+        while (events := await asyncio.to_thread(next, chunks, None)) is not None:
+            await stream.send(asciicast_lines(events))
+        await stream.eof()
+    finally:
+        reader.close()
+
+
+@app.get("/metrics")
+async def metrics(_):
+    """Prometheus metrics of this worker."""
+    return response.text(await REGISTRY.expose(), content_type="text/plain; version=0.0.4")
+
+
+@REGISTRY.collector
+async def collect_state():
+    for status, count in (await session_manager.status_counts()).items():
+        SESSIONS.labels(status).set(count)
+    DEVICES_ALIVE.set(await heartbeat_manager.count())
+    # The total and the largest session tell one stuck client from many
+    # slow ones, without putting session secrets in labels.
+    in_flight = relay_manager.bytes_in_flight().values()
+    RELAY_BYTES_IN_FLIGHT.set(sum(in_flight))
+    RELAY_BYTES_IN_FLIGHT_MAX.set(max(in_flight, default=0))
+
+
+@app.websocket("/ws/control")
+@counted_websocket("control")
+async def control_websocket_handler(request, ws):
+    """
+    Handle the control channel of a daemon in push mode. The daemon opens
+    with the same body as a heartbeat; every frame it sends after that counts
+    as a heartbeat, and session requests are pushed as soon as they exist.
+    """
+    try:
+        hello = HeartbeatSchema.model_validate_json(await ws.recv())
+    except ValidationError as e:
+        logger.error(f"Validation error on control channel: {e.errors()}")
+        await ws.close()
+        return
+    except (ConnectionClosed, WebsocketClosed, asyncio.CancelledError):
+        # The daemon went away before its hello; nothing is registered yet.
+        # Sanic's recv() raises CancelledError on a close frame, but a real
+        # cancellation of the handler still has to propagate.
+        if asyncio.current_task().cancelling():
+            raise
+        logger.debug("Control channel closed before hello.")
+        return
+
+    logger.info(f"Control channel established with {hello.id}.")
+    channel = control_channels.register(hello.id, ws, request.headers.get("host", "localhost"))
+    if peer_router:
+        await routing_table.register_channel(hello.id, peer_router.address)
+    try:
+        await heartbeat_manager.heartbeat(hello.id, hello.auth_type)
+        HEARTBEATS_PUSHED.inc()
+        await push_pending_session(channel)
+
+        while True:
+            await ws.recv()
+            await heartbeat_manager.heartbeat(hello.id, hello.auth_type)
+            HEARTBEATS_PUSHED.inc()
+
+    except Exception as e:
+        logger.error(f"Error in control websocket: {e}")
+    finally:
+        logger.info(f"Control channel of {hello.id} closed.")
+        control_channels.unregister(channel)
+        if peer_router:
+            await routing_table.unregister_channel(hello.id, peer_router.address)
+
+
+async def push_notified_session(device_id: str):
+    """Called when another worker created a session for a daemon whose channel is here."""
+    channel = control_channels.get(uuid.UUID(device_id))
+    if channel:
+        await push_pending_session(channel)
+
+
+@app.before_server_start
+async def setup_relay(app, _):
+    global peer_router, client_resume_grace
+    if routing_table is not None:
+        peer_host = os.getenv("RELAY_PEER_HOST", "127.0.0.1")
+        peer_router = PeerRouter(
+            routing_table,
+            relay_manager,
+            on_notify=push_notified_session,
+            on_resume=client_leg,
+            on_view=partial(viewer_leg, route=False),
+            peer_secret=os.getenv("RELAY_PEER_SECRET", ""),
+        )
+        await peer_router.start(peer_host, os.getenv("RELAY_PEER_ADVERTISE_HOST", peer_host))
+
+    if os.getenv("WEBSOCKET_COMPRESSION", "deflate") == "deflate":
+        enable_websocket_compression(
+            min_bytes=int(os.getenv("WEBSOCKET_COMPRESSION_MIN_BYTES", COMPRESSION_MIN_BYTES)),
+            window_bits=int(os.getenv("WEBSOCKET_COMPRESSION_WINDOW_BITS", 12)),
+        )
+
+    relay_manager.coalesce_delay = float(os.getenv("RELAY_COALESCE_MS", 0)) / 1000
+    relay_manager.coalesce_max_bytes = int(os.getenv("RELAY_COALESCE_MAX_BYTES", 64 * 1024))
+    relay_manager.high_watermark = int(os.getenv("RELAY_HIGH_WATERMARK", 1024 * 1024))
+    relay_manager.low_watermark = int(os.getenv("RELAY_LOW_WATERMARK", 256 * 1024))
+    relay_manager.viewer_max_lag = int(os.getenv("VIEWER_MAX_LAG_BYTES", 1024 * 1024))
+
+    client_resume_grace = float(os.getenv("CLIENT_RESUME_GRACE", 30))
+    if client_resume_grace > 0:
+        relay_manager.scrollback_budget = ScrollbackBudget(
+            session_bytes=int(os.getenv("SCROLLBACK_BYTES", 256 * 1024)),
+            total_bytes=int(os.getenv("SCROLLBACK_TOTAL_BYTES", 64 * 1024 * 1024)),
+        )
+
+    recording_dir = os.getenv("RECORDING_DIR")
+    if recording_dir:
+        relay_manager.recorder = Recorder(
+            recording_dir,
+            chunk_bytes=int(os.getenv("RECORDING_CHUNK_BYTES", 64 * 1024)),
+            chunk_interval=float(os.getenv("RECORDING_CHUNK_MS", 1000)) / 1000,
+            max_pending_chunks=int(os.getenv("RECORDING_MAX_PENDING_CHUNKS", 64)),
+        )
+
+
+@app.before_server_start
+async def restore_state(app, _):
+    """Reload the devices and pending sessions of the previous run, before serving."""
+    global state_snapshotter
+    path = os.getenv("STATE_SNAPSHOT")
+    if not path:
+        return
+    if routing_table is not None:
+        logger.warning("STATE_SNAPSHOT is ignored: the shared state backend already persists.")
+        return
+    state_snapshotter = StateSnapshotter(
+        path,
+        heartbeat_manager,
+        session_manager,
+        interval=float(os.getenv("STATE_SNAPSHOT_INTERVAL", 10)),
+        journal_interval=float(os.getenv("STATE_JOURNAL_MS", 200)) / 1000,
+    )
+    await state_snapshotter.load()
+    app.add_task(state_snapshotter.run(), name="state_snapshots")
 
 
 @app.after_server_start
@@ -192,24 +728,55 @@ async def setup_cleanup(app, _):
         stale_session_timeout = int(os.getenv("SESSION_TIMEOUT", 300))
 
         while True:
+            started = time.perf_counter()
             n_heartbeats = await heartbeat_manager.cleanup_heartbeats(
                 timeout=heartbeat_timeout
             )
-            logger.info("Cleaned up %s heartbeats.", n_heartbeats)
+            if n_heartbeats:
+                logger.info("Cleaned up %s heartbeats.", n_heartbeats)
 
             n_sessions = await session_manager.cleanup_sessions(
                 timeout=stale_session_timeout
             )
-            logger.info(
-                "Cleaned up %s stale sessions.",
-                n_sessions,
-            )
-
-            await asyncio.sleep(60)
+            if n_sessions:
+                logger.info(
+                    "Cleaned up %s stale sessions.",
+                    n_sessions,
+                )
+            CLEANUP_DURATION_SECONDS.observe(time.perf_counter() - started)
+
+            # Sleep until the next entry is due. Anything touched meanwhile
+            # expires later than that, so nothing is missed.
+            now = time.time()
+            deadlines = [
+                deadline
+                for deadline in (
+                    await heartbeat_manager.next_expiry(heartbeat_timeout),
+                    await session_manager.next_expiry(stale_session_timeout),
+                )
+                if deadline is not None
+            ]
+            next_deadline = min(deadlines, default=now + min(heartbeat_timeout, stale_session_timeout))
+            await asyncio.sleep(max(next_deadline - now, CLEANUP_MIN_INTERVAL))
 
     app.add_task(cleanup_task())
 
 
+@app.before_server_stop
+async def stop_peer_router(app, _):
+    if peer_router:
+        await peer_router.stop()
+
+
+@app.before_server_stop
+async def save_state(app, _):
+    if state_snapshotter:
+        await app.cancel_task("state_snapshots", raise_exception=False)
+        await state_snapshotter.close()
+
+
 if __name__ == "__main__":
-    load_dotenv()
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 7843)))
+    workers = int(os.getenv("WORKERS", 1))
+    if workers > 1 and routing_table is None:
+        raise ValueError("WORKERS > 1 needs a shared STATE_BACKEND, e.g. sqlite:///var/lib/easyshell/state.db")
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 7843)), workers=workers)
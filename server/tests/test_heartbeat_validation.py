@@ -0,0 +1,98 @@
+import json
+
+import pytest
+from pydantic import ValidationError
+
+from easyshell_server import fast_json
+from easyshell_server.validation.heartbeat import (
+    HeartbeatSchema,
+    HeartbeatBatchSchema,
+    parse_heartbeat,
+    parse_heartbeats,
+)
+
+DEVICE_ID = "6f1c2d0e-5b7a-4c1e-9a55-0d1f1b5f8d11"
+
+BODIES = [
+    # Valid
+    f'{{"id": "{DEVICE_ID}", "auth_type": "otp"}}',
+    f'{{"id": "{DEVICE_ID.upper()}", "auth_type": "no_auth", "extra": [1, 2]}}',
+    f'{{"id": "{DEVICE_ID.replace("-", "")}", "auth_type": "otp"}}',
+    # Missing fields
+    "{}",
+    f'{{"id": "{DEVICE_ID}"}}',
+    '{"auth_type": "otp"}',
+    # Wrong types
+    '{"id": 42, "auth_type": "otp"}',
+    f'{{"id": "{DEVICE_ID}", "auth_type": 1}}',
+    f'{{"id": "{DEVICE_ID}", "auth_type": null}}',
+    f'{{"id": ["{DEVICE_ID}"], "auth_type": "otp"}}',
+    f'["{DEVICE_ID}", "otp"]',
+    '"heartbeat"',
+    "NaN",
+    # Bad UUIDs
+    '{"id": "not-a-uuid", "auth_type": "otp"}',
+    f'{{"id": "{DEVICE_ID[:-1]}", "auth_type": "otp"}}',
+    '{"id": "", "auth_type": "otp"}',
+    # Unknown or empty auth_type
+    f'{{"id": "{DEVICE_ID}", "auth_type": "password"}}',
+    f'{{"id": "{DEVICE_ID}", "auth_type": "OTP"}}',
+    f'{{"id": "{DEVICE_ID}", "auth_type": ""}}',
+    # Not JSON
+    "",
+    "{bad",
+    f'{{"id": "{DEVICE_ID}", "auth_type": "otp"',
+]
+
+
+def outcome(parse, body: str):
+    """What a handler answers for body: the parsed value, the 400 error body, or a JSON error."""
+    try:
+        data = parse.loads(body.encode()) if body else None
+    except ValueError:
+        return "not json"
+    try:
+        return parse.validate(data)
+    except ValidationError as e:
+        # As response.json serializes it.
+        return json.dumps({"error": e.errors()}, default=str)
+
+
+class Pydantic:
+    """The /heartbeat handler before the fast path: request.json and the schema."""
+    loads = staticmethod(json.loads)
+
+    @staticmethod
+    def validate(data):
+        heartbeat = HeartbeatSchema.model_validate(data)
+        return heartbeat.id, heartbeat.auth_type
+
+
+class FastPath:
+    loads = staticmethod(fast_json.loads)
+    validate = staticmethod(parse_heartbeat)
+
+
+class PydanticBatch:
+    loads = staticmethod(json.loads)
+
+    @staticmethod
+    def validate(data):
+        batch = HeartbeatBatchSchema.model_validate(data)
+        return [(heartbeat.id, heartbeat.auth_type) for heartbeat in batch.devices]
+
+
+class FastBatch:
+    loads = staticmethod(fast_json.loads)
+    validate = staticmethod(parse_heartbeats)
+
+
+@pytest.mark.parametrize("body", BODIES)
+def test_parse_heartbeat_matches_schema(body):
+    assert outcome(FastPath, body) == outcome(Pydantic, body)
+
+
+@pytest.mark.parametrize("body", [body for body in BODIES if body.startswith("{")])
+def test_parse_heartbeats_matches_schema(body):
+    batch = f'{{"devices": [{{"id": "{DEVICE_ID}", "auth_type": "otp"}}, {body}]}}'
+    assert outcome(FastBatch, batch) == outcome(PydanticBatch, batch)
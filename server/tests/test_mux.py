@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from easyshell_server.mux import (
+    MuxConnection,
+    MuxChannelClosed,
+    MUX_HEADER,
+    MUX_CREDIT,
+    MUX_OPEN,
+    MUX_TEXT,
+    MUX_BINARY,
+    MUX_WINDOW,
+    MUX_CLOSE,
+    INITIAL_WINDOW,
+)
+
+
+class LinkEnd:
+    """One end of an in-memory websocket, with the recv/send/close of a Sanic one."""
+
+    def __init__(self):
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.peer: "LinkEnd" = None
+
+    async def recv(self):
+        return await self.inbox.get()
+
+    async def send(self, message):
+        await self.peer.inbox.put(message)
+
+    async def close(self):
+        pass
+
+
+def link() -> tuple[LinkEnd, LinkEnd]:
+    a, b = LinkEnd(), LinkEnd()
+    a.peer, b.peer = b, a
+    return a, b
+
+
+class Daemon:
+    """The daemon end of the link, speaking the framing by hand."""
+
+    def __init__(self, ws: LinkEnd):
+        self.ws = ws
+
+    async def send(self, kind: int, channel_id: int, payload: bytes = b""):
+        await self.ws.send(MUX_HEADER.pack(kind, channel_id) + payload)
+
+    async def recv(self) -> tuple[int, int, bytes]:
+        message = await asyncio.wait_for(self.ws.recv(), 1)
+        kind, channel_id = MUX_HEADER.unpack_from(message)
+        return kind, channel_id, message[MUX_HEADER.size:]
+
+
+async def blocked(task: asyncio.Task) -> bool:
+    await asyncio.sleep(0.05)
+    return not task.done()
+
+
+def serve_two_channels(test):
+    """Run test(daemon, channels, ended) with channels 1 and 2 open on one connection."""
+
+    async def run():
+        server_ws, daemon_ws = link()
+        channels = {}
+        ended = {1: asyncio.Event(), 2: asyncio.Event()}
+        both_open = asyncio.Event()
+
+        async def on_open(channel, session_secret):
+            channels[int(session_secret)] = channel
+            if len(channels) == 2:
+                both_open.set()
+            await ended[channel.id].wait()
+
+        connection = MuxConnection(server_ws, on_open)
+        serving = asyncio.create_task(connection.serve())
+        daemon = Daemon(daemon_ws)
+        await daemon.send(MUX_OPEN, 1, b"1")
+        await daemon.send(MUX_OPEN, 2, b"2")
+        await asyncio.wait_for(both_open.wait(), 1)
+        try:
+            await test(daemon, channels, ended)
+        finally:
+            serving.cancel()
+            await asyncio.gather(serving, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_sender_without_credit_waits_for_window():
+    async def test(daemon, channels, ended):
+        await channels[1].send(b"x" * INITIAL_WINDOW)
+        assert await daemon.recv() == (MUX_BINARY, 1, b"x" * INITIAL_WINDOW)
+
+        waiting = asyncio.create_task(channels[1].send("more"))
+        assert await blocked(waiting)
+
+        # The other channel has a window of its own.
+        await channels[2].send("other")
+        assert await daemon.recv() == (MUX_TEXT, 2, b"other")
+
+        await daemon.send(MUX_WINDOW, 1, MUX_CREDIT.pack(INITIAL_WINDOW))
+        await asyncio.wait_for(waiting, 1)
+        assert await daemon.recv() == (MUX_TEXT, 1, b"more")
+
+    serve_two_channels(test)
+
+
+def test_receiver_grants_window_as_it_consumes():
+    async def test(daemon, channels, ended):
+        half = INITIAL_WINDOW // 2
+        await daemon.send(MUX_BINARY, 2, b"y" * half)
+        assert await channels[2].recv() == b"y" * half
+        assert await daemon.recv() == (MUX_WINDOW, 2, MUX_CREDIT.pack(half))
+
+    serve_two_channels(test)
+
+
+def test_closing_a_channel_leaves_the_others_running():
+    async def test(daemon, channels, ended):
+        # Channel 1 is stuck without credit when the daemon closes it.
+        await channels[1].send(b"x" * INITIAL_WINDOW)
+        await daemon.recv()
+        waiting = asyncio.create_task(channels[1].send("more"))
+        assert await blocked(waiting)
+
+        await daemon.send(MUX_CLOSE, 1)
+        with pytest.raises(MuxChannelClosed):
+            await asyncio.wait_for(waiting, 1)
+        with pytest.raises(MuxChannelClosed):
+            await asyncio.wait_for(channels[1].recv(), 1)
+
+        await daemon.send(MUX_TEXT, 2, b"ls")
+        assert await asyncio.wait_for(channels[2].recv(), 1) == "ls"
+        await channels[2].send("output")
+        assert await daemon.recv() == (MUX_TEXT, 2, b"output")
+
+        # A session ending on the server closes only its own channel.
+        ended[2].set()
+        assert await daemon.recv() == (MUX_CLOSE, 2, b"")
+
+    serve_two_channels(test)
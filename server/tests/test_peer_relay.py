@@ -0,0 +1,45 @@
+import json
+import asyncio
+
+import pytest
+
+from easyshell_server.peer_relay import PeerRouter, KIND_NOTIFY
+from easyshell_server.relay import RelayManager
+
+
+def test_peer_connections_need_the_shared_secret():
+    async def run():
+        notified = []
+
+        async def on_notify(device_id):
+            notified.append(device_id)
+
+        router = PeerRouter(None, RelayManager(), on_notify, None, None, peer_secret="s3cret")
+        await router.start("127.0.0.1", "127.0.0.1")
+        host, port = router.address.rsplit(":", 1)
+        try:
+            for auth in (None, "wrong"):
+                reader, writer = await asyncio.open_connection(host, int(port))
+                hello = {"kind": KIND_NOTIFY, "device_id": "intruder"}
+                if auth is not None:
+                    hello["auth"] = auth
+                writer.write(json.dumps(hello).encode() + b"\n")
+                assert await asyncio.wait_for(reader.read(), 1) == b""
+                writer.close()
+
+            peer_socket = await router._dial(router.address, {"kind": KIND_NOTIFY, "device_id": "peer"})
+            await asyncio.wait_for(peer_socket.reader.read(), 1)
+            assert notified == ["peer"]
+        finally:
+            await router.stop()
+
+    asyncio.run(run())
+
+
+def test_listening_beyond_loopback_needs_a_secret():
+    async def run():
+        router = PeerRouter(None, RelayManager(), None, None, None)
+        with pytest.raises(ValueError):
+            await router.start("0.0.0.0", "10.0.0.1")
+
+    asyncio.run(run())
@@ -0,0 +1,42 @@
+import asyncio
+import uuid
+
+import main
+from easyshell_server.auth import AuthType
+from easyshell_server.control_channel import ControlChannelManager
+from easyshell_server.session_manager import SessionManager
+
+
+class BrokenWebsocket:
+    async def send(self, message):
+        raise ConnectionResetError("control channel dropped")
+
+
+class RecordingWebsocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+def test_failed_push_keeps_session_pending(monkeypatch):
+    session_manager = SessionManager()
+    control_channels = ControlChannelManager()
+    monkeypatch.setattr(main, "session_manager", session_manager)
+    monkeypatch.setattr(main, "control_channels", control_channels)
+    device_id = uuid.uuid4()
+
+    async def run():
+        session = await session_manager.session_request(
+            client_id=uuid.uuid4(), remote_id=device_id, auth_type=AuthType.OTP, auth_value="123456"
+        )
+        await main.push_pending_session(control_channels.register(device_id, BrokenWebsocket(), "localhost"))
+
+        # The daemon reconnects its channel and gets the request it missed.
+        ws = RecordingWebsocket()
+        await main.push_pending_session(control_channels.register(device_id, ws, "localhost"))
+        assert len(ws.sent) == 1 and session.secret in ws.sent[0]
+        assert await session_manager.claim_pending_session(device_id) is None
+
+    asyncio.run(run())
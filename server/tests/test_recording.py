@@ -0,0 +1,72 @@
+import os
+import asyncio
+
+from easyshell_server.recording import Recorder, RecordingReader, INDEX_EXTENSION, INDEX_ENTRY
+from easyshell_server.relay import CLIENT, DAEMON
+
+
+def record(recorder: Recorder, name: str, frames: list[tuple[str, str | bytes]], pause: float = 0.0):
+    async def run():
+        recording = recorder.open(name)
+        for side, data in frames:
+            recording.record(side, data)
+            await asyncio.sleep(pause)
+        await recording.close()
+
+    asyncio.run(run())
+
+
+def read_all(path: str, start: float = 0.0):
+    with RecordingReader(path) as reader:
+        return [event for events in reader.chunks(start) for event in events]
+
+
+def test_round_trip_across_chunks(tmp_path):
+    recorder = Recorder(str(tmp_path), chunk_bytes=64)
+    frames = [(DAEMON, f"line {i}\n" * 4) for i in range(20)] + [(CLIENT, "ls"), (DAEMON, b"\x00\xff")]
+    record(recorder, "session", frames)
+
+    path = recorder.path("session")
+    assert os.path.getsize(path + INDEX_EXTENSION) // INDEX_ENTRY.size > 1
+    events = read_all(path)
+    assert [(event.direction, event.data) for event in events] == [
+        ("i" if side == CLIENT else "o", data) for side, data in frames
+    ]
+    assert [event.time for event in events] == sorted(event.time for event in events)
+
+
+def test_seek(tmp_path):
+    recorder = Recorder(str(tmp_path), chunk_bytes=16)
+    record(recorder, "session", [(DAEMON, f"{i:02}" * 8) for i in range(10)], pause=0.01)
+
+    path = recorder.path("session")
+    events = read_all(path)
+    middle = events[5].time
+    assert [event.data for event in read_all(path, middle)] == [event.data for event in events[5:]]
+
+    # Without the index, replay finds the same place by scanning chunk headers.
+    os.remove(path + INDEX_EXTENSION)
+    assert [event.data for event in read_all(path, middle)] == [event.data for event in events[5:]]
+
+
+def test_truncated_trailing_chunk(tmp_path):
+    recorder = Recorder(str(tmp_path), chunk_bytes=16)
+    record(recorder, "session", [(DAEMON, f"{i:02}" * 8) for i in range(5)])
+
+    path = recorder.path("session")
+    # Cut the last chunk short, as a crash while writing it would.
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert [event.data for event in read_all(path)] == [f"{i:02}" * 8 for i in range(4)]
+
+
+def test_reopened_recording_stays_in_order(tmp_path):
+    recorder = Recorder(str(tmp_path), chunk_bytes=16)
+    record(recorder, "session", [(DAEMON, "first" * 4)])
+    record(recorder, "session", [(DAEMON, "second" * 4)])
+
+    path = recorder.path("session")
+    events = read_all(path)
+    assert [event.data for event in events] == ["first" * 4, "second" * 4]
+    assert events[0].time <= events[1].time
+    assert [event.data for event in read_all(path, events[1].time)] == ["second" * 4]
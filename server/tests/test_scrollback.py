@@ -0,0 +1,47 @@
+from easyshell_server.scrollback import ScrollbackBudget
+
+
+def test_since_across_trims():
+    scrollback = ScrollbackBudget(session_bytes=10, total_bytes=1024).open()
+    for frame in ["0123", "4567", b"89ab", "cdef"]:
+        scrollback.append(frame)
+
+    assert (scrollback.start, scrollback.end) == (6, 16)
+    assert scrollback.since(12) == b"cdef"
+    assert scrollback.since(7) == b"789abcdef"
+    # Already trimmed: from the oldest byte kept.
+    assert scrollback.since(0) == b"6789abcdef"
+    assert scrollback.since(16) == b""
+
+
+def test_trim_keeps_whole_characters():
+    budget = ScrollbackBudget(session_bytes=7, total_bytes=1024)
+    scrollback = budget.open()
+    scrollback.append("aé€b")  # 1 + 2 + 3 + 1 bytes
+    scrollback.append("€€")
+
+    kept = scrollback.since(0)
+    assert kept.decode() == "b€€"
+    assert scrollback.start == scrollback.end - len(kept)
+    assert budget.size == len(kept) <= 7
+
+
+def test_total_is_a_hard_cap_with_idle_sessions():
+    budget = ScrollbackBudget(session_bytes=100, total_bytes=200)
+    idle = [budget.open() for _ in range(2)]
+    for scrollback in idle:
+        scrollback.append("x" * 100)
+
+    busy = [budget.open() for _ in range(2)]
+    for _ in range(10):
+        for scrollback in busy:
+            scrollback.append("y" * 10)
+            assert budget.size <= budget.total_bytes
+
+    assert budget.size == sum(scrollback.size for scrollback in idle + busy)
+    assert all(scrollback.size <= budget.fair_share() for scrollback in idle)
+    assert all(scrollback.since(0) == b"x" * scrollback.size for scrollback in idle)
+
+    budget.release(idle[0])
+    assert idle[0].size == 0
+    assert budget.size == sum(scrollback.size for scrollback in idle[1:] + busy)
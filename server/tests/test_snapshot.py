@@ -0,0 +1,76 @@
+import uuid
+import asyncio
+
+from easyshell_server.auth import AuthType
+from easyshell_server.heartbeat_manager import HeartbeatManager
+from easyshell_server.session_manager import SessionManager
+from easyshell_server.snapshot import StateSnapshotter
+
+
+def pending_state(session_manager: SessionManager) -> dict:
+    """Every pending session, by secret, as the fields a restart has to keep and whether it was claimed."""
+    return {
+        session.secret: (
+            session.client_id,
+            session.remote_id,
+            session.auth_type,
+            session.auth_value,
+            session.viewer_token,
+            claimed,
+        )
+        for session, claimed in session_manager.checkpoint()
+    }
+
+
+def test_snapshot_and_journal_round_trip(tmp_path):
+    async def run():
+        path = str(tmp_path / "state")
+        heartbeat_manager, session_manager = HeartbeatManager(), SessionManager()
+        snapshotter = StateSnapshotter(path, heartbeat_manager, session_manager)
+        await snapshotter.load()
+
+        async def request(remote_id):
+            return await session_manager.session_request(
+                client_id=uuid.uuid4(), remote_id=remote_id, auth_type=AuthType.OTP, auth_value="123456"
+            )
+
+        devices = [uuid.uuid4() for _ in range(3)]
+        await heartbeat_manager.heartbeat_many([(device_id, AuthType.OTP) for device_id in devices[:2]])
+        snapshotted = [await request(devices[0]) for _ in range(3)]
+        await session_manager.claim_pending_session(devices[0])
+        await snapshotter.snapshot()
+
+        # Everything after the snapshot is only in its generation's journal.
+        await heartbeat_manager.heartbeat(devices[2], AuthType.NO_AUTH)
+        journaled = [await request(devices[1]) for _ in range(2)]
+        await session_manager.unclaim_session(snapshotted[0])
+        await session_manager.claim_pending_session(devices[1])
+        await session_manager.start_session(snapshotted[1].secret)
+        await session_manager.close_session(journaled[1].secret)
+        await snapshotter.flush_journal()
+        # A record torn by a crash ends the replay without losing the ones before it.
+        with open(snapshotter.journal_path(snapshotter.generation), "ab") as f:
+            f.write(b'["claim", "')
+
+        restored_heartbeats, restored_sessions = HeartbeatManager(), SessionManager()
+        await StateSnapshotter(path, restored_heartbeats, restored_sessions).load()
+
+        assert pending_state(restored_sessions) == pending_state(session_manager)
+        assert set(pending_state(restored_sessions)) == {
+            snapshotted[0].secret, snapshotted[2].secret, journaled[0].secret
+        }
+        assert restored_sessions.viewer_tokens == {
+            token: secret for token, secret in session_manager.viewer_tokens.items()
+            if secret in pending_state(session_manager)
+        }
+        assert [
+            (hb.client_id, hb.auth_type, hb.seq) for hb in restored_heartbeats.heartbeats.values()
+        ] == [(hb.client_id, hb.auth_type, hb.seq) for hb in heartbeat_manager.heartbeats.values()]
+        assert restored_heartbeats.version == heartbeat_manager.version
+
+        # The unclaimed session is handed out again, ahead of the newer one.
+        assert (await restored_sessions.claim_pending_session(devices[0])).secret == snapshotted[0].secret
+        assert (await restored_sessions.claim_pending_session(devices[0])).secret == snapshotted[2].secret
+        assert await restored_sessions.claim_pending_session(devices[1]) is None
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import uuid
+import asyncio
+
+from easyshell_server.auth import AuthType
+from easyshell_server.relay import CLIENT, DAEMON
+from easyshell_server.state import create_state
+
+
+def workers(path, count: int = 2):
+    """State of `count` workers sharing one database, each with its own connection and thread."""
+    return [create_state(f"sqlite://{path}") for _ in range(count)]
+
+
+def test_pending_session_is_claimed_once_across_workers(tmp_path):
+    async def run():
+        (_, first, _), (_, second, _) = workers(tmp_path / "state.db")
+        remote_id = uuid.uuid4()
+        requested = [
+            await first.session_request(
+                client_id=uuid.uuid4(), remote_id=remote_id, auth_type=AuthType.OTP, auth_value="123456"
+            )
+            for _ in range(20)
+        ]
+
+        # Both workers race for every session, one claim at a time and in batches.
+        claims = await asyncio.gather(*(
+            manager.claim_pending_session(remote_id) for _ in range(15) for manager in (first, second)
+        ))
+        batches = await asyncio.gather(
+            first.claim_pending_sessions([remote_id]), second.claim_pending_sessions([remote_id])
+        )
+        claimed = [session.secret for session in claims if session]
+        claimed += [session.secret for batch in batches for session in batch.values()]
+
+        assert sorted(claimed) == sorted(session.secret for session in requested)
+        assert await first.claim_pending_session(remote_id) is None
+
+    asyncio.run(run())
+
+
+def test_relay_legs_are_visible_to_every_worker(tmp_path):
+    async def run():
+        (_, _, first), (_, _, second) = workers(tmp_path / "state.db")
+        secret = str(uuid.uuid4())
+
+        client_leg = await first.register_leg(secret, CLIENT, "10.0.0.1:7900")
+        daemon_leg = await second.register_leg(secret, DAEMON, "10.0.0.2:7900")
+        assert (await second.find_leg(secret, CLIENT)).address == "10.0.0.1:7900"
+        assert (await first.find_leg(secret, DAEMON)).id == daemon_leg
+        assert daemon_leg > client_leg
+
+        # Only the worker holding a leg can unregister it.
+        await second.unregister_leg(secret, CLIENT, "10.0.0.2:7900")
+        assert await second.find_leg(secret, CLIENT) is not None
+        await first.unregister_leg(secret, CLIENT, "10.0.0.1:7900")
+        assert await second.find_leg(secret, CLIENT) is None
+
+    asyncio.run(run())